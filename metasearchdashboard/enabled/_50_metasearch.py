@@ -25,3 +25,11 @@ DISABLED = False
 ADD_INSTALLED_APPS = [
     'metasearchdashboard',
 ]
+
+ADD_JS_FILES = [
+    'metasearchdashboard/js/metasearchdashboard.js',
+]
+
+ADD_ANGULAR_MODULES = [
+    'horizon.metafinder',
+]
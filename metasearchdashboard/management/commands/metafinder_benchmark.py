@@ -0,0 +1,312 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+import timeit
+
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.management.base import BaseCommand
+from django.test.client import RequestFactory
+
+from openstack_auth import user as auth_user
+
+from metasearchdashboard.metafinder import breaker
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import fakes
+from metasearchdashboard.metafinder import index
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder import sync
+from metasearchdashboard.metafinder import tables
+from metasearchdashboard.metafinder import tabs
+from metasearchdashboard.metafinder import views
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import swift_helpers
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+
+SCENARIOS = ('render', 'format', 'tabs', 'search', 'index', 'records',
+             'query')
+
+SEARCH = 'app_id=app1'
+
+SELECT = 'app_id IN (app1,app2) AND NOT has:deprecated AND key_1=value-0'
+
+# Pattern lookups of the index, fuzzy ones on values sharing a prefix.
+PATTERNS = (
+    ('substring', 'key_3~lue-5'),
+    ('prefix', 'app_id^=app4'),
+    ('fuzzy', 'app_id%app42x'),
+    ('any key', '*~value-1'),
+)
+
+
+class FakeResource(object):
+    def __init__(self, resource_id, metadata, updated):
+        self.id = resource_id
+        self.metadata = metadata
+        self.updated = updated
+
+
+def legacy_metadata_dict_to_str(metadata, attr_name=None):
+    """The original string concatenation rendering, for comparison"""
+    attr_name = attr_name or "metadata"
+    metadata = getattr(metadata, attr_name)
+    if metadata is None:
+        return "None"
+    mystr = ""
+    items = len(metadata)
+    for k, v in metadata.items():
+        mystr += "{}: {}".format(k, v)
+        items -= 1
+        if items >= 1:
+            mystr += ", "
+    return mystr
+
+
+def reset_state():
+    """Forgets every cache, index and memo the panel keeps in process"""
+    cache._backend = None
+    breaker._breakers.clear()
+    index._indexes.clear()
+    sync._engines.clear()
+    tables._rendered_metadata = cache.MemoryBackend(
+        max_entries=tables._rendered_metadata.max_entries)
+    swift_helpers._revalidated = cache.MemoryBackend(
+        max_entries=swift_helpers._revalidated.max_entries)
+
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[int(round(fraction * (len(timings) - 1)))]
+
+
+def peak_memory(func):
+    """Peak bytes allocated while running func"""
+    if tracemalloc is None:
+        func()
+        # Only the high-water mark of the whole process is available.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def retained_memory(build):
+    """Bytes still allocated by what build() returns, None if unknown"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        held = build()
+        size = tracemalloc.get_traced_memory()[0]
+        del held
+        return size
+    finally:
+        tracemalloc.stop()
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the metafinder panel against offline fake Nova, "
+            "Cinder, Glance and Swift services.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                            help='Any of %s.' % ', '.join(SCENARIOS))
+        parser.add_argument('--scales', default='100,10000,100000',
+                            help='Resources of each type in the fake '
+                                 'project, comma separated.')
+        parser.add_argument('--metadata-keys', type=int, default=10,
+                            help='Metadata items per fake resource.')
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Seconds each fake API call takes.')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--rows', type=int, default=1000,
+                            help='Rows for the render scenario.')
+        parser.add_argument('--keys', type=int, default=200,
+                            help='Metadata items for the render scenario.')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs for the render scenario.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        if 'render' in options['scenarios']:
+            self.bench_render()
+        for scale in [int(s) for s in options['scales'].split(',')]:
+            backends = fakes.FakeBackends(
+                count=scale,
+                metadata_keys=options['metadata_keys'],
+                latency=options['latency'])
+            self.stdout.write('\n%d resources of each type' % scale)
+            self.stdout.write('%-28s %10s %10s %12s  %s' % (
+                'scenario', 'p50 ms', 'p99 ms', 'peak KiB', 'API calls'))
+            with backends.patch():
+                for scenario in options['scenarios']:
+                    if scenario != 'render':
+                        getattr(self, 'bench_%s' % scenario)(backends)
+
+    def make_request(self, data=None):
+        request = RequestFactory().get('/', data or {})
+        request.session = {}
+        request.user = auth_user.User(
+            id='bench', username='bench', tenant_id='bench',
+            tenant_name='bench', roles=[{'name': 'admin'}],
+            services_region='RegionOne', enabled=True)
+        request._messages = CookieStorage(request)
+        return request
+
+    def measure(self, name, backends, func, setup=None):
+        """Times func over the iterations, setup runs untimed before each"""
+        iterations = self.options['iterations']
+        timings = []
+        backends.calls.clear()
+        for i in range(iterations):
+            if setup:
+                setup()
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+        calls = dict((k, v / float(iterations))
+                     for k, v in backends.calls.items())
+        if setup:
+            setup()
+        peak = peak_memory(func)
+        self.stdout.write('%-28s %10.2f %10.2f %12d  %s' % (
+            name,
+            percentile(timings, 0.5) * 1000,
+            percentile(timings, 0.99) * 1000,
+            peak / 1024,
+            ', '.join('%s=%g' % item for item in sorted(calls.items()))))
+
+    def _tab(self, request, slug):
+        return tabs.MetaFinderTabs(request).get_tab(slug)
+
+    def _data_func(self, tab):
+        return getattr(tab, 'get_%s_data' % tab.table_classes[0]._meta.name)
+
+    def bench_tabs(self, backends):
+        for tab_class in tabs.MetaFinderTabs.tabs:
+            self.measure(
+                'tab %s' % tab_class.slug, backends,
+                lambda: self._data_func(
+                    self._tab(self.make_request(), tab_class.slug))(),
+                setup=reset_state)
+
+    def bench_search(self, backends):
+        for tab_class in tabs.MetaFinderTabs.tabs:
+            def search():
+                request = self.make_request()
+                tab = self._tab(request, tab_class.slug)
+                table = tab._tables[tab.table_classes[0]._meta.name]
+                param_name = table._meta._filter_action.get_param_name()
+                request.session[param_name] = SEARCH
+                return self._data_func(tab)()
+
+            self.measure('cold search %s' % tab_class.slug, backends,
+                         search, setup=reset_state)
+            self.measure('warm search %s' % tab_class.slug, backends,
+                         search)
+
+    def bench_index(self, backends):
+        def render():
+            response = views.IndexView.as_view()(self.make_request())
+            return response.render()
+
+        self.measure('IndexView render', backends, render,
+                     setup=reset_state)
+
+    def bench_records(self, backends):
+        builders = (
+            (resources.INSTANCES, backends.instance),
+            (resources.VOLUMES, backends.volume),
+            (resources.IMAGES, backends.image),
+        )
+        for resource_type, build in builders:
+            records._keys.clear()
+            for name, func in (
+                    ('api', build),
+                    ('record', lambda i: records.compact(resource_type,
+                                                         build(i)))):
+                size = retained_memory(
+                    lambda: [func(i) for i in range(backends.count)])
+                self.stdout.write('%-28s %10s bytes/row' % (
+                    '%s %s' % (name, resource_type),
+                    'n/a' if size is None else size // backends.count))
+
+    def bench_query(self, backends):
+        rows = [records.compact(resources.VOLUMES, backends.volume(i))
+                for i in range(backends.count)]
+        predicates = query.parse(SELECT)
+        self.measure('query select', backends,
+                     lambda: list(query.select(resources.VOLUMES, rows,
+                                               predicates)))
+        metadata_index = index.MetadataIndex()
+        metadata_index.update(resources.VOLUMES, rows)
+        for name, filter_string in PATTERNS:
+            [predicate] = query.parse(filter_string)
+            self.measure('index %s' % name, backends,
+                         lambda: metadata_index.match(resources.VOLUMES,
+                                                      predicate))
+
+    def bench_format(self, backends):
+        rows = [backends.instance(i) for i in range(backends.count)]
+
+        def render():
+            for row in rows:
+                tables.metadata_dict_to_str(row)
+
+        self.measure('format cold', backends, render, setup=reset_state)
+        self.measure('format memoized', backends, render)
+
+    def bench_render(self):
+        rows = [
+            FakeResource('resource-%d' % i,
+                         dict(('key_%d' % k, 'value-%d-%d' % (i, k))
+                              for k in range(self.options['keys'])),
+                         '2016-01-01T00:00:00Z')
+            for i in range(self.options['rows'])
+        ]
+
+        def render(func):
+            def run():
+                for row in rows:
+                    func(row)
+            return run
+
+        self.stdout.write('%d rows x %d metadata items' % (
+            self.options['rows'], self.options['keys']))
+        reset_state()
+        self._report('legacy', render(legacy_metadata_dict_to_str))
+        self._report('cold', render(tables.metadata_dict_to_str),
+                     setup=reset_state)
+        reset_state()
+        render(tables.metadata_dict_to_str)()
+        self._report('memoized', render(tables.metadata_dict_to_str))
+
+    def _report(self, name, func, setup=None):
+        timings = []
+        for i in range(self.options['repeat']):
+            if setup:
+                setup()
+            timings.append(timeit.timeit(func, number=1))
+        self.stdout.write('%-10s best %.4fs  worst %.4fs' %
+                          (name, min(timings), max(timings)))
@@ -0,0 +1,91 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from metasearchdashboard.metafinder import crawler
+from metasearchdashboard.metafinder import snapshot
+from metasearchdashboard.metafinder.api import resources
+
+
+class Command(BaseCommand):
+    help = ("Crawls the metadata of every project into the snapshot at "
+            "METAFINDER_SNAPSHOT_PATH, which the metafinder tabs serve "
+            "while it is fresh. Credentials default to the OS_* "
+            "environment variables and need the admin role.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Seconds between crawls, 0 crawls once.')
+        parser.add_argument('--types', default=','.join(
+            resources.RESOURCE_TYPES))
+        parser.add_argument('--auth-url', default=os.environ.get(
+            'OS_AUTH_URL', getattr(settings, 'OPENSTACK_KEYSTONE_URL', None)))
+        parser.add_argument('--username',
+                            default=os.environ.get('OS_USERNAME'))
+        parser.add_argument('--password',
+                            default=os.environ.get('OS_PASSWORD'))
+        parser.add_argument('--project-name',
+                            default=os.environ.get('OS_PROJECT_NAME'))
+        parser.add_argument('--user-domain-name', default=os.environ.get(
+            'OS_USER_DOMAIN_NAME', 'Default'))
+        parser.add_argument('--project-domain-name', default=os.environ.get(
+            'OS_PROJECT_DOMAIN_NAME', 'Default'))
+        parser.add_argument('--region',
+                            default=os.environ.get('OS_REGION_NAME'))
+
+    def handle(self, *args, **options):
+        store = self.get_store()
+        resource_types = options['types'].split(',')
+        unknown = set(resource_types) - set(resources.RESOURCE_TYPES)
+        if unknown:
+            raise CommandError('Unknown resource types: %s' %
+                               ', '.join(sorted(unknown)))
+        while True:
+            self.crawl_all(store, resource_types, options)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def get_store(self):
+        store = snapshot.get_store()
+        if store is None:
+            raise CommandError('METAFINDER_SNAPSHOT_PATH is not set.')
+        return store
+
+    def crawl_all(self, store, resource_types, options):
+        # Log in for every crawl, tokens expire between them.
+        request = crawler.login(
+            options['auth_url'], options['username'],
+            options['password'], options['project_name'],
+            options['user_domain_name'], options['project_domain_name'],
+            options['region'])
+        for resource_type in resource_types:
+            start = time.time()
+            try:
+                count = self.crawl(request, store, resource_type)
+            except Exception as e:
+                self.stderr.write('Crawl of %s failed: %r' %
+                                  (resource_type, e))
+                continue
+            self.stdout.write('Crawled %d %s in %.1fs' %
+                              (count, resource_type, time.time() - start))
+
+    def crawl(self, request, store, resource_type):
+        return crawler.crawl(request, store, resource_type)
@@ -0,0 +1,52 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import time
+
+from metasearchdashboard.management.commands import metafinder_crawl
+from metasearchdashboard.metafinder import notifications
+
+
+DEFAULT_RECONCILE_INTERVAL = 600
+
+
+class Command(metafinder_crawl.Command):
+    help = ("Applies Nova, Cinder and Glance notifications to the snapshot "
+            "at METAFINDER_SNAPSHOT_PATH as they arrive, and crawls every "
+            "--interval seconds to catch the ones missed. Keep the interval "
+            "under METAFINDER_SNAPSHOT_MAX_AGE so the snapshot stays in use. "
+            "Takes the credentials of metafinder_crawl.")
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.set_defaults(interval=DEFAULT_RECONCILE_INTERVAL)
+
+    def handle(self, *args, **options):
+        self.listener = notifications.Listener(self.get_store(),
+                                               notifications.get_transport(),
+                                               options['region'])
+        self.listener.start()
+        try:
+            super(Command, self).handle(*args, **options)
+            # Without reconciliation, listen until interrupted.
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.listener.stop()
+            self.stdout.write('Applied %d changes' % self.listener.applied)
+
+    def crawl(self, request, store, resource_type):
+        return self.listener.reconcile(request, resource_type)
@@ -0,0 +1,202 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Metadata search across every project and region, for admins
+
+The search is split into one unit per (region, project, resource type),
+run on a bounded pool of threads. Each unit lists only its project, with
+the metadata filters its service supports pushed down, so the projects
+are searched side by side rather than one after the other.
+"""
+
+import copy
+import heapq
+import re
+
+from django.conf import settings
+from swiftclient import client as swift_client
+
+from openstack_dashboard import api
+from openstack_dashboard.api import base
+
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import swift_helpers
+from metasearchdashboard.metafinder.api import workers
+
+
+DEFAULT_TIMEOUT = 120
+
+
+def get_regions(request):
+    """METAFINDER_SEARCH_REGIONS, or every region of the user's catalog"""
+    regions = getattr(settings, 'METAFINDER_SEARCH_REGIONS', None)
+    if regions:
+        return list(regions)
+    return sorted(request.user.available_services_regions or
+                  [request.user.services_region])
+
+
+def for_region(request, region):
+    """A copy of request whose API calls go to the given region"""
+    if region == request.user.services_region:
+        return request
+    request = copy.copy(request)
+    request.user = copy.copy(request.user)
+    request.user.services_region = region
+    return request
+
+
+def _instances(request, project_id, filters):
+    return resources.iter_pages(
+        resources.INSTANCES,
+        lambda marker: api.nova.server_list(
+            request,
+            search_opts={'tenant_id': project_id, 'marker': marker,
+                         'paginate': True},
+            all_tenants=True))
+
+
+def _volumes(request, project_id, filters):
+    search_opts = dict(filters or {}, all_tenants=1, project_id=project_id)
+    return resources.iter_pages(
+        resources.VOLUMES,
+        lambda marker: api.cinder.volume_list_paged(
+            request, search_opts=search_opts, marker=marker,
+            paginate=True)[:2])
+
+
+def _images(request, project_id, filters):
+    filters = dict(filters or {}, owner=project_id, is_public=None)
+    return resources.iter_pages(
+        resources.IMAGES,
+        lambda marker: api.glance.image_list_detailed(
+            request, marker=marker, filters=filters, paginate=True)[:2])
+
+
+def _swift_connection(request, project_id):
+    """
+    Connection to another project's Swift account, which needs the
+    ResellerAdmin role
+    """
+    endpoint = base.url_for(request, 'object-store')
+    prefix = getattr(settings, 'METAFINDER_SWIFT_RESELLER_PREFIX', 'AUTH_')
+    url = re.sub(r'/%s[^/]*$' % re.escape(prefix),
+                 '/%s%s' % (prefix, project_id), endpoint)
+    return swift_client.Connection(
+        preauthurl=url, preauthtoken=request.user.token.id,
+        insecure=getattr(settings, 'OPENSTACK_SSL_NO_VERIFY', False),
+        cacert=getattr(settings, 'OPENSTACK_SSL_CACERT', None))
+
+
+def _containers(request, project_id, filters):
+    # Connections are not thread safe, each worker borrows one of its own.
+    pool = swift_helpers.ConnectionPool(
+        lambda: _swift_connection(request, project_id),
+        workers.get_max_workers())
+
+    def list_page(marker):
+        limit = getattr(settings, 'API_RESULT_LIMIT', 1000)
+        with pool.connection() as connection:
+            headers, listing = connection.get_account(
+                marker=marker, limit=limit + 1, full_listing=False)
+        names = [c['name'] for c in listing[:limit]]
+        containers = workers.bounded_map(
+            lambda name: _container(pool, name), names,
+            lambda name, e: None)
+        return [c for c in containers if c is not None], len(listing) > limit
+
+    return resources.iter_pages(resources.CONTAINERS, list_page)
+
+
+def _container(pool, name):
+    with pool.connection() as connection:
+        headers = connection.head_container(name)
+    return swift_helpers.Container({
+        'name': name,
+        'metadata': swift_helpers._headers_to_metadata(
+            headers, meta_prefix='x-container-meta-'),
+    })
+
+
+LISTERS = {
+    resources.INSTANCES: _instances,
+    resources.VOLUMES: _volumes,
+    resources.IMAGES: _images,
+    resources.CONTAINERS: _containers,
+}
+
+
+def _search_unit(request, unit, predicates):
+    region, project_id, resource_type = unit
+    filters, residual = query.push_down(resource_type, predicates)
+    results = []
+    for resource in query.select(
+            resource_type,
+            LISTERS[resource_type](request, project_id, filters),
+            residual):
+        result = resources.to_dict(resource_type, resource)
+        result['project_id'] = project_id
+        result['region'] = region
+        results.append(result)
+    results.sort(key=sort_key)
+    return results
+
+
+def _failed_unit(unit, exc):
+    region, project_id, resource_type = unit
+    return [{'type': 'error', 'resource_type': resource_type,
+             'project_id': project_id, 'region': region,
+             'message': str(exc)}]
+
+
+def sort_key(result):
+    return ((result['name'] or '').lower(), result['type'],
+            result['project_id'], result['region'], result['id'])
+
+
+def search(request, predicates, resource_types=resources.RESOURCE_TYPES,
+           regions=None, project_ids=None):
+    """
+    Returns the matching resources of every project and region
+
+    Results are dicts like search.stream yields with project_id and region
+    added, merged in name order. Units that failed or did not finish within
+    METAFINDER_ADMIN_SEARCH_TIMEOUT seconds are reported as error dicts at
+    the end.
+    """
+    regions = regions or get_regions(request)
+    if project_ids is None:
+        projects, has_more = api.keystone.tenant_list(request)
+        project_ids = [p.id for p in projects]
+    units = [(region, project_id, resource_type)
+             for region in regions
+             for project_id in project_ids
+             for resource_type in resource_types]
+    regional = dict((region, for_region(request, region))
+                    for region in regions)
+    batches = workers.bounded_map(
+        lambda unit: _search_unit(regional[unit[0]], unit, predicates),
+        units,
+        _failed_unit,
+        max_workers=getattr(settings, 'METAFINDER_ADMIN_MAX_WORKERS', None),
+        timeout=getattr(settings, 'METAFINDER_ADMIN_SEARCH_TIMEOUT',
+                        DEFAULT_TIMEOUT))
+    errors = [r for batch in batches for r in batch if r['type'] == 'error']
+    found = [batch for batch in batches
+             if not batch or batch[0]['type'] != 'error']
+    merged = heapq.merge(*[[(sort_key(r), r) for r in batch]
+                           for batch in found])
+    return [result for key, result in merged] + errors
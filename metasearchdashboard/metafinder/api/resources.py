@@ -0,0 +1,151 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from openstack_dashboard import api
+
+from metasearchdashboard.metafinder.api import swift_helpers
+from metasearchdashboard.metafinder.api import workers
+
+
+INSTANCES = 'instances'
+VOLUMES = 'volumes'
+IMAGES = 'images'
+CONTAINERS = 'containers'
+OBJECTS = 'objects'
+
+RESOURCE_TYPES = (INSTANCES, VOLUMES, IMAGES, CONTAINERS)
+
+# Objects are only searched when asked for, finding them takes a HEAD per
+# candidate object.
+SEARCHABLE_TYPES = RESOURCE_TYPES + (OBJECTS,)
+
+# The service answering for each resource type, used to label metrics.
+SERVICES = {
+    INSTANCES: 'nova',
+    VOLUMES: 'cinder',
+    IMAGES: 'glance',
+    CONTAINERS: 'swift',
+    OBJECTS: 'swift',
+}
+
+METADATA_ATTRS = {
+    INSTANCES: 'metadata',
+    VOLUMES: 'metadata',
+    IMAGES: 'properties',
+    CONTAINERS: 'metadata',
+    OBJECTS: 'metadata',
+}
+
+
+def get_resource_id(resource_type, resource):
+    """
+    Containers have no id, their name is unique within the account. Objects
+    are identified by "container/object".
+    """
+    if resource_type == CONTAINERS:
+        return resource.name
+    return resource.id
+
+
+def get_metadata(resource_type, resource):
+    return getattr(resource, METADATA_ATTRS[resource_type], None) or {}
+
+
+def to_dict(resource_type, resource):
+    """The fields of a resource the search and export endpoints return"""
+    return {
+        'type': resource_type,
+        'id': get_resource_id(resource_type, resource),
+        'name': resource.name,
+        'metadata': dict(get_metadata(resource_type, resource)),
+    }
+
+
+def list_instances(request, marker=None, filters=None):
+    instances, has_more = api.nova.server_list(
+        request,
+        search_opts={'marker': marker, 'paginate': True})
+    return instances, has_more, False
+
+
+def list_volumes(request, marker=None, filters=None):
+    return api.cinder.volume_list_paged(
+        request,
+        marker=marker,
+        paginate=True,
+        search_opts=filters
+    )
+
+
+def list_images(request, marker=None, filters=None):
+    return api.glance.image_list_detailed(
+        request,
+        marker=marker,
+        filters=filters, paginate=True)
+
+
+def list_containers(request, marker=None, filters=None, limit=None):
+    """
+    The account listing comes in pages of API_RESULT_LIMIT names, limit
+    cuts a smaller page out of it so only the rows shown are looked up.
+    Containers whose listing entry did not change are not HEADed again.
+    """
+    containers, has_more = api.swift.swift_get_containers(
+        request=request,
+        marker=marker
+    )
+    if limit is not None and len(containers) > limit:
+        containers = containers[:limit]
+        has_more = True
+    containers = workers.bounded_map(
+        lambda c: swift_helpers.swift_get_container_revalidated(request, c),
+        containers,
+        lambda c, e: swift_helpers.swift_get_container_from_listing(c)
+    )
+    return containers, has_more, False
+
+
+# Listers return (items, has_more, has_prev). filters are the native
+# filters query.push_down produced for the service, if it supports any.
+LISTERS = {
+    INSTANCES: list_instances,
+    VOLUMES: list_volumes,
+    IMAGES: list_images,
+    CONTAINERS: list_containers,
+}
+
+
+def iter_pages(resource_type, list_page):
+    """
+    Yields every resource list_page(marker) returns, following markers
+
+    list_page returns (items, has_more) like the Horizon API wrappers.
+    """
+    marker = None
+    while True:
+        items, has_more = list_page(marker)
+        for item in items:
+            yield item
+        if not has_more or not items:
+            break
+        marker = get_resource_id(resource_type, items[-1])
+
+
+def iter_resources(request, resource_type, filters=None):
+    """
+    Yields every resource of the given type, following markers page by page
+    """
+    lister = LISTERS[resource_type]
+    return iter_pages(resource_type, lambda marker: lister(
+        request, marker=marker, filters=filters)[:2])
@@ -12,21 +12,164 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import contextlib
 from datetime import datetime
+import threading
+
+from six.moves import queue
 import six.moves.urllib.parse as urlparse
+from swiftclient import client as swift_client
+
+from django.conf import settings
 
 from openstack_dashboard.api import base
-from openstack_dashboard.api.swift import swift_api
 from openstack_dashboard.api.swift import GLOBAL_READ_ACL
 from openstack_dashboard.api.swift import Container
 
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import metrics
+from metasearchdashboard.metafinder.api import workers
+
+
+DEFAULT_POOL_TTL = 300
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 8
+DEFAULT_REVALIDATE_TTL = 600
+DEFAULT_REVALIDATE_ENTRIES = 100000
+
+# Pool per request, or per token and region across requests.
+REQUEST = 'request'
+TOKEN = 'token'
+
+
+def swift_api(request):
+    """
+    A new keep-alive Swift connection for the request
+
+    Failed calls are retried METAFINDER_SWIFT_RETRIES times, waiting
+    METAFINDER_SWIFT_BACKOFF seconds at first and doubling up to
+    METAFINDER_SWIFT_MAX_BACKOFF.
+    """
+    return swift_client.Connection(
+        None, request.user.username, None,
+        preauthtoken=request.user.token.id,
+        preauthurl=base.url_for(request, 'object-store'),
+        cacert=getattr(settings, 'OPENSTACK_SSL_CACERT', None),
+        insecure=getattr(settings, 'OPENSTACK_SSL_NO_VERIFY', False),
+        auth_version="2.0",
+        retries=getattr(settings, 'METAFINDER_SWIFT_RETRIES',
+                        DEFAULT_RETRIES),
+        starting_backoff=getattr(settings, 'METAFINDER_SWIFT_BACKOFF',
+                                 DEFAULT_BACKOFF),
+        max_backoff=getattr(settings, 'METAFINDER_SWIFT_MAX_BACKOFF',
+                            DEFAULT_MAX_BACKOFF))
+
+
+class ConnectionPool(object):
+    """
+    Up to size connections made by factory, reused across calls
+
+    swiftclient connections are not thread safe, so each one is lent to a
+    single caller at a time; callers beyond size wait for one to be returned.
+    """
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
 
-def swift_get_container_with_metadata(request, container_name, with_data=True):
+_pools = cache.MemoryBackend(max_entries=1000)
+_pools_lock = threading.Lock()
+
+
+def get_pool(request):
+    """
+    The connection pool of a request, METAFINDER_SWIFT_POOL_SCOPE "token"
+    shares it between the requests of a token for METAFINDER_SWIFT_POOL_TTL
+    """
+    if getattr(settings, 'METAFINDER_SWIFT_POOL_SCOPE', REQUEST) == TOKEN:
+        store, key = _pools, (request.user.token.id,
+                              request.user.services_region)
+    else:
+        store, key = None, '_metafinder_swift_pool'
+    with _pools_lock:
+        pool = (store.get(key) if store is not None
+                else request.__dict__.get(key))
+        if pool is None:
+            pool = ConnectionPool(
+                lambda: swift_api(request),
+                getattr(settings, 'METAFINDER_SWIFT_POOL_SIZE', None) or
+                workers.get_max_workers())
+            if store is not None:
+                store.set(key, pool, getattr(
+                    settings, 'METAFINDER_SWIFT_POOL_TTL', DEFAULT_POOL_TTL))
+            else:
+                request.__dict__[key] = pool
+    return pool
+
+
+def connection(request):
+    """Borrows a pooled Swift connection, use as a context manager"""
+    return get_pool(request).connection()
+
+
+class LazyContainer(Container):
+    """
+    Container whose object listing is only fetched when data is read
+
+    The metadata comes from a HEAD on the container, so rendering a table of
+    these never downloads the (possibly huge) listing body.
+    """
+    def __init__(self, apidict, request):
+        super(LazyContainer, self).__init__(apidict)
+        self._request = request
+
+    @property
+    def data(self):
+        if 'data' not in self._apidict:
+            headers, data = _get_object(self._request, self.name)
+            self._apidict['data'] = data
+        return self._apidict['data']
+
+
+def swift_get_container_with_metadata(request, container_name,
+                                      with_data=False):
     if with_data:
-        headers, data = swift_api(request).get_object(container_name, "")
+        headers, data = _get_object(request, container_name)
     else:
-        data = None
-        headers = swift_api(request).head_container(container_name)
+        with metrics.timed(request, 'swift_head', 'containers') as timer:
+            with connection(request) as conn:
+                headers = conn.head_container(container_name)
+            timer.bytes = _headers_size(headers)
     timestamp = None
     is_public = False
     public_url = None
@@ -55,11 +198,148 @@ def swift_get_container_with_metadata(request, container_name, with_data=True):
         'container_object_count': headers.get('x-container-object-count'),
         'container_bytes_used': headers.get('x-container-bytes-used'),
         'timestamp': timestamp,
-        'data': data,
         'is_public': is_public,
         'public_url': public_url,
         'metadata': metadata
     }
+    if not with_data:
+        return LazyContainer(container_info, request)
+    container_info['data'] = data
+    return Container(container_info)
+
+
+def container_signature(container):
+    """
+    What changes in an account listing entry when its container does
+
+    Account listings carry last_modified on recent Swift releases; without
+    it fall back to the object count and bytes used.
+    """
+    last_modified = getattr(container, 'last_modified', None)
+    if last_modified:
+        return last_modified
+    return (getattr(container, 'count', None),
+            getattr(container, 'bytes', None))
+
+
+_revalidated = cache.MemoryBackend(max_entries=getattr(
+    settings, 'METAFINDER_CONTAINER_REVALIDATE_ENTRIES',
+    DEFAULT_REVALIDATE_ENTRIES))
+
+# Concurrent lookups of the same container share one HEAD.
+_container_flights = cache.SingleFlight()
+
+
+def _revalidation_key(request, container_name):
+    return (request.user.tenant_id, request.user.services_region,
+            container_name)
+
+
+def swift_get_container_revalidated(request, container):
+    """
+    Looks up a container from its account listing entry, with a HEAD only
+    when the entry changed since the container was last looked up
+
+    Lookups are reused for METAFINDER_CONTAINER_REVALIDATE_TTL seconds at
+    most, metadata changes do not always show in the listing, and
+    METAFINDER_CONTAINER_REVALIDATE_ENTRIES of them are kept. Concurrent
+    lookups of a container share one HEAD.
+    """
+    signature = container_signature(container)
+    key = _revalidation_key(request, container.name)
+    cached = _revalidated.get(key)
+    if cached is None or cached[0] != signature:
+        cached = _container_flights.do(
+            (key, signature),
+            lambda: _revalidate(request, key, signature, container.name),
+            lambda: metrics.timed(request, 'coalesced', 'containers'))
+    return LazyContainer(dict(cached[1]), request)
+
+
+def _revalidate(request, key, signature, container_name):
+    found = swift_get_container_with_metadata(request, container_name,
+                                              with_data=False)
+    entry = (signature, dict(found._apidict))
+    _revalidated.set(key, entry,
+                     getattr(settings, 'METAFINDER_CONTAINER_REVALIDATE_TTL',
+                             DEFAULT_REVALIDATE_TTL))
+    return entry
+
+
+def forget_container(request, container_name):
+    """Makes the next lookup of a container HEAD it again"""
+    _revalidated.delete(_revalidation_key(request, container_name))
+
+
+def _get_object(request, container_name):
+    with metrics.timed(request, 'swift_get', 'containers') as timer:
+        with connection(request) as conn:
+            headers, data = conn.get_object(container_name, "")
+        timer.bytes = _headers_size(headers) + len(data or '')
+    return headers, data
+
+
+def _headers_size(headers):
+    return sum(len(k) + len(v) for k, v in headers.items())
+
+
+class SwiftObject(base.APIDictWrapper):
+    """An object with the metadata of its HEAD, identified by container/name"""
+    @property
+    def id(self):
+        return '%s/%s' % (self.container_name, self.name)
+
+
+def swift_get_object_with_metadata(request, container_name, object_name):
+    with metrics.timed(request, 'swift_head', 'objects') as timer:
+        with connection(request) as conn:
+            headers = conn.head_object(container_name, object_name)
+        timer.bytes = _headers_size(headers)
+    return SwiftObject({
+        'name': object_name,
+        'container_name': container_name,
+        'bytes': headers.get('content-length'),
+        'content_type': headers.get('content-type'),
+        'last_modified': headers.get('last-modified'),
+        'metadata': _headers_to_metadata(headers,
+                                         meta_prefix='x-object-meta-'),
+    })
+
+
+def swift_list_objects(request, container_name, marker=None, prefix=None,
+                       limit=None):
+    """
+    Returns (names, has_more) of a page of a container's object listing
+    """
+    limit = limit or getattr(settings, 'API_RESULT_LIMIT', 1000)
+    with metrics.timed(request, 'swift_list', 'objects') as timer:
+        with connection(request) as conn:
+            headers, listing = conn.get_container(
+                container_name, marker=marker, prefix=prefix,
+                limit=limit + 1, full_listing=False)
+        timer.items = len(listing)
+    names = [o['name'] for o in listing[:limit] if 'name' in o]
+    return names, len(listing) > limit
+
+
+def swift_get_container_from_listing(container):
+    """
+    Builds a partial container from an account listing entry
+
+    Used when the per-container lookup fails or times out, so the row can
+    still be shown with whatever the listing already told us.
+    """
+    container_info = {
+        'name': container.name,
+        'container_object_count': getattr(container, 'count', None),
+        'container_bytes_used': getattr(container, 'bytes', None),
+        'timestamp': None,
+        'data': None,
+        'is_public': False,
+        'public_url': None,
+        'metadata': {},
+        'partial': True
+    }
     return Container(container_info)
 
 
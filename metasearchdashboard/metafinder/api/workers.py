@@ -0,0 +1,85 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+
+from concurrent import futures
+
+from django.conf import settings
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TIMEOUT = 10
+
+
+def get_max_workers():
+    return getattr(settings, 'METAFINDER_MAX_WORKERS', DEFAULT_MAX_WORKERS)
+
+
+def get_timeout():
+    return getattr(settings, 'METAFINDER_REQUEST_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+class DetachedRequest(object):
+    """
+    What the API wrappers read of a request: its user, which carries the
+    token, region and project, and copies of its session and cookies
+
+    Work that may outlive the response runs with one of these instead of
+    the request, which Django is done with once the response is returned.
+    """
+    def __init__(self, request):
+        self.user = request.user
+        self.session = dict(request.session.items())
+        self.COOKIES = dict(request.COOKIES)
+
+
+def bounded_map(func, items, fallback, max_workers=None, timeout=None):
+    """
+    Calls func(item) for every item using a bounded pool of threads
+
+    Results are returned in the same order as items. When a call raises or
+    has not finished timeout seconds after the batch started,
+    fallback(item, exc) is used to build its result instead, so one bad
+    item never fails the whole batch nor holds it up past the timeout.
+    """
+    items = list(items)
+    if not items:
+        return []
+    max_workers = max_workers or get_max_workers()
+    timeout = timeout if timeout is not None else get_timeout()
+
+    executor = futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(items)))
+    try:
+        pending = [executor.submit(func, item) for item in items]
+        done, not_done = futures.wait(pending, timeout=timeout)
+        results = []
+        for item, future in zip(items, pending):
+            if future in not_done:
+                future.cancel()
+                error = futures.TimeoutError()
+            else:
+                error = future.exception()
+                if error is None:
+                    results.append(future.result())
+                    continue
+            LOG.warning("Lookup for %s failed: %r", item, error)
+            results.append(fallback(item, error))
+        return results
+    finally:
+        # Never block the response on a worker stuck past its timeout.
+        executor.shutdown(wait=False)
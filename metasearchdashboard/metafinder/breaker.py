@@ -0,0 +1,238 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Deadlines and circuit breakers for the backend calls of the panel
+
+Each call to a service gets METAFINDER_BACKEND_TIMEOUTS seconds for that
+service, METAFINDER_REQUEST_TIMEOUT when it is not listed, cut down to what
+is left of the tab's budget. A call past its deadline is abandoned rather
+than interrupted: it finishes on its worker thread, the page goes on.
+
+Each service has a pool of threads of its own. A service whose calls time
+out or fail with a server or connection error
+METAFINDER_BREAKER_FAILURES times in a row is not called for
+METAFINDER_BREAKER_COOLDOWN seconds, then a single call is let through to
+see whether it is back. Client errors such as a 404 or an expired token
+are answers, they count as successes.
+"""
+
+import logging
+import socket
+import threading
+import time
+
+from concurrent import futures
+
+from django.conf import settings
+
+from metasearchdashboard.metafinder.api import workers
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_FAILURES = 5
+DEFAULT_COOLDOWN = 30
+DEFAULT_WORKERS = 16
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class Unavailable(Exception):
+    """A service was not called, or did not answer in time"""
+    def __init__(self, service, reason):
+        super(Unavailable, self).__init__('%s is unavailable (%s)' %
+                                          (service, reason))
+        self.service = service
+        self.reason = reason
+
+
+class CircuitBreaker(object):
+    """
+    Counts the consecutive failures of a service, open after failures of
+    them until cooldown seconds have passed
+    """
+    def __init__(self, failures=None, cooldown=None):
+        self.failures = failures or getattr(
+            settings, 'METAFINDER_BREAKER_FAILURES', DEFAULT_FAILURES)
+        self.cooldown = cooldown or getattr(
+            settings, 'METAFINDER_BREAKER_COOLDOWN', DEFAULT_COOLDOWN)
+        self.state = CLOSED
+        self._failed = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether to call the service, a half-open breaker allows one"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if (self.state == OPEN and
+                    time.time() - self._opened_at >= self.cooldown):
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self.state = CLOSED
+            self._failed = 0
+
+    def failed(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == HALF_OPEN or self._failed >= self.failures:
+                self.state = OPEN
+                self._opened_at = time.time()
+
+    def released(self):
+        """A call let through ended telling nothing, let another one"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+_executors = {}
+
+
+def get_breaker(request, service):
+    """The breaker of a service in the request's region, process wide"""
+    key = (service, request.user.services_region)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker()
+        return breaker
+
+
+def get_timeout(service):
+    timeouts = getattr(settings, 'METAFINDER_BACKEND_TIMEOUTS', {})
+    return timeouts.get(service, workers.get_timeout())
+
+
+def _get_executor(service):
+    """
+    The pool of a service, METAFINDER_BACKEND_WORKERS threads, so calls
+    stuck on one service never hold up the calls to another
+    """
+    with _breakers_lock:
+        executor = _executors.get(service)
+        if executor is None:
+            executor = _executors[service] = futures.ThreadPoolExecutor(
+                max_workers=getattr(settings, 'METAFINDER_BACKEND_WORKERS',
+                                    DEFAULT_WORKERS))
+        return executor
+
+
+# Errors raised by the clients when a service cannot be reached, matched by
+# name so that none of the client libraries has to be imported here.
+CONNECTION_ERRORS = frozenset([
+    'CommunicationError',
+    'ConnectFailure',
+    'ConnectionError',
+    'ConnectionRefused',
+    'ConnectTimeout',
+    'GatewayTimeout',
+    'RequestTimeout',
+    'ServiceUnavailable',
+])
+
+
+def is_outage(exc):
+    """
+    Whether an error tells the service is down: a 5xx status or no answer
+    at all. Client errors and errors of our own do not.
+    """
+    status = getattr(exc, 'http_status', None) or getattr(exc, 'code', None)
+    if isinstance(status, int) and not isinstance(status, bool):
+        return status >= 500
+    if isinstance(exc, socket.error):
+        return True
+    return any(cls.__name__ in CONNECTION_ERRORS
+               for cls in type(exc).__mro__)
+
+
+class Budget(object):
+    """The latency budget of a tab, None for no limit"""
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds if seconds else None
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(self.expires - time.time(), 0)
+
+
+def _allow(request, service, timeout, budget):
+    """Returns (breaker, timeout left) of a call about to be made"""
+    remaining = budget.remaining() if budget is not None else None
+    if remaining is not None:
+        if remaining <= 0:
+            raise Unavailable(service, 'budget spent')
+        timeout = min(timeout, remaining) if timeout else remaining
+    breaker = get_breaker(request, service)
+    if not breaker.allow():
+        raise Unavailable(service, 'circuit open')
+    return breaker, timeout
+
+
+def _wait(breaker, service, future, timeout, crawl=False):
+    try:
+        result = future.result(timeout=timeout)
+    except futures.TimeoutError:
+        LOG.warning("Call to %s took more than %ss", service, timeout)
+        # A call still queued behind others was never made.
+        if future.cancel() or crawl:
+            breaker.released()
+        else:
+            breaker.failed()
+        raise Unavailable(service, 'timed out')
+    except Exception as e:
+        if is_outage(e):
+            breaker.failed()
+        else:
+            # A client error is still an answer, the service is up.
+            breaker.succeeded()
+        raise
+    breaker.succeeded()
+    return result
+
+
+def call(request, service, func, budget=None):
+    """
+    Returns func(), the call to service, within its deadline
+
+    Raises Unavailable when the breaker of the service is open, the budget
+    is spent or the call does not return in time.
+    """
+    breaker, timeout = _allow(request, service, get_timeout(service), budget)
+    future = _get_executor(service).submit(func)
+    return _wait(breaker, service, future, timeout)
+
+
+def wait_for_crawl(request, service, start, budget=None):
+    """
+    Returns the result of the future start() returns for a crawl of
+    service, which runs on a thread of its own
+
+    A crawl may take any time, so it is only bounded by the budget and its
+    timing out is no failure of the service. Raises Unavailable like call.
+    """
+    breaker, timeout = _allow(request, service, None, budget)
+    return _wait(breaker, service, start(), timeout, crawl=True)
@@ -0,0 +1,294 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from metasearchdashboard.metafinder import metrics
+from metasearchdashboard.metafinder.api import workers
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60
+DEFAULT_STALE_TTL = 3600
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class MemoryBackend(object):
+    """
+    In-process LRU cache with a per entry expiry time
+
+    The least recently used entry is evicted once max_entries is reached.
+    Counters are kept apart and never evicted.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or getattr(
+            settings, 'METAFINDER_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+        self._entries = collections.OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+class DjangoBackend(object):
+    """
+    Stores entries in a Django cache (METAFINDER_CACHE_ALIAS)
+
+    Django pickles cached values, entries that cannot be pickled are not
+    cached rather than failing the page.
+    """
+    def __init__(self, alias=None):
+        from django.core.cache import caches
+        alias = alias or getattr(settings, 'METAFINDER_CACHE_ALIAS',
+                                 'default')
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        try:
+            self.cache.set(key, value, ttl)
+        except Exception as e:
+            LOG.debug("Unable to cache %s: %r", key, e)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def counter(self, key):
+        return self.cache.get(key) or 0
+
+    def incr(self, key):
+        # A counter the cache evicted starts again from the clock rather
+        # than 0, so it does not go back to a value pages were cached with.
+        self.cache.add(key, int(time.time() * 1000), None)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Evicted again between add and incr.
+            value = int(time.time() * 1000)
+            self.cache.set(key, value, None)
+            return value
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs one call per key at a time
+
+    Callers of a key whose call is already running wait for it and share
+    its result, or its exception, instead of making their own. saved counts
+    the calls spared that way. A caller that waits longer than the timeout
+    makes its own call after all, so a stuck call never holds up others
+    for longer than it holds up itself.
+    """
+    def __init__(self):
+        self.saved = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fetch, waiting=None, timeout=None):
+        """
+        Returns fetch(), or the result of the running call of key
+
+        waiting, when given, returns a context manager entered while
+        waiting on another caller. timeout defaults to
+        METAFINDER_REQUEST_TIMEOUT.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.saved += 1
+        if not leader:
+            if timeout is None:
+                timeout = workers.get_timeout()
+            if waiting is None:
+                done = call.done.wait(timeout)
+            else:
+                with waiting():
+                    done = call.done.wait(timeout)
+            if not done:
+                LOG.warning("Gave up waiting on %s after %ss", key, timeout)
+                return fetch()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fetch()
+            return call.value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'django': DjangoBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# Page fetches in flight in this process, by cache key.
+flights = SingleFlight()
+
+
+def get_backend():
+    """
+    Returns the configured backend, METAFINDER_CACHE_BACKEND is either
+    "memory", "django" or the dotted path of a backend class. Backends have
+    get, set and delete, and counter and incr for the generations.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = getattr(settings, 'METAFINDER_CACHE_BACKEND', 'memory')
+            backend_class = BACKENDS.get(name) or import_string(name)
+            _backend = backend_class()
+        return _backend
+
+
+def _scope(request, resource_type):
+    """A project sees other resources in each region"""
+    return 'metafinder:%s:%s:%s' % (request.user.tenant_id,
+                                    request.user.services_region,
+                                    resource_type)
+
+
+def _generation(backend, scope):
+    return backend.counter(scope + ':generation')
+
+
+def make_key(request, resource_type, marker, filter_string):
+    """
+    Keys carry a per project, region and resource type generation, bumping
+    it invalidates every page cached for that scope at once.
+    """
+    backend = get_backend()
+    scope = _scope(request, resource_type)
+    page = hashlib.md5(repr((marker, filter_string)).encode('utf-8'))
+    return '%s:%s:%s' % (scope, _generation(backend, scope), page.hexdigest())
+
+
+def _stale_key(request, resource_type, marker, filter_string):
+    """Last good copies outlive generations, they are shown as stale"""
+    page = hashlib.md5(repr((marker, filter_string)).encode('utf-8'))
+    return '%s:stale:%s' % (_scope(request, resource_type), page.hexdigest())
+
+
+def get_or_fetch(request, resource_type, marker, filter_string, fetch):
+    """
+    Returns the cached result of fetch() for a page of a resource type
+
+    Unless METAFINDER_COALESCE is False, requests of this process missing
+    the same page while it is being fetched wait for that fetch rather than
+    making their own; each of them is timed as a "coalesced" call.
+    """
+    backend = get_backend()
+    key = make_key(request, resource_type, marker, filter_string)
+    value = backend.get(key)
+    if value is not None:
+        return value
+    stale_key = _stale_key(request, resource_type, marker, filter_string)
+    if not getattr(settings, 'METAFINDER_COALESCE', True):
+        return _fetch_and_store(backend, key, stale_key, fetch)
+    return flights.do(
+        key, lambda: _fetch_and_store(backend, key, stale_key, fetch),
+        lambda: metrics.timed(request, 'coalesced', resource_type))
+
+
+def _fetch_and_store(backend, key, stale_key, fetch):
+    # A flight of the same page may have ended since the caller looked.
+    value = backend.get(key)
+    if value is None:
+        value = fetch()
+        backend.set(key, value,
+                    getattr(settings, 'METAFINDER_CACHE_TTL', DEFAULT_TTL))
+        stale_ttl = getattr(settings, 'METAFINDER_STALE_TTL',
+                            DEFAULT_STALE_TTL)
+        if stale_ttl:
+            backend.set(stale_key, value, stale_ttl)
+    return value
+
+
+def get_stale(request, resource_type, marker, filter_string):
+    """
+    The last page fetch() returned, kept METAFINDER_STALE_TTL seconds
+    (0 keeps none) for when the service is unavailable
+    """
+    return get_backend().get(_stale_key(request, resource_type, marker,
+                                        filter_string))
+
+
+def invalidate(request, resource_type):
+    """
+    Drops every cached page of a resource type for the project in the
+    request's region
+    """
+    get_backend().incr(_scope(request, resource_type) + ':generation')
@@ -0,0 +1,154 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Crawls every project's resources with admin credentials into a snapshot
+
+Images are crawled whatever their owner and visibility, along with the
+projects the shared ones are shared with, so each project's snapshot holds
+the images it sees in Horizon.
+"""
+
+import logging
+
+from django.test.client import RequestFactory
+from keystoneauth1.identity import v3
+from keystoneauth1 import session as ks_session
+from openstack_auth import user as auth_user
+from openstack_dashboard import api
+
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder import snapshot
+from metasearchdashboard.metafinder.api import resources
+
+
+LOG = logging.getLogger(__name__)
+
+
+def login(auth_url, username, password, project_name,
+          user_domain_name='Default', project_domain_name='Default',
+          region=None):
+    """
+    Returns a request authenticated as the given user, for calling the
+    openstack_dashboard API wrappers outside of a web request
+    """
+    auth = v3.Password(auth_url=auth_url, username=username,
+                       password=password, project_name=project_name,
+                       user_domain_name=user_domain_name,
+                       project_domain_name=project_domain_name)
+    auth_ref = auth.get_access(ks_session.Session())
+    request = RequestFactory().get('/')
+    request.session = {}
+    token = auth_user.Token(auth_ref)
+    request.user = auth_user.create_user_from_token(
+        request, token, auth_url, services_region=region)
+    return request
+
+
+def _instances(request):
+    return resources.iter_pages(
+        resources.INSTANCES,
+        lambda marker: api.nova.server_list(
+            request, search_opts={'marker': marker, 'paginate': True},
+            all_tenants=True))
+
+
+def _volumes(request):
+    return resources.iter_pages(
+        resources.VOLUMES,
+        lambda marker: api.cinder.volume_list_paged(
+            request, search_opts={'all_tenants': 1}, marker=marker,
+            paginate=True)[:2])
+
+
+def _images(request):
+    # is_public None lists private images of other projects too.
+    return resources.iter_pages(
+        resources.IMAGES,
+        lambda marker: api.glance.image_list_detailed(
+            request, marker=marker, paginate=True,
+            filters={'is_public': None})[:2])
+
+
+def _containers(request):
+    # Swift accounts belong to one project, only the crawler's own account
+    # can be listed.
+    return resources.iter_resources(request, resources.CONTAINERS)
+
+
+CRAWLERS = {
+    resources.INSTANCES: (_instances, 'tenant_id'),
+    resources.VOLUMES: (_volumes, 'os-vol-tenant-attr:tenant_id'),
+    resources.IMAGES: (_images, 'owner'),
+    resources.CONTAINERS: (_containers, None),
+}
+
+
+def _raw_attr(resource, attr):
+    raw = getattr(resource, '_apiresource', resource)
+    return getattr(raw, attr, None)
+
+
+def _is_shared(image):
+    """
+    Glance v2 images have a visibility, v1 images can be shared unless
+    public
+    """
+    visibility = _raw_attr(image, 'visibility')
+    if visibility is not None:
+        return visibility == 'shared'
+    return not _raw_attr(image, 'is_public')
+
+
+def _image_members(request, image):
+    """The (image id, project id) pairs of the projects image is shared with"""
+    try:
+        members = api.glance.glanceclient(request).image_members.list(
+            image.id)
+        # v1 members have no status, v2 ones must have accepted.
+        return [(image.id, member.member_id) for member in members
+                if getattr(member, 'status', 'accepted') == 'accepted']
+    except Exception as e:
+        LOG.warning("Unable to list the members of image %s: %r",
+                    image.id, e)
+        return []
+
+
+def to_record(request, resource_type, resource, project_attr):
+    record = records.compact(resource_type, resource)
+    if project_attr is None:
+        record.project_id = request.user.tenant_id
+    record.name = record.name or ''
+    return record
+
+
+def crawl(request, store, resource_type):
+    """
+    Crawls one resource type of the request's region into store, returns
+    the number of rows
+    """
+    iterate, project_attr = CRAWLERS[resource_type]
+    found = []
+    members = []
+    for resource in iterate(request):
+        found.append(to_record(request, resource_type, resource,
+                               project_attr))
+        if resource_type == resources.IMAGES and _is_shared(resource):
+            members.extend(_image_members(request, resource))
+    scope = snapshot.ALL_PROJECTS
+    if project_attr is None:
+        scope = request.user.tenant_id
+    store.replace(resource_type, request.user.services_region, found,
+                  scope=scope, members=members)
+    return len(found)
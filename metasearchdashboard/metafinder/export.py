@@ -0,0 +1,92 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Writers turning search results into CSV or JSON Lines, one line at a time
+"""
+
+import csv
+import itertools
+import json
+
+import six
+
+from django.conf import settings
+
+
+FIELDS = ('type', 'id', 'name', 'project_id', 'region', 'resource_type',
+          'message')
+
+METADATA_PREFIX = 'metadata.'
+
+DEFAULT_SAMPLE_SIZE = 20
+
+
+def flatten(result):
+    """Moves the metadata of a result into metadata.<key> fields"""
+    row = dict((k, v) for k, v in result.items() if k != 'metadata')
+    for key, value in (result.get('metadata') or {}).items():
+        row[METADATA_PREFIX + key] = value
+    return row
+
+
+def jsonl_lines(results):
+    for result in results:
+        yield json.dumps(flatten(result), sort_keys=True) + '\n'
+
+
+class _Line(object):
+    """File-like object handing back what csv.writer writes to it"""
+    def write(self, value):
+        return value
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if six.PY2:
+        return six.text_type(value).encode('utf-8')
+    return value
+
+
+def csv_lines(results, keys=None):
+    """
+    Yields the CSV header and rows, with one column per metadata key
+
+    The header is written before any result is asked for when keys are
+    given, e.g. those the query names. Without them the columns are the
+    keys found in the first METAFINDER_EXPORT_SAMPLE_SIZE results, a page
+    or so. Other keys go into a final other_metadata column, as JSON, so
+    the download never waits on more than that sample.
+    """
+    if keys is None:
+        results = iter(results)
+        sample = list(itertools.islice(results, getattr(
+            settings, 'METAFINDER_EXPORT_SAMPLE_SIZE', DEFAULT_SAMPLE_SIZE)))
+        keys = sorted(set(key for result in sample
+                          for key in result.get('metadata') or {}))
+        results = itertools.chain(sample, results)
+    columns = set(keys)
+    writer = csv.writer(_Line())
+    yield writer.writerow([_cell(f) for f in FIELDS] +
+                          [_cell(METADATA_PREFIX + k) for k in keys] +
+                          ['other_metadata'])
+    for result in results:
+        metadata = result.get('metadata') or {}
+        other = dict((k, v) for k, v in metadata.items()
+                     if k not in columns)
+        yield writer.writerow(
+            [_cell(result.get(f)) for f in FIELDS] +
+            [_cell(metadata.get(k)) for k in keys] +
+            [json.dumps(other, sort_keys=True) if other else ''])
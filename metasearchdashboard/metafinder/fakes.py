@@ -0,0 +1,198 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Offline stand-ins for the Nova, Cinder, Glance and Swift calls the panel
+makes, for benchmarks and tests.
+
+Resources are generated from their position on demand, so a fake project
+with 100k resources costs no memory until its pages are listed.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+from openstack_dashboard.api import cinder
+from openstack_dashboard.api import glance
+from openstack_dashboard.api import nova
+from openstack_dashboard.api import swift
+
+from metasearchdashboard.metafinder.api import resources
+
+
+class FakeResource(object):
+    def __init__(self, **attrs):
+        for name, value in attrs.items():
+            setattr(self, name, value)
+
+
+class FakeBackends(object):
+    """
+    Fake services holding count resources of each type
+
+    Every resource carries metadata_keys metadata items, app_id is shared by
+    every 100th resource so searches have something to find. Each API call
+    sleeps latency seconds and is counted in calls.
+    """
+    def __init__(self, count=100, metadata_keys=10, latency=0.0,
+                 page_size=20, container_page_size=1000):
+        self.count = count
+        self.metadata_keys = metadata_keys
+        self.latency = latency
+        self.page_size = page_size
+        self.container_page_size = container_page_size
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def metadata(self, i):
+        metadata = dict(('key_%d' % k, 'value-%d' % (i % (k + 7)))
+                        for k in range(1, self.metadata_keys))
+        metadata['app_id'] = 'app%d' % (i % 100)
+        return metadata
+
+    def _resource_id(self, prefix, i):
+        return '%s-%08d' % (prefix, i)
+
+    def _position(self, marker):
+        return int(marker.rsplit('-', 1)[1]) + 1 if marker else 0
+
+    def _page(self, marker, size, build, match=None):
+        items = []
+        i = self._position(marker)
+        while i < self.count and len(items) <= size:
+            item = build(i)
+            if match is None or match(item):
+                items.append(item)
+            i += 1
+        has_more = len(items) > size
+        return items[:size], has_more, marker is not None
+
+    def instance(self, i):
+        return FakeResource(**{
+            'id': self._resource_id('instance', i),
+            'name': 'instance-%d' % i,
+            'status': 'ACTIVE',
+            'OS-EXT-STS:task_state': None,
+            'OS-EXT-STS:power_state': 1,
+            'OS-EXT-AZ:availability_zone': 'nova',
+            'image_name': 'cirros',
+            'tenant_id': 'bench',
+            'updated': '2016-01-01T00:00:00Z',
+            'metadata': self.metadata(i),
+        })
+
+    def volume(self, i):
+        return FakeResource(
+            id=self._resource_id('volume', i),
+            name='volume-%d' % i,
+            status='available',
+            availability_zone='nova',
+            updated_at='2016-01-01T00:00:00.000000',
+            metadata=self.metadata(i))
+
+    def image(self, i):
+        return FakeResource(
+            id=self._resource_id('image', i),
+            name='image-%d' % i,
+            status='active',
+            owner='bench',
+            updated_at='2016-01-01T00:00:00Z',
+            properties=self.metadata(i))
+
+    def container_headers(self, i):
+        headers = dict(('x-container-meta-%s' % k, v)
+                       for k, v in self.metadata(i).items())
+        headers['x-container-object-count'] = '0'
+        headers['x-container-bytes-used'] = '0'
+        headers['x-timestamp'] = '1451606400.00000'
+        return headers
+
+    def server_list(self, request, search_opts=None, all_tenants=False):
+        self._call('nova.server_list')
+        marker = (search_opts or {}).get('marker')
+        items, has_more, has_prev = self._page(
+            marker, self.page_size, self.instance)
+        return items, has_more
+
+    def volume_list_paged(self, request, search_opts=None, marker=None,
+                          paginate=False, sort_dir="desc"):
+        self._call('cinder.volume_list_paged')
+        pairs = (search_opts or {}).get('metadata', {})
+        return self._page(
+            marker, self.page_size, self.volume,
+            lambda v: all(v.metadata.get(k) == val
+                          for k, val in pairs.items()) if pairs else True)
+
+    def image_list_detailed(self, request, marker=None, sort_dir='desc',
+                            sort_key='created_at', filters=None,
+                            paginate=False, reversed_order=False):
+        self._call('glance.image_list_detailed')
+        filters = dict(filters or {})
+        pairs = filters.pop('properties', None) or filters
+        return self._page(
+            marker, self.page_size, self.image,
+            lambda i: all(i.properties.get(k) == val
+                          for k, val in pairs.items()) if pairs else True)
+
+    def swift_get_containers(self, request, marker=None, prefix=None):
+        self._call('swift.swift_get_containers')
+        i = self._position(marker)
+        names = ['container-%08d' % n
+                 for n in range(i, min(i + self.container_page_size + 1,
+                                       self.count))]
+        containers = [swift.Container({'name': name, 'count': 0,
+                                       'bytes': 0})
+                      for name in names]
+        if len(containers) > self.container_page_size:
+            return containers[:-1], True
+        return containers, False
+
+    def head_container(self, name):
+        self._call('swift.head_container')
+        return self.container_headers(int(name.rsplit('-', 1)[1]))
+
+    def get_object(self, container, name):
+        self._call('swift.get_object')
+        return {}, ''
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Replaces the service calls the panel makes with these fakes"""
+        swift_client = FakeResource(head_container=self.head_container,
+                                    get_object=self.get_object)
+        fakes = [
+            (nova, 'server_list', self.server_list),
+            (cinder, 'volume_list_paged', self.volume_list_paged),
+            (glance, 'image_list_detailed', self.image_list_detailed),
+            (swift, 'swift_get_containers', self.swift_get_containers),
+            (resources.swift_helpers, 'swift_api',
+             lambda *args, **kwargs: swift_client),
+        ]
+        originals = [(module, name, getattr(module, name))
+                     for module, name, fake in fakes]
+        for module, name, fake in fakes:
+            setattr(module, name, fake)
+        try:
+            yield self
+        finally:
+            for module, name, original in reversed(originals):
+                setattr(module, name, original)
@@ -0,0 +1,268 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import threading
+
+from django.conf import settings
+
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import ngram
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder.api import resources
+
+
+DEFAULT_FACET_KEYS = 10
+DEFAULT_FACET_VALUES = 5
+DEFAULT_MAX_PROJECTS = 100
+
+# Keys with at most this many distinct values are scanned for pattern
+# matches, rather than looked up by trigrams among the values of all keys.
+SCAN_VALUES = 256
+
+
+class MetadataIndex(object):
+    """
+    Inverted index of metadata key/value pairs to resource ids
+
+    Resources are kept per resource type, as the records the tables render,
+    so a search needs no other round trip to the service. Counts of the
+    resources carrying each key and value are kept up to date as resources
+    come and go, for facets, and the distinct keys and values of each type
+    are indexed by trigrams for substring, prefix and fuzzy matches.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}
+        self._key_postings = {}
+        self._resources = {}
+        self._terms = {}
+        self._key_counts = {}
+        self._value_counts = {}
+        self._key_grams = {}
+        self._value_grams = {}
+
+    def add(self, resource_type, resource):
+        resource = records.compact(resource_type, resource)
+        resource_id = resources.get_resource_id(resource_type, resource)
+        metadata = resources.get_metadata(resource_type, resource)
+        terms = [(query.to_text(k), query.to_text(v))
+                 for k, v in metadata.items()]
+        with self._lock:
+            self._unlink(resource_type, resource_id)
+            self._resources.setdefault(resource_type, {})[resource_id] = \
+                resource
+            self._terms[(resource_type, resource_id)] = terms
+            for key, value in terms:
+                self._postings.setdefault(
+                    (resource_type, key, value), set()).add(resource_id)
+                self._key_postings.setdefault(
+                    (resource_type, key), set()).add(resource_id)
+                keys = self._key_counts.setdefault(resource_type,
+                                                   collections.Counter())
+                if not keys[key]:
+                    self._grams(self._key_grams, resource_type).add(key)
+                keys[key] += 1
+                values = self._value_counts.setdefault(
+                    (resource_type, key), collections.Counter())
+                if not values[value]:
+                    self._grams(self._value_grams, resource_type).add(value)
+                values[value] += 1
+
+    def _grams(self, grams, resource_type):
+        index = grams.get(resource_type)
+        if index is None:
+            index = grams[resource_type] = ngram.TrigramIndex()
+        return index
+
+    def update(self, resource_type, items):
+        for item in items:
+            self.add(resource_type, item)
+
+    def get(self, resource_type, resource_id):
+        """The indexed record of a resource, None when not indexed"""
+        with self._lock:
+            return self._resources.get(resource_type, {}).get(resource_id)
+
+    def remove(self, resource_type, resource_id):
+        with self._lock:
+            self._unlink(resource_type, resource_id)
+            self._resources.get(resource_type, {}).pop(resource_id, None)
+
+    def _unlink(self, resource_type, resource_id):
+        terms = self._terms.pop((resource_type, resource_id), ())
+        for key, value in terms:
+            for postings, index_key in (
+                    (self._postings, (resource_type, key, value)),
+                    (self._key_postings, (resource_type, key))):
+                ids = postings.get(index_key)
+                if ids is not None:
+                    ids.discard(resource_id)
+                    if not ids:
+                        del postings[index_key]
+            if self._decrement(self._key_counts, resource_type, key):
+                self._key_grams[resource_type].discard(key)
+            if self._decrement(self._value_counts, (resource_type, key),
+                               value):
+                self._value_grams[resource_type].discard(value)
+
+    def _decrement(self, counters, counter_key, value):
+        """Returns whether value was the last of its counter"""
+        counter = counters.get(counter_key)
+        if counter is None:
+            return False
+        counter[value] -= 1
+        if counter[value] > 0:
+            return False
+        del counter[value]
+        if not counter:
+            del counters[counter_key]
+        return True
+
+    def replace(self, resource_type, items):
+        """Swaps in a complete listing for a resource type"""
+        with self._lock:
+            for resource_id in list(self._resources.get(resource_type, {})):
+                self.remove(resource_type, resource_id)
+            self.update(resource_type, items)
+
+    def search(self, resource_type, terms, among=None):
+        """
+        Returns the resources matching all of the (key, value) terms, only
+        those whose id is in the set among when given
+        """
+        with self._lock:
+            candidates = [among] if among is not None else []
+            for key, value in terms:
+                if value is None:
+                    ids = self._key_postings.get((resource_type, key))
+                else:
+                    ids = self._postings.get((resource_type, key, value))
+                if not ids:
+                    return []
+                candidates.append(ids)
+            objects = self._resources.get(resource_type, {})
+            if not candidates:
+                return list(objects.values())
+            candidates.sort(key=len)
+            matches = candidates[0].intersection(*candidates[1:])
+            return [objects[resource_id] for resource_id in matches]
+
+    def match(self, resource_type, predicate):
+        """
+        Returns {resource id: rank} of the resources matching a substring,
+        prefix or fuzzy predicate, lower ranks matching more closely
+
+        Ranks are the edit distance of fuzzy matches, otherwise 0 when the
+        value equals the one searched and 1 when it only contains it.
+        """
+        key, op, value = predicate
+        test = query.value_test(op, value)
+        with self._lock:
+            grams = self._value_grams.get(resource_type)
+            values = self._value_counts.get((resource_type, key), ())
+            if grams is None:
+                return {}
+            if key != query.ANY_KEY and len(values) <= SCAN_VALUES:
+                candidates = list(values)
+            elif op == query.CONTAINS:
+                candidates = grams.substring(value)
+            elif op == query.PREFIX:
+                candidates = grams.prefix(value)
+            else:
+                candidates = grams.similar(value, query.fuzzy_distance(value))
+            if key == query.ANY_KEY:
+                keys = list(self._key_counts.get(resource_type, ()))
+            else:
+                keys = [key]
+            found = {}
+            for text in candidates:
+                if not test(text):
+                    continue
+                rank = self._rank(op, value, text)
+                for k in keys:
+                    for resource_id in self._postings.get(
+                            (resource_type, k, text), ()):
+                        if found.get(resource_id, rank + 1) > rank:
+                            found[resource_id] = rank
+            return found
+
+    def _rank(self, op, value, text):
+        if op == query.FUZZY:
+            limit = query.fuzzy_distance(value)
+            return query.edit_distance(value.lower(), text.lower(), limit)
+        return 0 if text == value else 1
+
+    def suggest(self, resource_type, text, limit=10):
+        """
+        Returns the keys and the values closest to text, best first, as
+        ([(key, similarity), ...], [(value, similarity), ...])
+        """
+        with self._lock:
+            return tuple(
+                grams[resource_type].ranked(text, limit)
+                if resource_type in grams else []
+                for grams in (self._key_grams, self._value_grams))
+
+    def facets(self, resource_type, keys=10, values=5):
+        """
+        Returns the most used keys of a resource type with their most used
+        values, as [(key, count, [(value, count), ...]), ...]
+        """
+        with self._lock:
+            counts = self._key_counts.get(resource_type)
+            if not counts:
+                return []
+            return [(key, count,
+                     self._value_counts[(resource_type, key)]
+                     .most_common(values))
+                    for key, count in counts.most_common(keys)]
+
+
+def get_max_projects():
+    return getattr(settings, 'METAFINDER_INDEX_MAX_PROJECTS',
+                   DEFAULT_MAX_PROJECTS)
+
+
+# The indexes of the METAFINDER_INDEX_MAX_PROJECTS projects and regions
+# searched last, the others are built again when next searched.
+_indexes = cache.MemoryBackend(max_entries=get_max_projects())
+_indexes_lock = threading.Lock()
+
+
+def get_index(request):
+    """
+    Returns the index for the project and region the request is scoped to
+    """
+    key = (request.user.tenant_id, request.user.services_region)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = MetadataIndex()
+            _indexes.set(key, index, None)
+        return index
+
+
+def get_facets(request, resource_type, keys=None, values=None):
+    """
+    Facets of the project's index, METAFINDER_FACET_KEYS keys with
+    METAFINDER_FACET_VALUES values each unless told otherwise
+    """
+    return get_index(request).facets(
+        resource_type,
+        keys=keys or getattr(settings, 'METAFINDER_FACET_KEYS',
+                             DEFAULT_FACET_KEYS),
+        values=values or getattr(settings, 'METAFINDER_FACET_VALUES',
+                                 DEFAULT_FACET_VALUES))
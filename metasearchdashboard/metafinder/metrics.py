@@ -0,0 +1,225 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Timings of the backend calls and table rendering of the panel
+
+Enabled with METAFINDER_METRICS. Each sample is recorded twice: against the
+request, to be sent back as a Server-Timing header, and in a process wide
+registry exposed in Prometheus or StatsD text format. When disabled timed()
+returns a shared no-op, so the instrumented code pays one settings lookup.
+"""
+
+import bisect
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds in seconds, the Prometheus client defaults.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Sample = collections.namedtuple('Sample', ['name', 'resource_type',
+                                           'seconds', 'bytes', 'items'])
+
+
+def is_enabled():
+    return getattr(settings, 'METAFINDER_METRICS', False)
+
+
+class Series(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.items = 0
+        # The last slot counts samples above the largest bucket.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, sample):
+        self.count += 1
+        self.seconds += sample.seconds
+        self.bytes += sample.bytes
+        self.items += sample.items
+        self.buckets[bisect.bisect_left(BUCKETS, sample.seconds)] += 1
+
+
+class Registry(object):
+    """Aggregated samples per (name, resource type)"""
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def add(self, sample):
+        key = (sample.name, sample.resource_type)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = Series()
+            series.add(sample)
+
+    def snapshot(self):
+        with self._lock:
+            return sorted(self._series.items())
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+registry = Registry()
+
+
+class _Timer(object):
+    def __init__(self, request, name, resource_type):
+        self.request = request
+        self.name = name
+        self.resource_type = resource_type
+        self.bytes = 0
+        self.items = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.request, Sample(self.name, self.resource_type,
+                                    time.time() - self.start,
+                                    self.bytes, self.items))
+
+
+class _NoopTimer(object):
+    bytes = 0
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __setattr__(self, name, value):
+        # Shared by every caller, so what they count is dropped.
+        pass
+
+
+_noop = _NoopTimer()
+
+
+def timed(request, name, resource_type):
+    """
+    Times the block as a call to name for resource_type
+
+    The context manager has bytes and items attributes the block can set.
+    """
+    if not is_enabled():
+        return _noop
+    return _Timer(request, name, resource_type)
+
+
+def record(request, sample):
+    registry.add(sample)
+    if request is not None:
+        # Tabs may load in parallel threads, setdefault is atomic.
+        request.__dict__.setdefault('_metafinder_samples', []).append(sample)
+    hook = _get_hook()
+    if hook is not None:
+        try:
+            hook(sample)
+        except Exception:
+            LOG.exception("Metrics hook %s failed", hook)
+
+
+# The path METAFINDER_METRICS_HOOK was last imported from, and its callable.
+_hook = (None, None)
+
+
+def _get_hook():
+    """
+    The METAFINDER_METRICS_HOOK callable, imported once for each value of
+    the setting; None when unset or when it cannot be imported
+    """
+    global _hook
+    path = getattr(settings, 'METAFINDER_METRICS_HOOK', None)
+    if not path:
+        return None
+    if _hook[0] != path:
+        try:
+            hook = import_string(path)
+        except ImportError:
+            LOG.exception("Unable to import metrics hook %s", path)
+            hook = None
+        _hook = (path, hook)
+    return _hook[1]
+
+
+def server_timing(request):
+    """
+    Returns the Server-Timing header value for the samples of a request
+
+    Samples of the same call and resource type are summed.
+    """
+    totals = collections.OrderedDict()
+    for sample in getattr(request, '_metafinder_samples', ()):
+        key = '%s-%s' % (sample.name, sample.resource_type)
+        count, seconds = totals.get(key, (0, 0.0))
+        totals[key] = (count + 1, seconds + sample.seconds)
+    return ', '.join('%s;dur=%.1f;desc="%d calls"' % (key, s * 1000, count)
+                     for key, (count, s) in totals.items())
+
+
+def prometheus_text():
+    """
+    The registry in the Prometheus text exposition format, the samples of
+    each metric family grouped under its # TYPE line
+    """
+    series = [('call="%s",resource_type="%s"' % key, values)
+              for key, values in registry.snapshot()]
+    lines = ['# TYPE metafinder_call_seconds histogram']
+    for labels, values in series:
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), values.buckets):
+            cumulative += count
+            lines.append('metafinder_call_seconds_bucket{%s,le="%s"} %d' %
+                         (labels, bound, cumulative))
+        lines.append('metafinder_call_seconds_sum{%s} %f' %
+                     (labels, values.seconds))
+        lines.append('metafinder_call_seconds_count{%s} %d' %
+                     (labels, values.count))
+    for family, attr in (('metafinder_call_bytes_total', 'bytes'),
+                         ('metafinder_call_items_total', 'items')):
+        lines.append('# TYPE %s counter' % family)
+        for labels, values in series:
+            lines.append('%s{%s} %d' % (family, labels,
+                                        getattr(values, attr)))
+    return '\n'.join(lines) + '\n'
+
+
+def statsd_text():
+    """The registry as StatsD gauge lines, for a collector to forward"""
+    lines = []
+    for (name, resource_type), series in registry.snapshot():
+        prefix = 'metafinder.%s.%s' % (name, resource_type)
+        mean = series.seconds / series.count if series.count else 0
+        lines.append('%s.count:%d|g' % (prefix, series.count))
+        lines.append('%s.mean_ms:%.1f|g' % (prefix, mean * 1000))
+        lines.append('%s.bytes:%d|g' % (prefix, series.bytes))
+        lines.append('%s.items:%d|g' % (prefix, series.items))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,156 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Trigram index of metadata strings for substring, prefix and fuzzy lookups
+
+Each distinct string is indexed once, however many resources carry it, by
+the lowercased three character sequences it contains. A lookup intersects
+or counts the postings of the trigrams of what is searched for and returns
+candidates, which callers check with the real predicate: the index only
+narrows millions of strings down to a few before they are compared.
+"""
+
+import collections
+
+from django.conf import settings
+
+
+DEFAULT_MAX_LENGTH = 256
+
+START = u'\x02'
+END = u'\x03'
+
+
+def trigrams(text, start=START, end=END):
+    """The set of lowercased trigrams of text, padded with start and end"""
+    text = start + text.lower() + end
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TrigramIndex(object):
+    """
+    Reference counted set of strings indexed by trigrams
+
+    Strings longer than METAFINDER_NGRAM_MAX_LENGTH are kept aside and
+    returned as candidates of every lookup, rather than indexed.
+    """
+    def __init__(self, max_length=None):
+        self.max_length = max_length or getattr(
+            settings, 'METAFINDER_NGRAM_MAX_LENGTH', DEFAULT_MAX_LENGTH)
+        self._refs = {}
+        self._postings = {}
+        self._unindexed = set()
+
+    def __len__(self):
+        return len(self._refs)
+
+    def add(self, text):
+        refs = self._refs.get(text, 0)
+        self._refs[text] = refs + 1
+        if refs:
+            return
+        if len(text) > self.max_length:
+            self._unindexed.add(text)
+            return
+        for gram in trigrams(text):
+            self._postings.setdefault(gram, set()).add(text)
+
+    def discard(self, text):
+        refs = self._refs.get(text, 0) - 1
+        if refs > 0:
+            self._refs[text] = refs
+            return
+        self._refs.pop(text, None)
+        if text in self._unindexed:
+            self._unindexed.discard(text)
+            return
+        for gram in trigrams(text):
+            strings = self._postings.get(gram)
+            if strings is not None:
+                strings.discard(text)
+                if not strings:
+                    del self._postings[gram]
+
+    def _intersect(self, grams):
+        if not grams:
+            return set(self._refs)
+        postings = sorted((self._postings.get(g, ()) for g in grams), key=len)
+        if not postings[0]:
+            return set(self._unindexed)
+        found = set(postings[0])
+        for strings in postings[1:]:
+            found.intersection_update(strings)
+            if not found:
+                break
+        return found | self._unindexed
+
+    def substring(self, fragment):
+        """Strings that may contain fragment"""
+        return self._intersect(trigrams(fragment, u'', u''))
+
+    def prefix(self, fragment):
+        """Strings that may start with fragment"""
+        return self._intersect(trigrams(fragment, START, u''))
+
+    def _shared(self, text):
+        grams = trigrams(text)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        return grams, shared
+
+    def similar(self, text, distance):
+        """
+        Strings that may be within distance edits of text
+
+        An edit changes at most three trigrams, so closer strings share at
+        least len(grams) - 3 * distance of them, and hence one of any
+        3 * distance + 1 of them. Candidates come from the postings of the
+        rarest ones, the others are only checked for those candidates.
+        """
+        grams = trigrams(text)
+        needed = len(grams) - 3 * distance
+        if needed <= 0:
+            return set(self._refs)
+        postings = sorted((self._postings.get(g, ()) for g in grams),
+                          key=len)
+        rare, common = postings[:3 * distance + 1], postings[3 * distance + 1:]
+        shared = collections.Counter()
+        for strings in rare:
+            shared.update(strings)
+        found = set(self._unindexed)
+        for candidate, count in shared.items():
+            if abs(len(candidate) - len(text)) > distance:
+                continue
+            for strings in common:
+                if count >= needed:
+                    break
+                count += candidate in strings
+            if count >= needed:
+                found.add(candidate)
+        return found
+
+    def ranked(self, text, limit=10):
+        """
+        The limit strings sharing the most trigrams with text, best first,
+        as (string, similarity) where similarity goes from 0 to 1
+        """
+        grams, shared = self._shared(text)
+        scored = []
+        for candidate, count in shared.most_common(limit * 5):
+            total = len(grams) + len(trigrams(candidate)) - count
+            scored.append((candidate, float(count) / total))
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
@@ -0,0 +1,345 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Keeps the snapshot current from Nova, Cinder and Glance notifications
+
+Create, update (metadata changes included) and delete events are applied
+to the snapshot's rows as they arrive, so between crawls searches follow
+the changes within seconds without calling the services. Events can be
+missed, e.g. while the listener is down, so crawls still run as a slower
+reconciliation. Swift sends no notifications, containers only change with
+crawls.
+
+Notifications come through a transport, METAFINDER_NOTIFICATION_TRANSPORT:
+"oslo" listens on the message bus with oslo.messaging, "memory" is an in
+process queue for tests, or the dotted path of a transport class.
+"""
+
+import collections
+import logging
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from metasearchdashboard.metafinder import crawler
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder.api import resources
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_TOPICS = ('notifications',)
+DEFAULT_POOL = 'metafinder'
+
+# A change to apply, fields are the record fields the notification carries,
+# None when the resource is gone.
+Change = collections.namedtuple('Change', ['resource_type', 'resource_id',
+                                           'fields'])
+
+# Event type prefixes, and the suffixes of events deleting resources.
+PREFIXES = (
+    ('compute.instance.', resources.INSTANCES),
+    ('instance.', resources.INSTANCES),
+    ('volume.', resources.VOLUMES),
+    ('image.', resources.IMAGES),
+)
+DELETES = ('delete.end', 'delete')
+
+
+def _metadata(metadata):
+    """Cinder sends metadata as a list of key/value items, others a dict"""
+    if isinstance(metadata, list):
+        return dict((item['key'], item['value']) for item in metadata)
+    return dict(metadata or {})
+
+
+def _name(name):
+    return name or ''
+
+
+def _upper(state):
+    return (state or '').upper() or None
+
+
+def _or_none(value):
+    return value or None
+
+
+def _power_state(power_state):
+    """Versioned payloads name the power state, the API numbers it"""
+    return POWER_STATES.get(power_state, power_state)
+
+
+POWER_STATES = {
+    'pending': 0,
+    'running': 1,
+    'paused': 3,
+    'shutdown': 4,
+    'crashed': 6,
+    'suspended': 7,
+}
+
+# Record fields, the payload keys they are read from, the first present
+# wins, and how their values are converted.
+INSTANCE_FIELDS = (
+    ('id', ('instance_id', 'uuid'), None),
+    ('name', ('display_name',), _name),
+    ('project_id', ('tenant_id',), None),
+    ('status', ('state',), _upper),
+    ('updated', ('updated_at',), None),
+    ('metadata', ('metadata',), _metadata),
+    ('availability_zone', ('availability_zone',), None),
+    # Legacy payloads carry the task state as state_description.
+    ('task_state', ('task_state', 'state_description'), _or_none),
+    ('power_state', ('power_state',), _power_state),
+)
+
+VOLUME_FIELDS = (
+    ('id', ('volume_id',), None),
+    ('name', ('display_name',), _name),
+    ('project_id', ('tenant_id',), None),
+    ('status', ('status',), None),
+    ('updated', ('updated_at',), None),
+    ('metadata', ('metadata',), _metadata),
+    ('availability_zone', ('availability_zone',), None),
+)
+
+IMAGE_FIELDS = (
+    ('id', ('id',), None),
+    ('name', ('name',), _name),
+    ('project_id', ('owner',), None),
+    ('status', ('status',), None),
+    ('updated', ('updated_at',), None),
+    ('metadata', ('properties',), _metadata),
+    ('protected', ('protected',), None),
+    ('container_format', ('container_format',), None),
+    ('visibility', ('visibility',), None),
+)
+
+
+def _fields(payload, spec):
+    """
+    The record fields of payload, those it does not carry are left out so
+    the stored row keeps them
+    """
+    fields = {}
+    for attr, keys, convert in spec:
+        for key in keys:
+            if key in payload:
+                value = payload[key]
+                fields[attr] = convert(value) if convert else value
+                break
+    return fields
+
+
+def _instance(payload):
+    # Versioned notifications wrap the payload in an object.
+    return _fields(payload.get('nova_object.data', payload), INSTANCE_FIELDS)
+
+
+def _volume(payload):
+    return _fields(payload, VOLUME_FIELDS)
+
+
+def _image(payload):
+    fields = _fields(payload, IMAGE_FIELDS)
+    if 'visibility' not in fields and 'is_public' in payload:
+        fields['visibility'] = records.get_visibility(None,
+                                                      payload['is_public'])
+    return fields
+
+
+RECORDS = {
+    resources.INSTANCES: _instance,
+    resources.VOLUMES: _volume,
+    resources.IMAGES: _image,
+}
+
+
+def parse(event_type, payload):
+    """
+    The Change an event makes, None for events about anything else or
+    about a step that changes nothing shown (*.start)
+    """
+    for prefix, resource_type in PREFIXES:
+        if event_type.startswith(prefix):
+            break
+    else:
+        return None
+    if event_type.endswith('.start') or not isinstance(payload, dict):
+        return None
+    fields = RECORDS[resource_type](payload)
+    resource_id = fields.pop('id', None)
+    if not resource_id:
+        return None
+    if (event_type.endswith(DELETES) or payload.get('deleted') is True or
+            fields.get('status') in ('DELETED', 'deleted')):
+        return Change(resource_type, resource_id, None)
+    return Change(resource_type, resource_id, fields)
+
+
+class MemoryTransport(object):
+    """
+    Delivers what is published to the handler, once started, in the
+    publishing thread
+    """
+    def __init__(self):
+        self._handler = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def publish(self, event_type, payload):
+        with self._lock:
+            if self._handler is None:
+                self._pending.append((event_type, payload))
+                return
+            handler = self._handler
+        handler(event_type, payload)
+
+    def start(self, handler):
+        with self._lock:
+            self._handler = handler
+            pending, self._pending = self._pending, []
+        for event_type, payload in pending:
+            handler(event_type, payload)
+
+    def stop(self):
+        with self._lock:
+            self._handler = None
+
+
+class _Endpoint(object):
+    def __init__(self, handler):
+        self.handler = handler
+
+    def info(self, ctxt, publisher_id, event_type, payload, metadata):
+        self.handler(event_type, payload)
+
+
+class OsloTransport(object):
+    """
+    Listens to METAFINDER_NOTIFICATION_TOPICS on the bus at
+    METAFINDER_NOTIFICATION_URL with oslo.messaging, which is only needed
+    for this transport
+
+    The listener has a pool of its own, METAFINDER_NOTIFICATION_POOL, so it
+    gets a copy of each notification instead of taking them from other
+    consumers such as Ceilometer.
+    """
+    def __init__(self):
+        from oslo_config import cfg
+        import oslo_messaging
+        self._messaging = oslo_messaging
+        self._transport = oslo_messaging.get_notification_transport(
+            cfg.CONF, url=getattr(settings, 'METAFINDER_NOTIFICATION_URL',
+                                  None))
+        self._listener = None
+
+    def start(self, handler):
+        topics = getattr(settings, 'METAFINDER_NOTIFICATION_TOPICS',
+                         DEFAULT_TOPICS)
+        self._listener = self._messaging.get_notification_listener(
+            self._transport,
+            [self._messaging.Target(topic=topic) for topic in topics],
+            [_Endpoint(handler)],
+            executor='threading',
+            pool=getattr(settings, 'METAFINDER_NOTIFICATION_POOL',
+                         DEFAULT_POOL))
+        self._listener.start()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener.wait()
+            self._listener = None
+
+
+TRANSPORTS = {
+    'memory': MemoryTransport,
+    'oslo': OsloTransport,
+}
+
+
+def get_transport():
+    name = getattr(settings, 'METAFINDER_NOTIFICATION_TRANSPORT', 'oslo')
+    return (TRANSPORTS.get(name) or import_string(name))()
+
+
+class Listener(object):
+    """
+    Applies the notifications of a transport to the rows of region in a
+    snapshot store
+
+    The bus of a region only carries that region's notifications. Each
+    reconcile sets region to the region its crawl logged in to. applied
+    counts the changes applied since the listener was made.
+    """
+    def __init__(self, store, transport, region=None):
+        self.store = store
+        self.transport = transport
+        self.region = region
+        self.applied = 0
+        self._replay = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.transport.start(self.handle)
+
+    def stop(self):
+        self.transport.stop()
+
+    def handle(self, event_type, payload):
+        try:
+            change = parse(event_type, payload)
+        except Exception:
+            LOG.exception("Unable to parse a %s notification", event_type)
+            return
+        if change is None:
+            return
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(change)
+        self.apply(change)
+
+    def apply(self, change):
+        if change.fields is None:
+            self.store.delete(change.resource_type, self.region,
+                              [change.resource_id])
+        else:
+            self.store.update(change.resource_type, self.region,
+                              change.resource_id, change.fields)
+        with self._lock:
+            self.applied += 1
+
+    def reconcile(self, request, resource_type):
+        """
+        Crawls resource_type into the store, then applies again the changes
+        that arrived during the crawl, which its listing may predate
+
+        Returns the number of rows crawled.
+        """
+        with self._lock:
+            self.region = request.user.services_region
+            self._replay = []
+        try:
+            count = crawler.crawl(request, self.store, resource_type)
+        finally:
+            with self._lock:
+                replay, self._replay = self._replay, None
+        for change in replay:
+            if change.resource_type == resource_type:
+                self.apply(change)
+        return count
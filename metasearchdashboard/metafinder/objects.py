@@ -0,0 +1,153 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Search of Swift objects by their x-object-meta-* metadata
+
+Object metadata is only returned by a HEAD on each object, so candidates
+are taken from the container listings page by page and HEADed in batches
+on the bounded worker pool. Matches are yielded as each batch completes,
+and only one listing page is held at a time.
+
+Two terms of a query narrow the candidates instead of matching metadata:
+"container:<name>" searches only the named containers, "prefix:<p>" only
+objects whose name starts with p. A search stops once it has HEADed
+METAFINDER_OBJECT_SCAN_LIMIT objects, narrow it to search further.
+"""
+
+import itertools
+import logging
+
+from django.conf import settings
+
+from openstack_dashboard import api
+
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import swift_helpers
+from metasearchdashboard.metafinder.api import workers
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_HEAD_BATCH = 50
+DEFAULT_SCAN_LIMIT = 10000
+
+CONTAINER_TERM = 'container:'
+PREFIX_TERM = 'prefix:'
+
+
+def narrow(predicates):
+    """
+    Splits container: and prefix: terms off the predicates
+
+    Returns (container names or None for all, prefix or None, predicates).
+    """
+    containers = []
+    prefix = None
+    rest = []
+    for predicate in predicates:
+        key = predicate.key or ''
+        if predicate.op == query.EXISTS and key.startswith(CONTAINER_TERM):
+            containers.append(key[len(CONTAINER_TERM):])
+        elif predicate.op == query.EXISTS and key.startswith(PREFIX_TERM):
+            prefix = key[len(PREFIX_TERM):]
+        else:
+            rest.append(predicate)
+    return sorted(containers) or None, prefix, rest
+
+
+def split_marker(marker):
+    """Object markers are "container/object", container names have no /"""
+    if not marker:
+        return None, None
+    container_name, _sep, object_name = marker.partition('/')
+    return container_name, object_name or None
+
+
+def _container_names(request, containers, start):
+    if containers is None:
+        containers = (c.name for c in resources.iter_pages(
+            resources.CONTAINERS,
+            lambda marker: api.swift.swift_get_containers(
+                request, marker=marker)))
+    for name in containers:
+        if start is None or name >= start:
+            yield name
+
+
+def _candidate_batches(request, containers, prefix, marker):
+    """Yields (container, object names) batches in listing order"""
+    start, object_marker = split_marker(marker)
+    batch_size = getattr(settings, 'METAFINDER_OBJECT_HEAD_BATCH',
+                         DEFAULT_HEAD_BATCH)
+    for container_name in _container_names(request, containers, start):
+        listing_marker = object_marker if container_name == start else None
+        while True:
+            names, has_more = swift_helpers.swift_list_objects(
+                request, container_name, marker=listing_marker,
+                prefix=prefix)
+            for i in range(0, len(names), batch_size):
+                yield container_name, names[i:i + batch_size]
+            if not has_more or not names:
+                break
+            listing_marker = names[-1]
+
+
+def search(request, predicates, marker=None):
+    """
+    Yields the objects whose metadata matches the predicates, in listing
+    order, starting after the object marker ("container/object")
+
+    Objects whose HEAD fails are skipped. At most
+    METAFINDER_OBJECT_SCAN_LIMIT objects are HEADed, 0 for no limit.
+    """
+    containers, prefix, predicates = narrow(predicates)
+    test = query.compile_all(predicates)
+    scan_limit = getattr(settings, 'METAFINDER_OBJECT_SCAN_LIMIT',
+                         DEFAULT_SCAN_LIMIT)
+    scanned = 0
+    for container_name, names in _candidate_batches(request, containers,
+                                                    prefix, marker):
+        if scan_limit:
+            if scanned >= scan_limit:
+                LOG.warning("Object search stopped after %d objects",
+                            scanned)
+                return
+            names = names[:scan_limit - scanned]
+        scanned += len(names)
+        found = workers.bounded_map(
+            lambda name: swift_helpers.swift_get_object_with_metadata(
+                request, container_name, name),
+            names,
+            lambda name, e: None)
+        for obj in found:
+            if obj is not None and test(obj.metadata):
+                yield obj
+
+
+def list_objects(request, marker=None, filters=None, limit=None):
+    """
+    Lister of the Objects tab, filters are the parsed query predicates
+
+    Without any predicate nothing is listed, HEADing every object of the
+    account just to show a page is not worth it.
+    """
+    if not filters:
+        return [], False, False
+    found = list(itertools.islice(
+        search(request, filters, marker),
+        limit + 1 if limit is not None else None))
+    has_more = limit is not None and len(found) > limit
+    return found[:limit], has_more, marker is not None
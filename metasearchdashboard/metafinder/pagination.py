@@ -0,0 +1,233 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Marker pagination shared by the metafinder tabs
+
+Every service pages forward from the id (the name for containers) of the
+last resource seen, so markers stay valid while resources come and go.
+Not all of them can page backwards though, so each page records which
+marker produced it: the "previous" link of a table carries the first id of
+the page shown, which leads back to the marker of the page before it.
+
+Pages are cached as compact records. Once a page is served the next one
+is fetched in the background into the page cache, so following "Next"
+does not wait on the service. Fetches run within the deadline and circuit
+breaker of the service; when it is unavailable the last good copy of the
+page is served, marked stale.
+"""
+
+import copy
+import logging
+import threading
+
+from concurrent import futures
+
+from django.conf import settings
+from horizon.utils import functions as utils
+
+from metasearchdashboard.metafinder import breaker
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import metrics
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import workers
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PREFETCH_WORKERS = 2
+DEFAULT_TRAIL_TTL = 3600
+
+_executor = None
+_executor_lock = threading.Lock()
+_prefetching = set()
+
+
+def get_page_size(request):
+    """
+    METAFINDER_PAGE_SIZE, or the page size the user picked in Horizon
+
+    Nova, Cinder and Glance pages are sized by Horizon's API wrappers from
+    the user's setting. Only container and object pages, which the panel
+    cuts out of listings itself, follow METAFINDER_PAGE_SIZE.
+    """
+    return (getattr(settings, 'METAFINDER_PAGE_SIZE', None) or
+            utils.get_page_size(request))
+
+
+def slice_page(resource_type, items, marker=None, prev_marker=None,
+               limit=20):
+    """
+    Returns (items, has_more, has_prev) of the page of an ordered list of
+    every match after marker, or before prev_marker, the way page() pages
+
+    A marker that is no longer in the list starts over from the first page.
+    """
+    ids = [resources.get_resource_id(resource_type, item) for item in items]
+    if prev_marker and prev_marker in ids:
+        end = ids.index(prev_marker)
+        start = max(end - limit, 0)
+    else:
+        start = ids.index(marker) + 1 if marker in ids else 0
+        end = start + limit
+    return items[start:end], end < len(items), start > 0
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = futures.ThreadPoolExecutor(
+                max_workers=getattr(settings, 'METAFINDER_PREFETCH_WORKERS',
+                                    DEFAULT_PREFETCH_WORKERS))
+        return _executor
+
+
+class Paginator(object):
+    """
+    Pages through one resource type for a request
+
+    filter_string is part of the cache key of every page, filters are the
+    native filters it was pushed down to. lister replaces the one
+    resources.LISTERS has for the type, budget is the breaker.Budget the
+    fetches must fit in.
+
+    After page(), stale tells whether the page is a last good copy served
+    in place of an unavailable service, partial whether some of its rows
+    were only partly looked up.
+    """
+    def __init__(self, request, resource_type, filter_string='',
+                 filters=None, lister=None, budget=None):
+        self.request = request
+        self.resource_type = resource_type
+        self.filter_string = filter_string
+        self.filters = filters
+        self.lister = lister or resources.LISTERS[resource_type]
+        self.budget = budget
+        self.stale = False
+        self.partial = False
+
+    def page(self, marker=None, prev_marker=None):
+        """
+        Returns (items, has_more, has_prev) of the page after marker, or of
+        the page before the one starting with prev_marker
+        """
+        if prev_marker:
+            marker = self._previous_marker(prev_marker)
+        try:
+            items, has_more = self._load(marker)
+        except breaker.Unavailable:
+            stale = cache.get_stale(self.request, self.resource_type, marker,
+                                    self.filter_string)
+            if stale is None:
+                raise
+            items, has_more = stale
+            self.stale = True
+            return items, has_more, marker is not None
+        if items:
+            self._remember(marker, items)
+        if has_more and items and self._prefetch_enabled():
+            self._prefetch(self._id(items[-1]))
+        return items, has_more, marker is not None
+
+    def _id(self, item):
+        return resources.get_resource_id(self.resource_type, item)
+
+    def _fetch(self, marker):
+        return breaker.call(self.request,
+                            resources.SERVICES[self.resource_type],
+                            lambda: self._fetch_page(marker), self.budget)
+
+    def _fetch_page(self, marker):
+        kwargs = {}
+        if self.resource_type in (resources.CONTAINERS, resources.OBJECTS):
+            kwargs['limit'] = get_page_size(self.request)
+        with metrics.timed(self.request,
+                           resources.SERVICES[self.resource_type],
+                           self.resource_type) as timer:
+            items, has_more, has_prev = self.lister(
+                self.request, marker=marker, filters=self.filters, **kwargs)
+            timer.items = len(items)
+        if any(getattr(item, 'partial', False) for item in items):
+            self.partial = True
+        if self.resource_type in resources.RESOURCE_TYPES:
+            items = records.compact_all(self.request, self.resource_type,
+                                        items)
+        return items, has_more
+
+    def _load(self, marker):
+        return cache.get_or_fetch(self.request, self.resource_type, marker,
+                                  self.filter_string,
+                                  lambda: self._fetch(marker))
+
+    def _trail_key(self, edge, resource_id):
+        return cache.make_key(self.request, self.resource_type,
+                              (edge, resource_id), self.filter_string)
+
+    def _remember(self, marker, items):
+        """Records the marker a page was loaded with by its first, last id"""
+        backend = cache.get_backend()
+        ttl = getattr(settings, 'METAFINDER_PAGINATION_TTL',
+                      DEFAULT_TRAIL_TTL)
+        entry = {'marker': marker}
+        backend.set(self._trail_key('first', self._id(items[0])), entry, ttl)
+        backend.set(self._trail_key('last', self._id(items[-1])), entry, ttl)
+
+    def _previous_marker(self, prev_marker):
+        """
+        The page shown started with prev_marker and was loaded after the
+        last id of the page before it, whose own marker is the one wanted.
+        Without a record of those pages we go back to the first one.
+        """
+        backend = cache.get_backend()
+        shown = backend.get(self._trail_key('first', prev_marker))
+        if shown is None or shown['marker'] is None:
+            return None
+        before = backend.get(self._trail_key('last', shown['marker']))
+        if before is None:
+            return None
+        return before['marker']
+
+    def _prefetch_enabled(self):
+        return getattr(settings, 'METAFINDER_PREFETCH', True)
+
+    def _prefetch(self, marker):
+        key = cache.make_key(self.request, self.resource_type, marker,
+                             self.filter_string)
+        with _executor_lock:
+            if key in _prefetching:
+                return
+            _prefetching.add(key)
+        if cache.get_backend().get(key) is not None:
+            _prefetching.discard(key)
+            return
+        # The prefetch goes on after the response, away from the request.
+        prefetcher = copy.copy(self)
+        prefetcher.request = workers.DetachedRequest(self.request)
+        try:
+            _get_executor().submit(prefetcher._prefetch_page, key, marker)
+        except RuntimeError:
+            _prefetching.discard(key)
+
+    def _prefetch_page(self, key, marker):
+        try:
+            items, has_more = self._load(marker)
+            if items:
+                self._remember(marker, items)
+        except Exception as e:
+            LOG.debug("Prefetch of %s after %s failed: %r",
+                      self.resource_type, marker, e)
+        finally:
+            _prefetching.discard(key)
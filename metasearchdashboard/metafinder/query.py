@@ -0,0 +1,555 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import operator
+import re
+
+import six
+
+from django.conf import settings
+
+from metasearchdashboard.metafinder.api import resources
+
+
+EQ = '='
+NE = '!='
+CONTAINS = '~'
+PREFIX = '^='
+REGEX = '=~'
+FUZZY = '%'
+LT = '<'
+LE = '<='
+GT = '>'
+GE = '>='
+IN = 'in'
+EXISTS = 'exists'
+# Operators of compound predicates, whose value is a tuple of predicates.
+AND = 'and'
+OR = 'or'
+NOT = 'not'
+
+NUMERIC = (LT, LE, GT, GE)
+
+# Operators the n-gram index answers.
+PATTERNS = (CONTAINS, PREFIX, FUZZY)
+
+# Key of terms matching any key, e.g. "*~build-42".
+ANY_KEY = '*'
+
+# Compound predicates have no key.
+Predicate = collections.namedtuple('Predicate', ['key', 'op', 'value'])
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<open>\() |
+        (?P<close>\)) |
+        (?P<comma>,) |
+        "(?P<string>(?:[^"\\]|\\.)*)" |
+        (?P<op>!=|=~|\^=|<=|>=|=|~|<|>) |
+        (?P<word>(?:[^\s()",=!~<>^]|\^(?!=))+)
+    )""", re.VERBOSE)
+
+_KEYWORDS = ('AND', 'OR', 'NOT', 'IN')
+
+_BARE_WORD = re.compile(r'(?:[^\s()",=!~<>^%]|\^(?!=))+$')
+
+DEFAULT_COMPILED_CACHE_SIZE = 256
+DEFAULT_REGEX_MAX_LENGTH = 100
+
+# Quantifiers repeating without a small bound.
+_REPEATS = ('*', '+', '{')
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _tokenize(filter_string):
+    tokens = []
+    position = 0
+    filter_string = filter_string.rstrip()
+    while position < len(filter_string):
+        match = _TOKEN.match(filter_string, position)
+        if match is None or match.end() == position:
+            raise QueryError('Unexpected "%s"' % filter_string[position:])
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value)
+        elif kind == 'word' and value.upper() in _KEYWORDS:
+            kind = value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+
+class _Parser(object):
+    """
+    Recursive descent over the grammar:
+
+    or    := and ("OR" and)*
+    and   := not (["AND" | ","] not)*
+    not   := "NOT" not | "(" or ")" | term
+    term  := "has:"key | key | key op value | key "IN" "(" values ")"
+
+    "%" is only an operator right after a key, values such as "50%" keep
+    it.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def take(self, *kinds):
+        kind, value = self.tokens[self.position]
+        if kinds and kind not in kinds:
+            raise QueryError('Expected %s, got "%s"' %
+                             (' or '.join(kinds), value))
+        self.position += 1
+        return value
+
+    def expect(self, *kinds):
+        if self.peek() is None:
+            raise QueryError('Expected %s at the end' % ' or '.join(kinds))
+        return self.take(*kinds)
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.take()
+            nodes.append(self.parse_and())
+        if len(nodes) == 1:
+            return nodes[0]
+        return Predicate(None, OR, tuple(nodes))
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek() not in (None, 'OR', 'close'):
+            if self.peek() in ('AND', 'comma'):
+                self.take()
+            nodes.append(self.parse_not())
+        if len(nodes) == 1:
+            return nodes[0]
+        return Predicate(None, AND, tuple(nodes))
+
+    def parse_not(self):
+        kind = self.peek()
+        if kind == 'NOT':
+            self.take()
+            return Predicate(None, NOT, (self.parse_not(),))
+        if kind == 'open':
+            self.take()
+            node = self.parse_or()
+            self.expect('close')
+            return node
+        return self.parse_term()
+
+    def parse_fuzzy(self, key, value):
+        if not key:
+            raise QueryError('Expected a key before "%s", quote values '
+                             'starting with it' % FUZZY)
+        if not value and self.peek() in ('word', 'string'):
+            value = self.take()
+        return Predicate(key, FUZZY, value)
+
+    def parse_term(self):
+        kind = self.peek()
+        key = self.expect('word', 'string')
+        if kind == 'word' and FUZZY in key:
+            return self.parse_fuzzy(*key.split(FUZZY, 1))
+        if (self.peek() == 'word' and
+                self.tokens[self.position][1].startswith(FUZZY)):
+            return self.parse_fuzzy(key, self.take()[1:])
+        if self.peek() == 'IN':
+            self.take()
+            self.expect('open')
+            values = [self.expect('word', 'string')]
+            while self.peek() == 'comma':
+                self.take()
+                values.append(self.expect('word', 'string'))
+            self.expect('close')
+            return Predicate(key, IN, frozenset(values))
+        if self.peek() != 'op':
+            if key.startswith('has:') and len(key) > 4:
+                key = key[4:]
+            return Predicate(key, EXISTS, None)
+        op = self.take()
+        value = ''
+        if self.peek() in ('word', 'string'):
+            value = self.take()
+        if op in NUMERIC:
+            try:
+                value = float(value)
+            except ValueError:
+                raise QueryError('%s needs a number, got "%s"' % (op, value))
+        elif op == REGEX:
+            _check_regex(value)
+        return Predicate(key, op, value)
+
+
+def _check_regex(value):
+    """
+    Refuses regular expressions that could take exponential time on a
+    metadata value: those longer than METAFINDER_REGEX_MAX_LENGTH and those
+    repeating a group that repeats itself, e.g. "(a+)+"
+    """
+    max_length = getattr(settings, 'METAFINDER_REGEX_MAX_LENGTH',
+                         DEFAULT_REGEX_MAX_LENGTH)
+    if len(value) > max_length:
+        raise QueryError('Regular expressions are limited to %d characters'
+                         % max_length)
+    try:
+        re.compile(value)
+    except re.error as e:
+        raise QueryError('Invalid regular expression "%s": %s' % (value, e))
+    # Whether each open group repeats something, the pattern compiled so
+    # escapes, classes and groups are well formed.
+    groups = [False]
+    position = 0
+    while position < len(value):
+        char = value[position]
+        if char == '\\':
+            position += 1
+        elif char == '[':
+            # A "]" first in the class is one of its characters.
+            if value[position + 1] == '^':
+                position += 1
+            position = value.index(']', position + 2)
+        elif char == '(':
+            groups.append(False)
+        elif char == ')':
+            repeats = groups.pop()
+            if repeats and value[position + 1:position + 2] in _REPEATS:
+                raise QueryError('Nested repetition in "%s" is not allowed'
+                                 % value)
+            groups[-1] = groups[-1] or repeats
+        elif char in _REPEATS:
+            groups[-1] = True
+        position += 1
+
+
+def parse(filter_string):
+    """
+    Parses a filter string into a list of predicates that must all match
+
+    Terms are "key=value", "key!=value", "key~substring", "key^=prefix",
+    "key=~regex", "key%value" for values a typo or two away (ignoring
+    case), numeric "key<n" (also <=, >, >=), "key IN (a,b)", and "key" or
+    "has:key" for a key that is present. The key "*" matches any key.
+    Terms are combined with AND (also implied by whitespace or commas), OR,
+    NOT and parentheses, in any case. Keys and values with spaces or special
+    characters, or spelled like a keyword, can be double quoted; "%" is
+    only special right after a key, so "discount=50%" needs no quotes.
+    Regular expressions are bounded, see _check_regex.
+
+    Ex:
+    'env=prod AND tier IN (web,api) AND NOT has:deprecated' ->
+        [Predicate("env", "=", "prod"),
+         Predicate("tier", "in", frozenset(["web", "api"])),
+         Predicate(None, "not", (Predicate("deprecated", "exists", None),))]
+
+    Raises QueryError when the string does not parse.
+    """
+    tokens = _tokenize(filter_string or '')
+    if not tokens:
+        return []
+    parser = _Parser(tokens)
+    node = parser.parse_or()
+    if parser.peek() is not None:
+        raise QueryError('Unexpected "%s"' % parser.take())
+    if node.op == AND:
+        return list(node.value)
+    return [node]
+
+
+def quote(text):
+    """Returns text as one word of a query, quoted when it has to be"""
+    if _BARE_WORD.match(text) and text.upper() not in _KEYWORDS:
+        return text
+    return '"%s"' % re.sub(r'(["\\])', r'\\\1', text)
+
+
+def and_term(filter_string, key, value):
+    """Narrows a filter string down to the resources where key is value"""
+    term = '%s=%s' % (quote(key), quote(value))
+    filter_string = (filter_string or '').strip()
+    if not filter_string:
+        return term
+    return '(%s) AND %s' % (filter_string, term)
+
+
+def to_text(value):
+    if isinstance(value, six.text_type):
+        return value
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8', 'replace')
+    return six.text_type(value)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def fuzzy_distance(value):
+    """How many edits a FUZZY term tolerates, by the length of its value"""
+    if len(value) < 3:
+        return 0
+    if len(value) < 6:
+        return 1
+    return 2
+
+
+def _levenshtein(pattern):
+    """
+    A function of text returning its edit distance to pattern, computed a
+    column of bits at a time (Myers, Hyyro) in one pass over text
+    """
+    if not pattern:
+        return len
+    masks = {}
+    for i, char in enumerate(pattern):
+        masks[char] = masks.get(char, 0) | (1 << i)
+    width = (1 << len(pattern)) - 1
+    last = 1 << (len(pattern) - 1)
+
+    def distance(text):
+        positive, negative, score = width, 0, len(pattern)
+        for char in text:
+            equal = masks.get(char, 0)
+            vertical = equal | negative
+            horizontal = (((equal & positive) + positive) ^ positive) | equal
+            up = negative | (~(horizontal | positive) & width)
+            down = positive & horizontal
+            if up & last:
+                score += 1
+            elif down & last:
+                score -= 1
+            up = ((up << 1) | 1) & width
+            down = (down << 1) & width
+            positive = down | (~(vertical | up) & width)
+            negative = up & vertical
+        return score
+    return distance
+
+
+def edit_distance(a, b, limit):
+    """
+    Levenshtein distance between a and b, or limit + 1 when it is larger
+    than limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    return min(_levenshtein(a)(b), limit + 1)
+
+
+def value_test(op, value):
+    """A function of one metadata value, as text, for a term's operator"""
+    if op in NUMERIC:
+        compare = {
+            LT: operator.lt,
+            LE: operator.le,
+            GT: operator.gt,
+            GE: operator.ge,
+        }[op]
+
+        def test(text):
+            number = _number(text)
+            return number is not None and compare(number, value)
+    elif op == EQ:
+        def test(text):
+            return text == value
+    elif op == NE:
+        def test(text):
+            return text != value
+    elif op == CONTAINS:
+        def test(text):
+            return value in text
+    elif op == PREFIX:
+        def test(text):
+            return text.startswith(value)
+    elif op == FUZZY:
+        distance = _levenshtein(value.lower())
+        limit = fuzzy_distance(value)
+
+        def test(text):
+            return (abs(len(text) - len(value)) <= limit and
+                    distance(text.lower()) <= limit)
+    elif op == REGEX:
+        search = re.compile(value).search
+
+        def test(text):
+            return search(text) is not None
+    elif op == IN:
+        test = value.__contains__
+    else:
+        raise QueryError('Unknown operator "%s"' % op)
+    return test
+
+
+def _compile_term(predicate):
+    key, op, value = predicate
+    if key == ANY_KEY:
+        if op == EXISTS:
+            return bool
+        test = value_test(op, value)
+        if op == NE:
+            return lambda metadata: all(test(to_text(v))
+                                        for v in metadata.values())
+        return lambda metadata: any(test(to_text(v))
+                                    for v in metadata.values())
+    if op == EXISTS:
+        return lambda metadata: key in metadata
+    test = value_test(op, value)
+    if op == NE:
+        return lambda metadata: (key not in metadata or
+                                 test(to_text(metadata[key])))
+
+    def match(metadata):
+        if key not in metadata:
+            return False
+        return test(to_text(metadata[key]))
+    return match
+
+
+def compile_predicate(predicate):
+    """Turns a predicate into a function of a metadata dict"""
+    if predicate.op == AND:
+        return compile_all(predicate.value)
+    if predicate.op == OR:
+        tests = [compile_predicate(p) for p in predicate.value]
+        return lambda metadata: any(test(metadata) for test in tests)
+    if predicate.op == NOT:
+        test = compile_predicate(predicate.value[0])
+        return lambda metadata: not test(metadata)
+    return _compile_term(predicate)
+
+
+def compile_all(predicates):
+    """A function of a metadata dict matching when all predicates do"""
+    tests = [compile_predicate(p) for p in predicates]
+    if len(tests) == 1:
+        return tests[0]
+    return lambda metadata: all(test(metadata) for test in tests)
+
+
+_compiled = {}
+
+
+def _get_compiled(predicates):
+    key = tuple(predicates)
+    test = _compiled.get(key)
+    if test is None:
+        if len(_compiled) >= getattr(settings,
+                                     'METAFINDER_COMPILED_QUERY_CACHE_SIZE',
+                                     DEFAULT_COMPILED_CACHE_SIZE):
+            _compiled.clear()
+        test = _compiled[key] = compile_all(predicates)
+    return test
+
+
+def matches(metadata, predicates):
+    """
+    Evaluates predicates locally against a raw metadata dict
+
+    Predicates are compiled once per query, so filtering many rows only
+    pays for the comparisons themselves.
+    """
+    if not predicates:
+        return True
+    return _get_compiled(predicates)(metadata or {})
+
+
+def select(resource_type, items, predicates):
+    """Yields the resources whose metadata matches all predicates"""
+    test = compile_all(predicates)
+    for item in items:
+        if test(resources.get_metadata(resource_type, item)):
+            yield item
+
+
+def named_keys(predicates):
+    """The metadata keys predicates name, sorted, "*" left out"""
+    keys = set()
+    for predicate in predicates:
+        if predicate.op in (AND, OR, NOT):
+            keys.update(named_keys(predicate.value))
+        elif predicate.key != ANY_KEY:
+            keys.add(predicate.key)
+    return sorted(keys)
+
+
+def is_equality(predicate):
+    """Whether a predicate is a plain key=value term"""
+    return predicate.op == EQ and predicate.key != ANY_KEY
+
+
+def _equalities(predicates):
+    return dict((p.key, p.value) for p in predicates if is_equality(p))
+
+
+def _volume_filters(predicates):
+    """Cinder matches every pair of its metadata search option"""
+    pairs = _equalities(predicates)
+    if not pairs:
+        return {}
+    return {'metadata': pairs}
+
+
+def _image_filters(predicates):
+    """
+    Glance v2 filters on custom properties directly, v1 needs them under
+    'properties' so the client sends them as property-<key>.
+    """
+    pairs = _equalities(predicates)
+    if not pairs:
+        return {}
+    versions = getattr(settings, 'OPENSTACK_API_VERSIONS', {})
+    if float(versions.get('image', 1)) >= 2:
+        return pairs
+    return {'properties': pairs}
+
+
+PUSH_DOWN = {
+    resources.VOLUMES: _volume_filters,
+    resources.IMAGES: _image_filters,
+}
+
+
+def push_down(resource_type, predicates):
+    """
+    Splits predicates into native filters for the service and the residual
+    predicates that still have to be matched locally
+
+    Returns (filters, residual); filters is None when nothing can be pushed.
+    """
+    translate = PUSH_DOWN.get(resource_type)
+    if translate is None:
+        return None, list(predicates)
+    filters = translate(predicates) or None
+    residual = [p for p in predicates
+                if filters is None or not is_equality(p)]
+    # A key repeated with different values cannot be expressed as a dict.
+    pushed = _equalities(predicates)
+    residual.extend(p for p in predicates
+                    if is_equality(p) and filters and
+                    pushed[p.key] != p.value)
+    return filters, residual
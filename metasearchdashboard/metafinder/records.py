@@ -0,0 +1,234 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Compact records of the resources the panel caches, indexes and renders
+
+The API wrappers keep every field the services return, plus the client
+objects behind them. A Record keeps only what the tables and their row
+actions read, in __slots__, and shares metadata key strings between
+records, so a cached page or a project's index costs a fraction of it.
+"""
+
+import collections
+import logging
+
+from django.conf import settings
+
+from openstack_dashboard import api
+
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import workers
+
+
+LOG = logging.getLogger(__name__)
+
+# Keys are shared through this dict rather than intern(), which only takes
+# byte strings on Python 2. Past the limit new keys are no longer shared.
+MAX_INTERNED_KEYS = 100000
+
+_keys = {}
+
+DEFAULT_IMAGE_NAME_TTL = 600
+
+# Names of the images instances were booted from, by region, project and
+# image id.
+_image_names = cache.MemoryBackend()
+
+# Where each type keeps the id of the project owning it.
+PROJECT_ATTRS = {
+    resources.INSTANCES: 'tenant_id',
+    resources.VOLUMES: 'os-vol-tenant-attr:tenant_id',
+    resources.IMAGES: 'owner',
+    resources.CONTAINERS: None,
+}
+
+
+def intern_key(key):
+    shared = _keys.get(key)
+    if shared is not None:
+        return shared
+    if len(_keys) < MAX_INTERNED_KEYS:
+        return _keys.setdefault(key, key)
+    return key
+
+
+class Record(object):
+    """
+    A resource as the tables render it
+
+    The names the API wrappers use for the same fields are aliases, e.g.
+    an image's properties are its metadata and its owner its project_id.
+    """
+    __slots__ = ('resource_type', 'id', 'name', 'project_id', 'status',
+                 'updated', 'metadata', 'availability_zone', 'image_name',
+                 'task_state', 'addresses', 'key_name', 'locked',
+                 'protected', 'container_format', 'visibility', 'bootable',
+                 'power_state', 'transfer')
+
+    ALIASES = {
+        'tenant_id': 'project_id',
+        'owner': 'project_id',
+        'properties': 'metadata',
+        'updated_at': 'updated',
+        'os-vol-tenant-attr:tenant_id': 'project_id',
+        'OS-EXT-AZ:availability_zone': 'availability_zone',
+        'OS-EXT-STS:task_state': 'task_state',
+        'OS-EXT-STS:power_state': 'power_state',
+    }
+
+    def __init__(self, resource_type, id, name, project_id=None,
+                 status=None, updated=None, metadata=None, **fields):
+        self.resource_type = resource_type
+        self.id = id
+        self.name = name
+        self.project_id = project_id
+        self.status = status
+        self.updated = updated
+        self.metadata = dict((intern_key(k), v)
+                             for k, v in (metadata or {}).items())
+        for attr in self.__slots__[7:]:
+            setattr(self, attr, fields.pop(attr, None))
+        if fields:
+            raise TypeError('Unknown record fields: %s' %
+                            ', '.join(sorted(fields)))
+
+    def __getattr__(self, name):
+        alias = Record.ALIASES.get(name)
+        if alias is None:
+            raise AttributeError(name)
+        return getattr(self, alias)
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        # Records pickled before a field was added do not have it.
+        state = tuple(state) + (None,) * (len(self.__slots__) - len(state))
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+
+# The transfer of a volume awaiting one, DeleteTransfer reads its id.
+Transfer = collections.namedtuple('Transfer', ['id', 'name'])
+
+
+def _raw_attr(resource, attr):
+    raw = getattr(resource, '_apiresource', resource)
+    return getattr(raw, attr, None)
+
+
+def _transfer(resource):
+    transfer = _raw_attr(resource, 'transfer')
+    if transfer is None:
+        return None
+    return Transfer(transfer.id, getattr(transfer, 'name', None))
+
+
+def _image_name(resource, image_names):
+    """
+    Server.image_name looks the image up in Glance on every access, so
+    names come from the server's image or image_names instead
+    """
+    if not hasattr(resource, 'image'):
+        return getattr(resource, 'image_name', None)
+    image = resource.image or {}
+    if isinstance(image, dict):
+        return image.get('name') or image_names.get(image.get('id'))
+    return getattr(image, 'name', None)
+
+
+def get_visibility(visibility, is_public):
+    """Glance v1 images only tell whether they are public"""
+    if visibility:
+        return visibility
+    return 'public' if is_public else 'private'
+
+
+def compact(resource_type, resource, image_names=None):
+    """Returns the Record of a resource, records are returned as they are"""
+    if isinstance(resource, Record):
+        return resource
+    project_attr = PROJECT_ATTRS[resource_type]
+    fields = {}
+    if resource_type == resources.INSTANCES:
+        fields = {
+            'availability_zone': _raw_attr(resource,
+                                           'OS-EXT-AZ:availability_zone'),
+            'image_name': _image_name(resource, image_names or {}),
+            'task_state': _raw_attr(resource, 'OS-EXT-STS:task_state'),
+            'power_state': _raw_attr(resource, 'OS-EXT-STS:power_state'),
+            'addresses': _raw_attr(resource, 'addresses'),
+            'key_name': _raw_attr(resource, 'key_name'),
+            'locked': _raw_attr(resource, 'locked'),
+        }
+    elif resource_type == resources.VOLUMES:
+        fields = {
+            'availability_zone': _raw_attr(resource, 'availability_zone'),
+            'bootable': _raw_attr(resource, 'bootable'),
+            'transfer': _transfer(resource),
+        }
+    elif resource_type == resources.IMAGES:
+        fields = {
+            'protected': _raw_attr(resource, 'protected'),
+            'container_format': _raw_attr(resource, 'container_format'),
+            'visibility': get_visibility(_raw_attr(resource, 'visibility'),
+                                         _raw_attr(resource, 'is_public')),
+        }
+    return Record(
+        resource_type,
+        resources.get_resource_id(resource_type, resource),
+        resource.name,
+        _raw_attr(resource, project_attr) if project_attr else None,
+        _raw_attr(resource, 'status'),
+        (_raw_attr(resource, 'updated') or
+         _raw_attr(resource, 'updated_at')),
+        resources.get_metadata(resource_type, resource),
+        **fields)
+
+
+def _get_image_name(request, image_id):
+    key = (request.user.services_region, request.user.tenant_id, image_id)
+    name = _image_names.get(key)
+    if name is None:
+        name = api.glance.image_get(request, image_id).name
+        _image_names.set(key, name, getattr(
+            settings, 'METAFINDER_IMAGE_NAME_TTL', DEFAULT_IMAGE_NAME_TTL))
+    return name
+
+
+def _get_image_names(request, servers):
+    """
+    Names of the images servers were booted from, looked up by id for the
+    images of these servers only and remembered for the next pages
+    """
+    image_ids = sorted(set(
+        s.image['id'] for s in servers
+        if isinstance(getattr(s, 'image', None), dict) and
+        s.image.get('id') and not s.image.get('name')))
+    names = workers.bounded_map(
+        lambda image_id: _get_image_name(request, image_id),
+        image_ids,
+        lambda image_id, e: None)
+    return dict((image_id, name) for image_id, name in zip(image_ids, names)
+                if name is not None)
+
+
+def compact_all(request, resource_type, items):
+    """Returns the Records of a list of resources"""
+    image_names = None
+    if resource_type == resources.INSTANCES:
+        image_names = _get_image_names(request, items)
+    return [compact(resource_type, item, image_names) for item in items]
@@ -0,0 +1,101 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+
+from six.moves import queue
+
+from django.conf import settings
+
+from metasearchdashboard.metafinder import objects
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder.api import resources
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1000
+
+_DONE = object()
+
+
+def iter_matches(request, resource_type, predicates):
+    """
+    Yields the resources of one type matching the predicates, page by page
+
+    Predicates the service supports are pushed down, the rest are matched
+    locally on each page as it arrives. Objects are found by
+    objects.search.
+    """
+    if resource_type == resources.OBJECTS:
+        return objects.search(request, predicates)
+    filters, residual = query.push_down(resource_type, predicates)
+    return query.select(
+        resource_type,
+        resources.iter_resources(request, resource_type, filters=filters),
+        residual)
+
+
+def stream(request, predicates, resource_types=resources.RESOURCE_TYPES):
+    """
+    Yields dicts of matching resources across resource types
+
+    Every resource type is searched on its own thread and results are
+    yielded in the order they arrive. The buffer between the threads and the
+    consumer is bounded, so a slow consumer holds back the backends instead
+    of piling results up in memory. Closing the generator stops the threads.
+    """
+    results = queue.Queue(maxsize=getattr(
+        settings, 'METAFINDER_STREAM_BUFFER_SIZE', DEFAULT_BUFFER_SIZE))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(resource_type):
+        try:
+            for resource in iter_matches(request, resource_type, predicates):
+                if not put(resources.to_dict(resource_type, resource)):
+                    return
+        except Exception as e:
+            LOG.exception("Search of %s failed", resource_type)
+            put({'type': 'error', 'resource_type': resource_type,
+                 'message': str(e)})
+        finally:
+            put(_DONE)
+
+    producers = []
+    for resource_type in resource_types:
+        producer = threading.Thread(target=produce, args=(resource_type,))
+        producer.daemon = True
+        producer.start()
+        producers.append(producer)
+
+    try:
+        remaining = len(producers)
+        while remaining:
+            item = results.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        stop.set()
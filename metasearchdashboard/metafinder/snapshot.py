@@ -0,0 +1,332 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+SQLite store of metadata snapshots written by the metafinder_crawl command
+
+Each crawl replaces every row of a resource type at once, so readers always
+see one complete crawl. Between crawls the metafinder_listen command updates
+and deletes single rows as notifications of their changes arrive. Metadata
+is kept twice: as JSON on the resource to rebuild rows, and as key/value
+rows indexed for searching. The other fields of the records, which the
+row actions read, are kept as JSON too.
+
+A project sees its own rows, public ones (images) and those shared with
+it, which are listed in the members table. Rows and crawls are kept per
+region, the region the crawler logged in to.
+"""
+
+import contextlib
+import json
+import sqlite3
+import time
+
+from django.conf import settings
+
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder.api import resources
+
+
+DEFAULT_MAX_AGE = 900
+
+# Crawls of types listed across every project are recorded under this scope.
+ALL_PROJECTS = '*'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    resource_type TEXT NOT NULL,
+    region TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    project_id TEXT,
+    status TEXT,
+    updated TEXT,
+    metadata TEXT NOT NULL,
+    visibility TEXT,
+    fields TEXT,
+    PRIMARY KEY (resource_type, region, id)
+);
+CREATE INDEX IF NOT EXISTS resources_project
+    ON resources (resource_type, region, project_id, name, id);
+CREATE TABLE IF NOT EXISTS metadata (
+    resource_type TEXT NOT NULL,
+    region TEXT NOT NULL,
+    id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metadata_key_value
+    ON metadata (resource_type, region, key, value);
+CREATE INDEX IF NOT EXISTS metadata_resource
+    ON metadata (resource_type, region, id);
+CREATE TABLE IF NOT EXISTS members (
+    resource_type TEXT NOT NULL,
+    region TEXT NOT NULL,
+    id TEXT NOT NULL,
+    project_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS members_project
+    ON members (resource_type, region, project_id);
+CREATE TABLE IF NOT EXISTS crawls (
+    resource_type TEXT NOT NULL,
+    region TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    finished_at REAL NOT NULL,
+    PRIMARY KEY (resource_type, region, scope)
+);
+"""
+
+TABLES = ('resources', 'metadata', 'members', 'crawls')
+
+# Snapshots of another version are dropped, the next crawl rebuilds them.
+SCHEMA_VERSION = 2
+
+PUBLIC = ('public',)
+
+# Record fields with a column of their own.
+COLUMNS = ('resource_type', 'id', 'name', 'project_id', 'status', 'updated',
+           'metadata')
+
+
+class SnapshotStore(object):
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                for table in TABLES:
+                    db.execute('DROP TABLE IF EXISTS %s' % table)
+            db.executescript(SCHEMA)
+            db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A connection per use, sqlite3 connections are not shared between
+        # threads and opening one is cheap.
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def replace(self, resource_type, region, records, scope=ALL_PROJECTS,
+                members=()):
+        """
+        Replaces the snapshot of a resource type in region by records, in
+        one transaction. With a project scope only that project's rows go.
+
+        members are the (id, project id) pairs of records shared with
+        other projects.
+        """
+        where = 'resource_type = ? AND region = ?'
+        args = [resource_type, region]
+        if scope != ALL_PROJECTS:
+            where += ' AND project_id = ?'
+            args.append(scope)
+        with self._connect() as db:
+            for table in ('metadata', 'members'):
+                db.execute('DELETE FROM %s WHERE resource_type = ? AND '
+                           'region = ? AND id IN (SELECT id FROM resources '
+                           'WHERE %s)' % (table, where),
+                           [resource_type, region] + args)
+            db.execute('DELETE FROM resources WHERE %s' % where, args)
+            self._insert(db, resource_type, region, records)
+            db.executemany('INSERT INTO members VALUES (?, ?, ?, ?)',
+                           [(resource_type, region, resource_id, project_id)
+                            for resource_id, project_id in members])
+            db.execute('INSERT OR REPLACE INTO crawls VALUES (?, ?, ?, ?)',
+                       (resource_type, region, scope, time.time()))
+
+    def _insert(self, db, resource_type, region, records):
+        for record in records:
+            metadata = dict(
+                (query.to_text(k), query.to_text(v)) for k, v in
+                resources.get_metadata(resource_type, record).items())
+            fields = dict((attr, getattr(record, attr))
+                          for attr in record.__slots__[len(COLUMNS):])
+            db.execute('INSERT OR REPLACE INTO resources VALUES '
+                       '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (resource_type, region, record.id, record.name,
+                        record.project_id, record.status,
+                        record.updated, json.dumps(metadata),
+                        record.visibility, json.dumps(fields)))
+            db.executemany('INSERT INTO metadata VALUES (?, ?, ?, ?, ?)',
+                           [(resource_type, region, record.id, k, v)
+                            for k, v in metadata.items()])
+
+    def _delete(self, db, resource_type, region, resource_ids,
+                tables=('metadata', 'resources')):
+        for table in tables:
+            db.executemany('DELETE FROM %s WHERE resource_type = ? AND '
+                           'region = ? AND id = ?' % table,
+                           [(resource_type, region, i)
+                            for i in resource_ids])
+
+    def put(self, resource_type, region, records):
+        """Adds or replaces the rows of records, leaving the others"""
+        with self._connect() as db:
+            self._delete(db, resource_type, region, [r.id for r in records])
+            self._insert(db, resource_type, region, records)
+
+    def update(self, resource_type, region, resource_id, fields):
+        """
+        Sets fields on the row of a resource, adding the row when missing.
+        The fields left out, notifications do not carry them all, keep
+        their value, and so do the resource's members.
+        """
+        with self._connect() as db:
+            row = db.execute('SELECT id, name, project_id, status, updated, '
+                             'metadata, fields FROM resources WHERE '
+                             'resource_type = ? AND region = ? AND id = ?',
+                             (resource_type, region,
+                              resource_id)).fetchone()
+            if row:
+                record = self._record(resource_type, row)
+                values = dict((attr, getattr(record, attr))
+                              for attr in record.__slots__[1:])
+            else:
+                values = {'id': resource_id, 'name': ''}
+            values.update(fields)
+            record = records.Record(resource_type, **values)
+            self._delete(db, resource_type, region, [resource_id])
+            self._insert(db, resource_type, region, [record])
+
+    def delete(self, resource_type, region, resource_ids):
+        with self._connect() as db:
+            self._delete(db, resource_type, region, resource_ids, TABLES[:3])
+
+    def crawled_at(self, resource_type, region, project_id):
+        """
+        When the rows of project_id in region were last crawled, None if
+        never
+        """
+        with self._connect() as db:
+            row = db.execute('SELECT MAX(finished_at) FROM crawls '
+                             'WHERE resource_type = ? AND region = ? AND '
+                             'scope IN (?, ?)',
+                             (resource_type, region, ALL_PROJECTS,
+                              project_id)).fetchone()
+        return row[0]
+
+    def _record(self, resource_type, row):
+        fields = dict((attr, value) for attr, value in
+                      json.loads(row[-1] or '{}').items()
+                      if attr in records.Record.__slots__)
+        if fields.get('transfer'):
+            fields['transfer'] = records.Transfer(*fields['transfer'])
+        return records.Record(resource_type,
+                              *(row[:-2] + (json.loads(row[-2]),)),
+                              **fields)
+
+    def page(self, resource_type, region, project_id, predicates=(),
+             marker=None, prev_marker=None, limit=20):
+        """
+        Returns (records, has_more, has_prev) a project sees in region,
+        ordered by name
+
+        Equality and existence predicates are answered by the metadata
+        index, the others are matched against each row.
+        """
+        where = ['r.resource_type = ? AND r.region = ?',
+                 '(r.project_id = ? OR r.visibility IN (%s) OR r.id IN '
+                 '(SELECT id FROM members WHERE resource_type = ? AND '
+                 'region = ? AND project_id = ?))' %
+                 ', '.join('?' * len(PUBLIC))]
+        args = ([resource_type, region, project_id] + list(PUBLIC) +
+                [resource_type, region, project_id])
+        residual = []
+        for predicate in predicates:
+            if query.is_equality(predicate):
+                where.append('r.id IN (SELECT id FROM metadata WHERE '
+                             'resource_type = ? AND region = ? AND key = ? '
+                             'AND value = ?)')
+                args.extend([resource_type, region, predicate.key,
+                             predicate.value])
+            elif (predicate.op == query.EXISTS and
+                    predicate.key != query.ANY_KEY):
+                where.append('r.id IN (SELECT id FROM metadata WHERE '
+                             'resource_type = ? AND region = ? AND key = ?)')
+                args.extend([resource_type, region, predicate.key])
+            else:
+                residual.append(predicate)
+        backwards = bool(prev_marker)
+        edge = self._position(resource_type, region, prev_marker or marker)
+        if edge:
+            where.append('(r.name %s ? OR (r.name = ? AND r.id %s ?))' %
+                         (('<', '<') if backwards else ('>', '>')))
+            args.extend([edge[0], edge[0], edge[1]])
+        order = 'DESC' if backwards else 'ASC'
+        sql = ('SELECT r.id, r.name, r.project_id, '
+               'r.status, r.updated, r.metadata, r.fields FROM resources r '
+               'WHERE %s ORDER BY r.name %s, r.id %s' %
+               (' AND '.join(where), order, order))
+        records = []
+        with self._connect() as db:
+            rows = (self._record(resource_type, row)
+                    for row in db.execute(sql, args))
+            for record in query.select(resource_type, rows, residual):
+                records.append(record)
+                if len(records) > limit:
+                    break
+        more = len(records) > limit
+        records = records[:limit]
+        if backwards:
+            records.reverse()
+            return records, True, more
+        return records, more, edge is not None
+
+    def _position(self, resource_type, region, resource_id):
+        if not resource_id:
+            return None
+        with self._connect() as db:
+            row = db.execute('SELECT name, id FROM resources WHERE '
+                             'resource_type = ? AND region = ? AND id = ?',
+                             (resource_type, region,
+                              resource_id)).fetchone()
+        return tuple(row) if row else None
+
+
+_stores = {}
+
+
+def get_store():
+    """The store at METAFINDER_SNAPSHOT_PATH, None when not configured"""
+    path = getattr(settings, 'METAFINDER_SNAPSHOT_PATH', None)
+    if not path:
+        return None
+    if path not in _stores:
+        _stores[path] = SnapshotStore(path)
+    return _stores[path]
+
+
+def get_fresh_store(request, resource_type):
+    """
+    Returns (store, crawled_at) when the request's project has a snapshot of
+    resource_type in its region younger than METAFINDER_SNAPSHOT_MAX_AGE,
+    else (None, None)
+    """
+    store = get_store()
+    if store is None:
+        return None, None
+    crawled_at = store.crawled_at(resource_type,
+                                  request.user.services_region,
+                                  request.user.tenant_id)
+    max_age = getattr(settings, 'METAFINDER_SNAPSHOT_MAX_AGE',
+                      DEFAULT_MAX_AGE)
+    if crawled_at is None or time.time() - crawled_at > max_age:
+        return None, None
+    return store, crawled_at
@@ -0,0 +1,337 @@
+#   Copyright 2016 Michael Rice <michael@michaelrice.org>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime
+import threading
+import time
+
+from concurrent import futures
+
+from django.conf import settings
+
+from horizon.utils import functions as utils
+from openstack_dashboard import api
+
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import index
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import swift_helpers
+from metasearchdashboard.metafinder.api import workers
+
+
+DEFAULT_SYNC_INTERVAL = 30
+DEFAULT_RECONCILE_INTERVAL = 3600
+
+DELETED_STATUSES = ('deleted', 'deleting', 'killed', 'pending_delete')
+
+
+def _raw_attr(resource, attr):
+    """Reads attributes the Horizon API wrappers do not expose"""
+    raw = getattr(resource, '_apiresource', resource)
+    return getattr(raw, attr, None)
+
+
+def _is_deleted(resource):
+    return (_raw_attr(resource, 'status') or '').lower() in DELETED_STATUSES
+
+
+def _utcnow():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _latest(resources_, attr, mark):
+    stamps = [_raw_attr(r, attr) for r in resources_]
+    stamps = [s for s in stamps if s]
+    if mark:
+        stamps.append(mark)
+    return max(stamps) if stamps else None
+
+
+def _instance_changes(request, mark):
+    """Nova filters on changes-since and also returns deleted servers"""
+    changed = []
+    marker = None
+    while True:
+        servers, has_more = api.nova.server_list(
+            request,
+            search_opts={'changes-since': mark, 'marker': marker,
+                         'paginate': True})
+        changed.extend(servers)
+        if not has_more or not servers:
+            break
+        marker = servers[-1].id
+    return changed, _latest(changed, 'updated', mark)
+
+
+def _volume_changes(request, mark):
+    """Cinder has no changes-since, walk newest updated_at first instead"""
+    client = api.cinder.cinderclient(request)
+    page_size = utils.get_page_size(request)
+    transfers = dict((t.volume_id, t)
+                     for t in api.cinder.transfer_list(request))
+    changed = []
+    marker = None
+    while True:
+        page = client.volumes.list(marker=marker, limit=page_size,
+                                   sort='updated_at:desc')
+        fresh = [v for v in page if (v.updated_at or '') >= mark]
+        for v in fresh:
+            v.transfer = transfers.get(v.id)
+            changed.append(api.cinder.Volume(v))
+        if len(fresh) < len(page) or len(page) < page_size:
+            break
+        marker = page[-1].id
+    return changed, _latest(changed, 'updated_at', mark)
+
+
+def _image_changes(request, mark):
+    """Glance lists can be sorted on updated_at, stop at the mark"""
+    changed = []
+    marker = None
+    while True:
+        images, has_more, has_prev = api.glance.image_list_detailed(
+            request,
+            marker=marker,
+            sort_key='updated_at',
+            sort_dir='desc',
+            paginate=True)
+        fresh = [i for i in images
+                 if (_raw_attr(i, 'updated_at') or '') >= mark]
+        changed.extend(fresh)
+        if len(fresh) < len(images) or not has_more:
+            break
+        marker = images[-1].id
+    return changed, _latest(changed, 'updated_at', mark)
+
+
+def _iter_container_listing(request):
+    marker = None
+    while True:
+        containers, has_more = api.swift.swift_get_containers(
+            request=request, marker=marker)
+        for container in containers:
+            yield container
+        if not has_more or not containers:
+            break
+        marker = containers[-1].name
+
+
+def _container_changes(request, mark):
+    """
+    Only the account listing is read in full; containers are HEADed when
+    they are new or their listing entry changed.
+    """
+    mark = mark or {}
+    signatures = {}
+    stale = []
+    for container in _iter_container_listing(request):
+        signature = swift_helpers.container_signature(container)
+        signatures[container.name] = signature
+        if mark.get(container.name) != signature:
+            stale.append(container)
+    changed = workers.bounded_map(
+        lambda c: swift_helpers.swift_get_container_with_metadata(
+            request, c.name, with_data=False),
+        stale,
+        lambda c, e: swift_helpers.swift_get_container_from_listing(c)
+    )
+    for container in changed:
+        if getattr(container, 'partial', False):
+            # Retry lookups that failed on the next sync.
+            signatures.pop(container.name, None)
+    deleted = [name for name in mark if name not in signatures]
+    return changed, deleted, signatures
+
+
+class SyncEngine(object):
+    """
+    Keeps a MetadataIndex current with per resource type high-water marks
+
+    The first sync of a resource type crawls everything; after that only
+    resources changed since the mark are fetched. A full crawl still runs
+    every reconcile interval to drop resources whose deletion the change
+    feed cannot report (Cinder and Glance hide deleted resources).
+    """
+    def __init__(self, metadata_index):
+        self.index = metadata_index
+        self._marks = {}
+        self._synced_at = {}
+        self._reconciled_at = {}
+        self._locks = dict((resource_type, threading.Lock())
+                           for resource_type in resources.RESOURCE_TYPES)
+        self._refreshing = {}
+        self._refreshing_lock = threading.Lock()
+
+    def is_synced(self, resource_type):
+        return resource_type in self._reconciled_at
+
+    def refresh(self, request, resource_type):
+        interval = getattr(settings, 'METAFINDER_SYNC_INTERVAL',
+                           DEFAULT_SYNC_INTERVAL)
+        reconcile_interval = getattr(settings,
+                                     'METAFINDER_SYNC_RECONCILE_INTERVAL',
+                                     DEFAULT_RECONCILE_INTERVAL)
+        with self._locks[resource_type]:
+            now = time.time()
+            reconciled_at = self._reconciled_at.get(resource_type)
+            if (reconciled_at is None or
+                    now - reconciled_at >= reconcile_interval):
+                self.full_sync(request, resource_type)
+            elif now - self._synced_at[resource_type] >= interval:
+                self.incremental_sync(request, resource_type)
+
+    def refresh_async(self, request, resource_type):
+        """
+        Refreshes resource_type on a thread of its own, returns a future of
+        it. While a refresh of the type runs, its future is returned rather
+        than another one started.
+        """
+        with self._refreshing_lock:
+            future = self._refreshing.get(resource_type)
+            if future is None:
+                future = self._refreshing[resource_type] = futures.Future()
+                future.set_running_or_notify_cancel()
+                thread = threading.Thread(target=self._refresh_into,
+                                          args=(request, resource_type,
+                                                future))
+                thread.daemon = True
+                thread.start()
+            return future
+
+    def _refresh_into(self, request, resource_type, future):
+        try:
+            self.refresh(request, resource_type)
+        except Exception as e:
+            error = e
+        else:
+            error = None
+        with self._refreshing_lock:
+            del self._refreshing[resource_type]
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    def _keep_indexed(self, containers):
+        """
+        Containers whose lookup failed are built from the listing alone,
+        without metadata; those indexed before keep their indexed record
+        """
+        kept = []
+        for container in containers:
+            indexed = None
+            if getattr(container, 'partial', False):
+                indexed = self.index.get(resources.CONTAINERS, container.name)
+            kept.append(container if indexed is None else indexed)
+        return kept
+
+    def full_sync(self, request, resource_type):
+        started = _utcnow()
+        if resource_type == resources.CONTAINERS:
+            changed, deleted, mark = _container_changes(request, None)
+            self.index.replace(resource_type, self._keep_indexed(changed))
+        else:
+            items = list(resources.iter_resources(request, resource_type))
+            self.index.replace(resource_type, records.compact_all(
+                request, resource_type, items))
+            attr = 'updated' if resource_type == resources.INSTANCES \
+                else 'updated_at'
+            mark = _latest(items, attr, None) or started
+        self._marks[resource_type] = mark
+        self._synced_at[resource_type] = time.time()
+        self._reconciled_at[resource_type] = self._synced_at[resource_type]
+
+    def incremental_sync(self, request, resource_type):
+        mark = self._marks[resource_type]
+        if resource_type == resources.CONTAINERS:
+            changed, deleted, mark = _container_changes(request, mark)
+            changed = self._keep_indexed(changed)
+        else:
+            feed = {
+                resources.INSTANCES: _instance_changes,
+                resources.VOLUMES: _volume_changes,
+                resources.IMAGES: _image_changes,
+            }[resource_type]
+            changed, mark = feed(request, mark)
+            deleted = [resources.get_resource_id(resource_type, r)
+                       for r in changed if _is_deleted(r)]
+            changed = [r for r in changed if not _is_deleted(r)]
+        for resource_id in deleted:
+            self.index.remove(resource_type, resource_id)
+        self.index.update(resource_type, records.compact_all(
+            request, resource_type, changed))
+        self._marks[resource_type] = mark
+        self._synced_at[resource_type] = time.time()
+
+
+# Engines are evicted along with their index, see index.get_index.
+_engines = cache.MemoryBackend(max_entries=index.get_max_projects())
+_engines_lock = threading.Lock()
+
+
+def get_engine(request):
+    """
+    Returns the sync engine for the project and region the request is
+    scoped to
+    """
+    key = (request.user.tenant_id, request.user.services_region)
+    metadata_index = index.get_index(request)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None or engine.index is not metadata_index:
+            engine = SyncEngine(metadata_index)
+            _engines.set(key, engine, None)
+        return engine
+
+
+def search(request, resource_type, predicates, refresh=True):
+    """
+    Answers query predicates from the index, after bringing it up to date
+    unless refresh is False
+
+    Equality and existence predicates are looked up in the index, as are
+    substring, prefix and fuzzy ones through its trigrams; anything else is
+    matched against the candidates it returns. Results come closest matches
+    first, then by name.
+    """
+    engine = get_engine(request)
+    if refresh:
+        engine.refresh(request, resource_type)
+    terms = []
+    ranks = None
+    residual = []
+    for predicate in predicates:
+        if query.is_equality(predicate):
+            terms.append((predicate.key, predicate.value))
+        elif (predicate.op == query.EXISTS and
+                predicate.key != query.ANY_KEY):
+            terms.append((predicate.key, None))
+        elif predicate.op in query.PATTERNS:
+            matched = engine.index.match(resource_type, predicate)
+            if ranks is not None:
+                matched = dict((i, rank + ranks[i])
+                               for i, rank in matched.items() if i in ranks)
+            ranks = matched
+        else:
+            residual.append(predicate)
+    among = set(ranks) if ranks is not None else None
+    results = engine.index.search(resource_type, terms, among)
+    if residual:
+        results = query.select(resource_type, results, residual)
+    ranks = ranks or {}
+    return sorted(results, key=lambda r: (
+        ranks.get(resources.get_resource_id(resource_type, r), 0),
+        (r.name or '').lower()))
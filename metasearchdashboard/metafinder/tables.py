@@ -12,9 +12,15 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import six
+
 from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ungettext
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.template.defaultfilters import filesizeformat
+from django.utils.html import format_html
+from django.utils.http import urlencode
 
 from openstack_dashboard.dashboards.project.containers import utils
 from openstack_dashboard.dashboards.project.instances.tables import \
@@ -40,9 +46,140 @@ from openstack_dashboard.dashboards.project.images.images.tables import \
 
 from horizon import tables
 
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import index
+from metasearchdashboard.metafinder import metrics
+
 
 class MetadataFilterAction(tables.FilterAction):
+    """
+    Searches metadata across every page of a table
+
+    Filters are parsed by metafinder.query and evaluated against the raw
+    metadata, e.g. "env=prod AND tier IN (web,api) AND NOT has:deprecated"
+    or "*~3fa9c" for any value containing 3fa9c. They are pushed down to the
+    service where it supports them and answered from the project's metadata
+    index otherwise.
+    """
     name = "metadatafilter"
+    filter_type = "server"
+
+
+class ExportCSV(tables.LinkAction):
+    """
+    Downloads every row matching the table's current filter, across all of
+    its pages
+    """
+    name = "export_csv"
+    verbose_name = _("Export CSV")
+    icon = "download"
+    output_format = "csv"
+
+    def get_link_url(self, datum=None):
+        param_name = self.table._meta._filter_action.get_param_name()
+        params = {
+            'types': self.table._meta.name,
+            'format': self.output_format,
+            'q': self.table.request.session.get(param_name, ''),
+        }
+        return '%s?%s' % (
+            reverse('horizon:metasearchdashboard:metafinder:export'),
+            urlencode(params))
+
+
+class ExportJSONLines(ExportCSV):
+    name = "export_jsonl"
+    verbose_name = _("Export JSON Lines")
+    output_format = "jsonl"
+
+
+class InvalidateCacheMixin(object):
+    """
+    Drops the cached pages and index entry of a resource once an action on
+    it succeeded, so the next page view does not show it stale.
+    """
+    def action(self, request, obj_id):
+        super(InvalidateCacheMixin, self).action(request, obj_id)
+        resource_type = self.table._meta.name
+        cache.invalidate(request, resource_type)
+        index.get_index(request).remove(resource_type, obj_id)
+
+
+class MetaDeleteInstance(InvalidateCacheMixin, DeleteInstance):
+    pass
+
+
+class MetaDeleteVolume(InvalidateCacheMixin, DeleteVolume):
+    pass
+
+
+class MetaDeleteImage(InvalidateCacheMixin, DeleteImage):
+    pass
+
+
+class InstrumentedTableMixin(object):
+    """Records how long the table takes to render and how large it is"""
+    def render(self):
+        with metrics.timed(self.request, 'render', self._meta.name) as timer:
+            output = super(InstrumentedTableMixin, self).render()
+            timer.bytes = len(output)
+            timer.items = len(self.data or ())
+        return output
+
+
+class IndexFormMixin(object):
+    """
+    Tables of a tab rendered on its own, by views.TabContentView, post their
+    forms and row updates to the index view, which handles the actions of
+    the tables of every tab
+    """
+    def _is_tab_content(self):
+        match = getattr(self.request, 'resolver_match', None)
+        return match is not None and match.url_name == 'tab'
+
+    def get_absolute_url(self):
+        if self._is_tab_content():
+            return reverse('horizon:metasearchdashboard:metafinder:index')
+        return super(IndexFormMixin, self).get_absolute_url()
+
+    def get_full_url(self):
+        if self._is_tab_content():
+            return reverse('horizon:metasearchdashboard:metafinder:index')
+        return super(IndexFormMixin, self).get_full_url()
+
+
+DEFAULT_METADATA_DISPLAY_LIMIT = 20
+
+_rendered_metadata = cache.MemoryBackend(
+    max_entries=getattr(settings, 'METAFINDER_RENDER_CACHE_SIZE', 10000))
+
+
+def _revision(datum):
+    """
+    Returns what changes whenever a resource is updated, if it has one
+    """
+    raw = getattr(datum, '_apiresource', datum)
+    return (getattr(raw, 'updated', None) or
+            getattr(raw, 'updated_at', None))
+
+
+def render_metadata(metadata, limit=None):
+    """
+    Renders a metadata dict, items past limit are hidden behind a link that
+    expands them in the page
+    """
+    limit = limit or getattr(settings, 'METAFINDER_METADATA_DISPLAY_LIMIT',
+                             DEFAULT_METADATA_DISPLAY_LIMIT)
+    items = [u"%s: %s" % item for item in six.iteritems(metadata)]
+    if len(items) <= limit:
+        return u", ".join(items)
+    hidden = len(items) - limit
+    return format_html(
+        u'{}<span class="metadata-more hide">, {}</span> '
+        u'<a href="#" class="metadata-expand">{}</a>',
+        u", ".join(items[:limit]),
+        u", ".join(items[limit:]),
+        ungettext("(%d more)", "(%d more)", hidden) % hidden)
 
 
 def metadata_dict_to_str(metadata, attr_name=None):
@@ -52,22 +189,29 @@ def metadata_dict_to_str(metadata, attr_name=None):
     Ex:
     metadata = {"app_id": "myapp", "color": "blue"}
     return "app_id: myapp, color: blue"
+
+    The output is memoized per resource revision, so a resource is only
+    formatted again once it has been updated.
     """
     attr_name = attr_name or "metadata"
-    metadata = getattr(metadata, attr_name)
+    datum = metadata
+    metadata = getattr(datum, attr_name)
     if metadata is None:
         return "None"
-    mystr = ""
-    items = len(metadata)
-    for k, v in metadata.iteritems():
-        mystr += "{}: {}".format(k, v)
-        items -= 1
-        if items >= 1:
-            mystr += ", "
-    return mystr
+    revision = _revision(datum)
+    resource_id = getattr(datum, 'id', None)
+    if revision is None or resource_id is None:
+        return render_metadata(metadata)
+    key = (attr_name, resource_id, revision)
+    rendered = _rendered_metadata.get(key)
+    if rendered is None:
+        rendered = render_metadata(metadata)
+        _rendered_metadata.set(key, rendered, None)
+    return rendered
 
 
-class InstancesTable(tables.DataTable):
+class InstancesTable(InstrumentedTableMixin, IndexFormMixin,
+                     tables.DataTable):
     TASK_STATUS_CHOICES = (
         (None, True),
         ("none", True)
@@ -107,7 +251,9 @@ class InstancesTable(tables.DataTable):
             launch_actions = (LaunchLink,) + launch_actions
         if getattr(settings, 'LAUNCH_INSTANCE_NG_ENABLED', True):
             launch_actions = (LaunchLinkNG,) + launch_actions
-        table_actions = launch_actions + (MetadataFilterAction, DeleteInstance)
+        table_actions = launch_actions + (MetadataFilterAction,
+                                          ExportCSV, ExportJSONLines,
+                                          MetaDeleteInstance)
         row_actions = (StartInstance, ConfirmResize, RevertResize,
                        CreateSnapshot, SimpleAssociateIP, AssociateIP,
                        SimpleDisassociateIP, AttachInterface,
@@ -116,12 +262,13 @@ class InstancesTable(tables.DataTable):
                        ConsoleLink, LogLink, TogglePause, ToggleSuspend,
                        ToggleShelve, ResizeLink, LockInstance, UnlockInstance,
                        SoftRebootInstance, RebootInstance,
-                       StopInstance, RebuildInstance, DeleteInstance)
+                       StopInstance, RebuildInstance, MetaDeleteInstance)
         pagination_param = 'instance_marker'
         prev_pagination_param = 'prev_instance_marker'
 
 
-class VolumeTable(tables.DataTable):
+class VolumeTable(InstrumentedTableMixin, IndexFormMixin,
+                  tables.DataTable):
     name = tables.Column("name", verbose_name=_("Name"),
                          link="horizon:admin:volumes:volumes:detail")
     # status = tables.Column("status", verbose_name=_("Status"))
@@ -134,7 +281,8 @@ class VolumeTable(tables.DataTable):
     class Meta(object):
         name = "volumes"
         verbose_name = _("Volumes")
-        table_actions = (MetadataFilterAction, CreateVolume, AcceptTransfer, DeleteVolume)
+        table_actions = (MetadataFilterAction, ExportCSV, ExportJSONLines,
+                         CreateVolume, AcceptTransfer, MetaDeleteVolume)
         launch_actions = ()
         if getattr(settings, 'LAUNCH_INSTANCE_LEGACY_ENABLED', False):
             launch_actions = (LaunchVolume,) + launch_actions
@@ -144,7 +292,7 @@ class VolumeTable(tables.DataTable):
                        launch_actions +
                        (EditAttachments, CreateSnapshot, CreateBackup,
                         RetypeVolume, UploadToImage, CreateTransfer,
-                        DeleteTransfer, DeleteVolume))
+                        DeleteTransfer, MetaDeleteVolume))
         pagination_param = 'volume_marker'
         prev_pagination_param = 'prev_volume_marker'
 
@@ -153,7 +301,8 @@ def images_md_to_str(data):
     return metadata_dict_to_str(data, attr_name="properties")
 
 
-class ImageTable(tables.DataTable):
+class ImageTable(InstrumentedTableMixin, IndexFormMixin,
+                 tables.DataTable):
     name = tables.Column("name", verbose_name=_("Name"),
                          link="horizon:admin:images:detail")
     properties = tables.Column(images_md_to_str, verbose_name=_("Metadata"))
@@ -161,7 +310,8 @@ class ImageTable(tables.DataTable):
     class Meta(object):
         name = "images"
         verbose_name = _("Images")
-        table_actions = (MetadataFilterAction, CreateImage, DeleteImage, )
+        table_actions = (MetadataFilterAction, ExportCSV, ExportJSONLines,
+                         CreateImage, MetaDeleteImage, )
         launch_actions = ()
         if getattr(settings, 'LAUNCH_INSTANCE_LEGACY_ENABLED', False):
             launch_actions = (LaunchImage,) + launch_actions
@@ -169,7 +319,7 @@ class ImageTable(tables.DataTable):
             launch_actions = (LaunchImageNG,) + launch_actions
         row_actions = launch_actions + (CreateVolumeFromImage,
                                         EditImage, UpdateMetadataImg,
-                                        DeleteImage,)
+                                        MetaDeleteImage,)
         pagination_param = 'image_marker'
         prev_pagination_param = 'prev_image_marker'
 
@@ -179,14 +329,46 @@ def get_container_link(container):
                    args=(utils.wrap_delimiter(container.name),))
 
 
-class ContainerTable(tables.DataTable):
+class ContainerTable(InstrumentedTableMixin, IndexFormMixin,
+                     tables.DataTable):
     name = tables.Column("name", verbose_name=_("Name"),
                          link=get_container_link)
     metadata = tables.Column(metadata_dict_to_str, verbose_name=_("Metadata"))
 
+    def get_object_id(self, datum):
+        # Container names are unique within the account and are the markers
+        # Swift pages by.
+        return datum.name
+
     class Meta(object):
         name = "containers"
         verbose_name = _("Containers")
-        table_actions = (MetadataFilterAction, )
+        table_actions = (MetadataFilterAction, ExportCSV, ExportJSONLines)
         pagination_param = 'container_marker'
         prev_pagination_param = 'prev_container_marker'
+
+
+def get_object_container_link(obj):
+    return reverse("horizon:project:containers:index",
+                   args=(utils.wrap_delimiter(obj.container_name),))
+
+
+class ObjectTable(InstrumentedTableMixin, IndexFormMixin,
+                  tables.DataTable):
+    container = tables.Column("container_name",
+                              verbose_name=_("Container"),
+                              link=get_object_container_link)
+    name = tables.Column("name", verbose_name=_("Name"))
+    size = tables.Column("bytes", verbose_name=_("Size"),
+                         filters=(filesizeformat,))
+    metadata = tables.Column(metadata_dict_to_str, verbose_name=_("Metadata"))
+
+    def get_object_id(self, datum):
+        return datum.id
+
+    class Meta(object):
+        name = "objects"
+        verbose_name = _("Objects")
+        table_actions = (MetadataFilterAction, ExportCSV, ExportJSONLines)
+        pagination_param = 'object_marker'
+        prev_pagination_param = 'prev_object_marker'
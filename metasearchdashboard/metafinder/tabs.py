@@ -12,62 +12,260 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import copy
+import datetime
+
+import six
+
+from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from horizon import exceptions
+from horizon import messages
 from horizon import tabs
 
-from openstack_dashboard import api
+from metasearchdashboard.metafinder import breaker
+from metasearchdashboard.metafinder import index
+from metasearchdashboard.metafinder import objects
+from metasearchdashboard.metafinder import pagination
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder import snapshot
+from metasearchdashboard.metafinder import sync
 from metasearchdashboard.metafinder import tables
 
-from metasearchdashboard.metafinder.api import swift_helpers
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import workers
+
+
+LAZY = 'lazy'
+AJAX = 'ajax'
+PARALLEL = 'parallel'
+
+# How a tab got less than it asked for.
+STALE = 'stale'
+PARTIAL = 'partial'
+
+DEFAULT_TAB_TIMEOUT = 60
+
+
+def get_tab_loading():
+    """
+    How tabs that are not active get their data, METAFINDER_TAB_LOADING:
+
+    "lazy": the default, as in Horizon a tab is loaded when it is clicked.
+    "ajax": the page requests every tab at once and each fills in as soon
+    as its own data arrives.
+    "parallel": the view loads all tabs concurrently before responding.
+
+    The last two query every service on each page view, tabs opened or
+    not, in exchange for switching tabs without waiting.
+    """
+    return getattr(settings, 'METAFINDER_TAB_LOADING', LAZY)
 
 
 class PagedTableMixin(object):
     def __init__(self, *args, **kwargs):
         super(PagedTableMixin, self).__init__(*args, **kwargs)
         self._has_prev_data = False
-        self._has_more_data = False
+        self._has_more = False
+        self._snapshot_at = None
+        self._degraded = None
+        self._budget = None
+
+    def get_context_data(self, request, **kwargs):
+        context = super(PagedTableMixin, self).get_context_data(request,
+                                                                **kwargs)
+        context['snapshot_at'] = self._snapshot_at
+        context['degraded'] = self._degraded
+        context['facets'] = self._get_facets()
+        if context['facets']:
+            context['filter_param'] = self._get_filter_param()
+        return context
+
+    def _get_facets(self):
+        """
+        Top keys and values of the metadata fetched so far, each value with
+        the filter narrowing the table down to it
+        """
+        resource_type = self.table_classes[0]._meta.name
+        if (resource_type not in resources.RESOURCE_TYPES or
+                not getattr(settings, 'METAFINDER_FACETS', True)):
+            return []
+        filter_string = self._get_filter_string()
+        return [{'key': key,
+                 'count': count,
+                 'values': [{'value': value,
+                             'count': value_count,
+                             'query': query.and_term(filter_string, key,
+                                                     value)}
+                            for value, value_count in values]}
+                for key, count, values in index.get_facets(self.request,
+                                                           resource_type)]
 
     def has_prev_data(self, table):
         return self._has_prev_data
 
     def has_more_data(self, table):
-        return self._has_more_data
+        return self._has_more
 
-    def _get_marker(self):
+    def _get_markers(self):
         meta = self.table_classes[0]._meta
-        prev_marker = self.request.GET.get(meta.prev_pagination_param, None)
-        if prev_marker:
-            return prev_marker, "asc"
-        else:
-            marker = self.request.GET.get(meta.pagination_param, None)
-            if marker:
-                return marker, "desc"
-            return None, "desc"
+        return (self.request.GET.get(meta.pagination_param, None),
+                self.request.GET.get(meta.prev_pagination_param, None))
+
+    def get_empty_context(self):
+        """Context of the tab with empty tables, for tabs that timed out"""
+        for table in self._tables.values():
+            table.data = []
+        self._table_data_loaded = True
+        return self.get_context_data(self.request)
+
+    def _get_filter_param(self):
+        table = self._tables[self.table_classes[0]._meta.name]
+        return table._meta._filter_action.get_param_name()
+
+    def _get_filter_string(self):
+        """
+        Returns the server side filter string for the tab's table
+
+        The string is kept in the session, like Horizon does for server
+        filters on plain table views, so it survives tab switches and paging.
+        """
+        param_name = self._get_filter_param()
+        filter_string = self.request.POST.get(param_name)
+        if filter_string is None:
+            return self.request.session.get(param_name, '')
+        self.request.session[param_name] = filter_string
+        return filter_string
+
+    def _use_index(self, resource_type, filters, residual):
+        """
+        Searches go to the index once it is warm, or when part of the query
+        cannot be pushed down to the service. A fully pushable query on a
+        cold index is cheaper to answer live than to crawl everything.
+        """
+        if not getattr(settings, 'METAFINDER_SEARCH_INDEX', True):
+            return False
+        engine = sync.get_engine(self.request)
+        return engine.is_synced(resource_type) or bool(residual)
+
+    def _get_budget(self):
+        """
+        The tab's latency budget, METAFINDER_TAB_TIMEOUT seconds from when
+        it first calls a service
+        """
+        if self._budget is None:
+            self._budget = breaker.Budget(getattr(
+                settings, 'METAFINDER_TAB_TIMEOUT', DEFAULT_TAB_TIMEOUT))
+        return self._budget
+
+    def _unavailable(self):
+        """Empty data for a tab whose service is unavailable"""
+        self._degraded = PARTIAL
+        self._has_more = False
+        self._has_prev_data = False
+        return []
+
+    def _get_page(self, paginator):
+        marker, prev_marker = self._get_markers()
+        items, self._has_more, self._has_prev_data = paginator.page(
+            marker, prev_marker)
+        if paginator.stale:
+            self._degraded = STALE
+        elif paginator.partial:
+            self._degraded = PARTIAL
+        return items
+
+    def _search_index(self, resource_type, predicates):
+        """
+        Searches the index once it is brought up to date, or as it is when
+        the service is unavailable and the index was synced before, and
+        returns the page of the matches the markers point to
+
+        A sync that outlasts the budget goes on in the background, later
+        requests wait on it rather than start another.
+        """
+        engine = sync.get_engine(self.request)
+        try:
+            breaker.wait_for_crawl(
+                self.request, resources.SERVICES[resource_type],
+                lambda: engine.refresh_async(
+                    workers.DetachedRequest(self.request), resource_type),
+                self._get_budget())
+        except breaker.Unavailable:
+            if not engine.is_synced(resource_type):
+                raise
+            self._degraded = STALE
+        matches = sync.search(self.request, resource_type, predicates,
+                              refresh=False)
+        marker, prev_marker = self._get_markers()
+        items, self._has_more, self._has_prev_data = pagination.slice_page(
+            resource_type, matches, marker, prev_marker,
+            pagination.get_page_size(self.request))
+        return items
+
+    def _get_snapshot(self, store, resource_type, predicates):
+        marker, prev_marker = self._get_markers()
+        items, self._has_more, self._has_prev_data = store.page(
+            resource_type, self.request.user.services_region,
+            self.request.user.tenant_id, predicates, marker, prev_marker,
+            pagination.get_page_size(self.request))
+        return items
+
+    def _parse_filter(self):
+        """Returns (filter string, predicates), predicates None if invalid"""
+        filter_string = self._get_filter_string().strip()
+        try:
+            return filter_string, query.parse(filter_string)
+        except query.QueryError as e:
+            self._has_more = False
+            messages.error(self.request, _('Invalid search: %s') % e)
+            return filter_string, None
+
+    def _get_resources(self, resource_type):
+        try:
+            return self._load_resources(resource_type)
+        except breaker.Unavailable:
+            return self._unavailable()
+
+    def _load_resources(self, resource_type):
+        filter_string, predicates = self._parse_filter()
+        if predicates is None:
+            return []
+        store, crawled_at = snapshot.get_fresh_store(self.request,
+                                                     resource_type)
+        if store is not None:
+            self._snapshot_at = datetime.datetime.utcfromtimestamp(
+                crawled_at).replace(tzinfo=timezone.utc)
+            return self._get_snapshot(store, resource_type, predicates)
+        filters, residual = query.push_down(resource_type, predicates)
+        if predicates and self._use_index(resource_type, filters, residual):
+            return self._search_index(resource_type, predicates)
+        paginator = pagination.Paginator(self.request, resource_type,
+                                         filter_string, filters,
+                                         budget=self._get_budget())
+        items = self._get_page(paginator)
+        if not predicates and not self._degraded:
+            index.get_index(self.request).update(resource_type, items)
+        if residual:
+            items = list(query.select(resource_type, items, residual))
+        return items
 
 
 class InstanceTab(PagedTableMixin, tabs.TableTab):
     name = _("Instances Tab")
     slug = "instances_tab"
     table_classes = (tables.InstancesTable,)
-    template_name = ("horizon/common/_detail_table.html")
+    template_name = "metasearchdashboard/metafinder/_tab_table.html"
     preload = False
 
-    def has_more_data(self, table):
-        return self._has_more
-
     def get_instances_data(self):
         try:
-            marker, sort_dir = self._get_marker()
-
-            instances, self._has_more = api.nova.server_list(
-                self.request,
-                search_opts={'marker': marker, 'paginate': True})
-
-            return instances
+            return self._get_resources(resources.INSTANCES)
         except Exception:
             self._has_more = False
+            self._has_prev_data = False
             error_message = _('Unable to get instances')
             exceptions.handle(self.request, error_message)
 
@@ -78,29 +276,16 @@ class VolumeTab(PagedTableMixin, tabs.TableTab):
     name = _("Volumes Tab")
     slug = "volumes_tab"
     table_classes = (tables.VolumeTable,)
-    template_name = ("horizon/common/_detail_table.html")
+    template_name = "metasearchdashboard/metafinder/_tab_table.html"
     preload = False
-    _has_more = False
-
-    def has_more_data(self, table):
-        return self._has_more
 
     def get_volumes_data(self):
         try:
-            marker, sort_dir = self._get_marker()
-
-            volumes, self._has_more, self._has_prev_data = api.cinder.volume_list_paged(
-                self.request,
-                marker=marker,
-                paginate=True,
-                search_opts=None
-            )
-
-            return volumes
+            return self._get_resources(resources.VOLUMES)
         except Exception as e:
             self._has_more = False
             self._has_prev_data = False
-            error_message = _('Unable to get volumes {}.'.format(e.message))
+            error_message = _('Unable to get volumes %s.') % six.text_type(e)
             exceptions.handle(self.request, error_message)
 
             return []
@@ -111,26 +296,16 @@ class ImageTab(PagedTableMixin, tabs.TableTab):
     slug = "images_tab"
     table_classes = (tables.ImageTable, )
 
-    template_name = ("horizon/common/_detail_table.html")
+    template_name = "metasearchdashboard/metafinder/_tab_table.html"
     preload = False
 
-    def has_more_data(self, table):
-        return self._has_more
-
     def get_images_data(self):
         try:
-            marker, sort_dir = self._get_marker()
-
-            images, self._has_more, self._has_prev_data = api.glance.image_list_detailed(
-                self.request,
-                marker=marker,
-                filters=None, paginate=True)
-
-            return images
+            return self._get_resources(resources.IMAGES)
         except Exception as e:
             self._has_more = False
             self._has_prev_data = False
-            error_message = _('Unable to get images {}.'.format(e.message))
+            error_message = _('Unable to get images %s.') % six.text_type(e)
             exceptions.handle(self.request, error_message)
 
             return []
@@ -140,37 +315,124 @@ class ContainerTab(PagedTableMixin, tabs.TableTab):
     name = _("Container Tab")
     slug = "containers_tab"
     table_classes = (tables.ContainerTable, )
-    template_name = ("horizon/common/_detail_table.html")
+    template_name = "metasearchdashboard/metafinder/_tab_table.html"
     preload = False
 
-    def has_more_data(self, table):
-        return self._has_more
-
     def get_containers_data(self):
         try:
-            marker, sort_dir = self._get_marker()
-            containers, self._has_more = api.swift.swift_get_containers(
-                request=self.request,
-                marker=marker
-            )
-            nc = []
-            for c in containers:
-                cc = swift_helpers.swift_get_container_with_metadata(self.request, c.name)
-                nc.append(cc)
-            n = len(containers)
-            for c in nc:
-                c.id = n
-                n -= 1
-            return nc
+            return self._get_resources(resources.CONTAINERS)
+        except Exception as e:
+            self._has_more = False
+            self._has_prev_data = False
+            error_message = (_('Unable to get containers %s.') %
+                             six.text_type(e))
+            exceptions.handle(self.request, error_message)
+            return []
+
+
+class ObjectTab(PagedTableMixin, tabs.TableTab):
+    """
+    Objects matching the filter, which is required: objects are listed by
+    HEADing every candidate, so there is no index or snapshot of them.
+    """
+    name = _("Objects Tab")
+    slug = "objects_tab"
+    table_classes = (tables.ObjectTable, )
+    template_name = "metasearchdashboard/metafinder/_tab_table.html"
+    preload = False
+
+    def get_objects_data(self):
+        try:
+            filter_string, predicates = self._parse_filter()
+            if not predicates:
+                return []
+            paginator = pagination.Paginator(
+                self.request, resources.OBJECTS, filter_string, predicates,
+                lister=objects.list_objects, budget=self._get_budget())
+            return self._get_page(paginator)
+        except breaker.Unavailable:
+            return self._unavailable()
         except Exception as e:
             self._has_more = False
             self._has_prev_data = False
-            error_message = _('Unable to get containers {}.'.format(e.message))
+            error_message = _('Unable to get objects %s.') % six.text_type(e)
             exceptions.handle(self.request, error_message)
             return []
 
 
 class MetaFinderTabs(tabs.TabGroup):
     slug = "mypanel_tabs"
-    tabs = (InstanceTab, VolumeTab, ImageTab, ContainerTab)
+    tabs = (InstanceTab, VolumeTab, ImageTab, ContainerTab, ObjectTab)
     sticky = True
+
+    def load_tab_data(self):
+        if get_tab_loading() != PARALLEL:
+            return super(MetaFinderTabs, self).load_tab_data()
+        for tab in self._tabs.values():
+            tab.preload = True
+        # Tabs not allowed or not enabled are left out, as Horizon does.
+        pending = [tab for tab in self._tabs.values()
+                   if tab.load and not tab.data_loaded]
+        for tab in pending:
+            # Filters are kept in the session, which workers only get a copy
+            # of, so they are stored from this thread.
+            tab._get_filter_string()
+        # Workers time their calls into the request's own list of samples.
+        self.request.__dict__.setdefault('_metafinder_samples', [])
+        loaded = workers.bounded_map(
+            self._load_copy,
+            pending,
+            self._timed_out,
+            max_workers=len(pending),
+            timeout=getattr(settings, 'METAFINDER_TAB_TIMEOUT',
+                            DEFAULT_TAB_TIMEOUT))
+        for tab, (state, context, request) in zip(pending, loaded):
+            if state is not None:
+                tab.__dict__.update(state)
+                self._add_messages(request)
+            tab._data = context
+
+    def _load_copy(self, tab):
+        """
+        Loads a copy of tab with a copy of the request, so a worker that
+        times out only ever touches its copies. Returns the state to take
+        over from the tab's copy, its context and the request's copy.
+        """
+        request = copy.copy(self.request)
+        request.session = dict(self.request.session)
+        request._messages = _Messages()
+        if hasattr(self.request, 'horizon'):
+            request.horizon = dict(self.request.horizon, async_messages=[])
+        worker = type(tab)(self, request)
+        context = worker.get_context_data(request)
+        for table in worker._tables.values():
+            table.request = self.request
+        state = dict(worker.__dict__)
+        del state['request']
+        del state['tab_group']
+        return state, context, request
+
+    def _add_messages(self, request):
+        """Adds the messages a worker added to its copy of the request"""
+        for level, message, extra_tags in request._messages.added:
+            messages.add_message(self.request, level, message,
+                                 extra_tags=extra_tags)
+        if hasattr(request, 'horizon'):
+            self.request.horizon['async_messages'].extend(
+                request.horizon['async_messages'])
+
+    def _timed_out(self, tab, exc):
+        messages.warning(self.request,
+                         _('%s did not load in time.') % tab.name)
+        return None, tab.get_empty_context(), None
+
+
+class _Messages(object):
+    """Message storage of a worker's copy of the request"""
+    _queued_messages = ()
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, level, message, extra_tags=''):
+        self.added.append((level, message, extra_tags))
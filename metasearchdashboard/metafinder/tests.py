@@ -10,10 +10,1513 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+import mock
+
 from horizon.test import helpers as test
 
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import swift_helpers
+from metasearchdashboard.metafinder.api import workers
+from metasearchdashboard.metafinder import admin_search
+from metasearchdashboard.metafinder import breaker
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import export
+from metasearchdashboard.metafinder import fakes
+from metasearchdashboard.metafinder import index
+from metasearchdashboard.metafinder import metrics
+from metasearchdashboard.metafinder import ngram
+from metasearchdashboard.metafinder import notifications
+from metasearchdashboard.metafinder import objects
+from metasearchdashboard.metafinder import pagination
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder import records
+from metasearchdashboard.metafinder import search
+from metasearchdashboard.metafinder import snapshot
+from metasearchdashboard.metafinder import sync
+from metasearchdashboard.metafinder import tables
+from metasearchdashboard.metafinder import tabs
+from metasearchdashboard.metafinder import views
+
 
 class MetafinderTests(test.TestCase):
     # Unit tests for metafinder.
     def test_me(self):
         self.assertTrue(1 + 1 == 2)
+
+
+class BoundedMapTests(test.TestCase):
+    def test_results_keep_order(self):
+        results = workers.bounded_map(lambda x: x * 2, [3, 1, 2],
+                                      lambda x, e: None, max_workers=2)
+        self.assertEqual([6, 2, 4], results)
+
+    def test_failure_uses_fallback(self):
+        def lookup(x):
+            if x == 2:
+                raise ValueError(x)
+            return x
+
+        results = workers.bounded_map(lookup, [1, 2, 3],
+                                      lambda x, e: -x, max_workers=2)
+        self.assertEqual([1, -2, 3], results)
+
+    def test_timeout_uses_fallback(self):
+        def lookup(x):
+            if x == 2:
+                time.sleep(1)
+            return x
+
+        results = workers.bounded_map(lookup, [1, 2, 3],
+                                      lambda x, e: None, timeout=0.1)
+        self.assertEqual([1, None, 3], results)
+
+    def test_timeout_bounds_the_whole_batch(self):
+        def lookup(x):
+            time.sleep(0.3)
+            return x
+
+        # One at a time the second lookup ends past the batch's timeout,
+        # though within the timeout of its own.
+        results = workers.bounded_map(lookup, [1, 2], lambda x, e: None,
+                                      max_workers=1, timeout=0.5)
+        self.assertEqual([1, None], results)
+
+
+class ContainerMetadataTests(test.TestCase):
+    def _mock_swift(self, mock_swift_api):
+        swift = mock_swift_api.return_value
+        swift.head_container.return_value = {
+            'x-container-meta-app-id': 'myapp',
+            'x-container-object-count': '3',
+            'x-timestamp': '1450000000.00000',
+        }
+        swift.get_object.return_value = ({}, 'obj1\nobj2\nobj3\n')
+        return swift
+
+    @mock.patch.object(tables, 'reverse', return_value='/containers/c1/')
+    @mock.patch.object(swift_helpers, 'swift_api')
+    def test_render_table_fetches_no_listing(self, mock_swift_api,
+                                             mock_reverse):
+        swift = self._mock_swift(mock_swift_api)
+        container = swift_helpers.swift_get_container_with_metadata(
+            self.request, 'c1')
+        container.id = 'c1'
+
+        table = tables.ContainerTable(self.request, data=[container])
+        content = table.render()
+
+        self.assertIn('app-id: myapp', content)
+        swift.head_container.assert_called_once_with('c1')
+        self.assertFalse(swift.get_object.called)
+
+    @mock.patch.object(swift_helpers, 'swift_api')
+    def test_data_fetched_on_access(self, mock_swift_api):
+        swift = self._mock_swift(mock_swift_api)
+        container = swift_helpers.swift_get_container_with_metadata(
+            self.request, 'c1')
+
+        self.assertFalse(swift.get_object.called)
+        self.assertEqual('obj1\nobj2\nobj3\n', container.data)
+        self.assertEqual('obj1\nobj2\nobj3\n', container['data'])
+        swift.get_object.assert_called_once_with('c1', '')
+
+
+class MetadataIndexTests(test.TestCase):
+    def _volume(self, volume_id, **metadata):
+        return mock.Mock(id=volume_id, metadata=metadata)
+
+    def setUp(self):
+        super(MetadataIndexTests, self).setUp()
+        self.index = index.MetadataIndex()
+        self.index.update('volumes', [
+            self._volume('v1', app_id='myapp', color='blue'),
+            self._volume('v2', app_id='myapp'),
+            self._volume('v3', app_id='other', color='blue'),
+        ])
+
+    def _search(self, *terms):
+        return sorted(r.id for r in self.index.search('volumes', terms))
+
+    def test_search_key_value(self):
+        self.assertEqual(['v1', 'v2'], self._search(('app_id', 'myapp')))
+        self.assertEqual(['v1'], self._search(('app_id', 'myapp'),
+                                              ('color', 'blue')))
+        self.assertEqual([], self._search(('app_id', 'nope')))
+
+    def test_search_key_only(self):
+        self.assertEqual(['v1', 'v3'], self._search(('color', None)))
+
+    def test_reindex_drops_stale_terms(self):
+        self.index.add('volumes', self._volume('v1', app_id='moved'))
+        self.assertEqual(['v2'], self._search(('app_id', 'myapp')))
+        self.index.remove('volumes', 'v2')
+        self.assertEqual([], self._search(('app_id', 'myapp')))
+
+    def test_facets_follow_changes(self):
+        self.assertEqual([('app_id', 3, [('myapp', 2), ('other', 1)]),
+                          ('color', 2, [('blue', 2)])],
+                         self.index.facets('volumes'))
+        self.index.add('volumes', self._volume('v1', app_id='other'))
+        self.index.remove('volumes', 'v3')
+        [(key, count, values)] = self.index.facets('volumes')
+        self.assertEqual(('app_id', 2, [('myapp', 1), ('other', 1)]),
+                         (key, count, sorted(values)))
+        self.assertEqual([], self.index.facets('images'))
+
+
+class ContainerSyncTests(test.TestCase):
+    def _listing(self, name, last_modified):
+        listing = mock.Mock(last_modified=last_modified)
+        listing.name = name
+        return listing
+
+    @mock.patch.object(sync.swift_helpers, 'swift_get_container_with_metadata')
+    @mock.patch.object(sync, '_iter_container_listing')
+    def test_only_changed_containers_are_fetched(self, mock_listing,
+                                                 mock_get_container):
+        mock_listing.return_value = [
+            self._listing('same', '2016-01-01T00:00:00'),
+            self._listing('changed', '2016-02-02T00:00:00'),
+            self._listing('new', '2016-02-02T00:00:00'),
+        ]
+        mark = {
+            'same': '2016-01-01T00:00:00',
+            'changed': '2016-01-01T00:00:00',
+            'gone': '2016-01-01T00:00:00',
+        }
+
+        changed, deleted, mark = sync._container_changes(self.request, mark)
+
+        self.assertEqual(['changed', 'new'],
+                         sorted(c[0][1] for c in
+                                mock_get_container.call_args_list))
+        self.assertEqual(['gone'], deleted)
+        self.assertEqual(['changed', 'new', 'same'], sorted(mark))
+
+    @mock.patch.object(sync, '_container_changes')
+    def test_partial_containers_keep_indexed_metadata(self, mock_changes):
+        engine = sync.SyncEngine(index.MetadataIndex())
+        looked_up = swift_helpers.Container({
+            'name': 'c1', 'metadata': {'app': 'web'}})
+        mock_changes.return_value = ([looked_up], [], {})
+        engine.full_sync(self.request, resources.CONTAINERS)
+
+        listed = mock.Mock(count=1, bytes=10)
+        listed.name = 'c1'
+        mock_changes.return_value = (
+            [swift_helpers.swift_get_container_from_listing(listed)], [], {})
+        engine.full_sync(self.request, resources.CONTAINERS)
+
+        [container] = engine.index.search(resources.CONTAINERS,
+                                          [('app', 'web')])
+        self.assertEqual('c1', container.name)
+
+
+class IndexRegistryTests(test.TestCase):
+    def test_least_recently_searched_projects_are_dropped(self):
+        self.request.user = mock.Mock(tenant_id='p1', services_region='r1')
+        with mock.patch.object(index, '_indexes',
+                               cache.MemoryBackend(max_entries=1)):
+            first = index.get_index(self.request)
+            self.assertIs(first, index.get_index(self.request))
+            self.request.user.services_region = 'r2'
+            index.get_index(self.request)
+            self.request.user.services_region = 'r1'
+            self.assertIsNot(first, index.get_index(self.request))
+
+    def test_engine_follows_its_index(self):
+        self.request.user = mock.Mock(tenant_id='p1', services_region='r1')
+        with mock.patch.object(index, '_indexes', cache.MemoryBackend()):
+            engine = sync.get_engine(self.request)
+            self.assertIs(index.get_index(self.request), engine.index)
+            index._indexes.clear()
+            self.assertIs(index.get_index(self.request),
+                          sync.get_engine(self.request).index)
+
+
+class TrigramIndexTests(test.TestCase):
+    def setUp(self):
+        super(TrigramIndexTests, self).setUp()
+        self.grams = ngram.TrigramIndex(max_length=20)
+        for text in ('compute-01.example.org', 'compute-02', 'Storage-01',
+                     'storage-01', 'db'):
+            self.grams.add(text)
+
+    def test_lookups_return_candidates(self):
+        self.assertIn('compute-02', self.grams.substring('ute-0'))
+        self.assertNotIn('db', self.grams.substring('ute-0'))
+        self.assertEqual(set(['Storage-01', 'storage-01',
+                              'compute-01.example.org']),
+                         self.grams.prefix('stor'))
+        self.assertIn('compute-02', self.grams.similar('compte-02', 1))
+        self.assertNotIn('storage-01', self.grams.similar('compte-02', 1))
+
+    def test_strings_are_reference_counted(self):
+        self.grams.add('compute-02')
+        self.grams.discard('compute-02')
+        self.assertIn('compute-02', self.grams.substring('compute'))
+        self.grams.discard('compute-02')
+        self.assertNotIn('compute-02', self.grams.substring('compute'))
+        self.assertEqual('storage-01',
+                         self.grams.ranked('storage-1')[0][0].lower())
+
+
+class PatternMatchTests(test.TestCase):
+    def setUp(self):
+        super(PatternMatchTests, self).setUp()
+        self.index = index.MetadataIndex()
+        self.index.update('volumes', [
+            records.Record('volumes', 'v%05d' % i, 'vol%d' % i,
+                           metadata={'host': 'compute-%05d' % i,
+                                     'env': ('prod', 'dev')[i % 2]})
+            for i in range(20000)])
+
+    def _match(self, filter_string):
+        [predicate] = query.parse(filter_string)
+        return self.index.match('volumes', predicate)
+
+    def test_substring_prefix_and_any_key(self):
+        self.assertEqual({'v04242': 1}, self._match('host~04242'))
+        self.assertEqual(10, len(self._match('host^=compute-0424')))
+        self.assertEqual({'v04242': 1}, self._match('*~e-04242'))
+        self.assertEqual(10000, len(self._match('env~ro')))
+
+    def test_fuzzy_matches_are_ranked(self):
+        matches = self._match('host%compute-04242')
+        self.assertEqual(0, matches['v04242'])
+        self.assertEqual(1, matches['v04243'])
+        self.assertNotIn('v05555', matches)
+
+
+class CacheTests(test.TestCase):
+    def test_memory_backend_evicts_least_recently_used(self):
+        backend = cache.MemoryBackend(max_entries=2)
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        backend.get('a')
+        backend.set('c', 3, 60)
+        self.assertEqual(1, backend.get('a'))
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(3, backend.get('c'))
+
+    def test_memory_backend_expires_entries(self):
+        backend = cache.MemoryBackend()
+        backend.set('a', 1, -1)
+        self.assertIsNone(backend.get('a'))
+
+    def test_memory_backend_never_evicts_counters(self):
+        backend = cache.MemoryBackend(max_entries=1)
+        backend.incr('generation')
+        backend.set('a', 1, 60)
+        backend.set('b', 2, 60)
+        self.assertEqual(1, backend.counter('generation'))
+
+    @mock.patch.object(cache, '_backend', cache.MemoryBackend())
+    def test_invalidate_drops_cached_pages(self):
+        self.request.user = mock.Mock(tenant_id='p1')
+        fetch = mock.Mock(return_value=(['v1'], False, False))
+
+        for i in range(2):
+            cache.get_or_fetch(self.request, 'volumes', None, '', fetch)
+        self.assertEqual(1, fetch.call_count)
+
+        cache.invalidate(self.request, 'volumes')
+        cache.get_or_fetch(self.request, 'volumes', None, '', fetch)
+        self.assertEqual(2, fetch.call_count)
+
+    @mock.patch.object(cache, '_backend', cache.MemoryBackend())
+    def test_regions_are_cached_apart(self):
+        fetch = mock.Mock(side_effect=['r1 page', 'r2 page'])
+        self.request.user = mock.Mock(tenant_id='p1', services_region='r1')
+        cache.get_or_fetch(self.request, 'volumes', None, 'regions', fetch)
+        self.request.user.services_region = 'r2'
+        self.assertEqual('r2 page', cache.get_or_fetch(
+            self.request, 'volumes', None, 'regions', fetch))
+        self.assertEqual(2, fetch.call_count)
+
+    def _wait_until(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def _run(self, outcomes, func):
+        """Starts func in a thread, appending its result or exception"""
+        def target():
+            try:
+                outcomes.append(func())
+            except Exception as e:
+                outcomes.append(e)
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @mock.patch.object(cache, '_backend', cache.MemoryBackend())
+    def test_concurrent_misses_share_one_fetch(self):
+        self.request.user = mock.Mock(tenant_id='p1')
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ['v1'], False
+
+        def get():
+            return cache.get_or_fetch(self.request, 'volumes', None, '',
+                                      fetch)
+
+        results = []
+        threads = [self._run(results, get)]
+        self.assertTrue(started.wait(5))
+        saved = cache.flights.saved
+        threads.extend(self._run(results, get) for i in range(3))
+        self._wait_until(lambda: cache.flights.saved >= saved + 3)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual([(['v1'], False)] * 4, results)
+        self.assertEqual(1, len(calls))
+
+    def test_single_flight_shares_errors(self):
+        flights = cache.SingleFlight()
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            raise ValueError('down')
+
+        outcomes = []
+        threads = [self._run(outcomes, lambda: flights.do('k', fetch))]
+        self._wait_until(lambda: flights._calls)
+        threads.append(self._run(outcomes, lambda: flights.do('k', fetch)))
+        self._wait_until(lambda: flights.saved)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual([ValueError] * 2, [type(o) for o in outcomes])
+        self.assertEqual({}, flights._calls)
+
+    def test_single_flight_waiters_give_up(self):
+        flights = cache.SingleFlight()
+        release = threading.Event()
+        outcomes = []
+        leader = self._run(outcomes, lambda: flights.do(
+            'k', lambda: release.wait(5) and 'leader'))
+        self._wait_until(lambda: flights._calls)
+
+        self.assertEqual('own', flights.do('k', lambda: 'own', timeout=0.01))
+        release.set()
+        leader.join(5)
+        self.assertEqual(['leader'], outcomes)
+
+
+class QueryTests(test.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            [query.Predicate('app_id', query.EQ, 'myapp'),
+             query.Predicate('color', query.NE, 'red'),
+             query.Predicate('name', query.CONTAINS, 'web'),
+             query.Predicate('backup', query.EXISTS, None)],
+            query.parse('app_id=myapp, color!=red name~web backup'))
+
+    def test_matches(self):
+        predicates = query.parse('app_id=myapp color!=red name~web')
+        self.assertTrue(query.matches(
+            {'app_id': 'myapp', 'name': 'web01'}, predicates))
+        self.assertFalse(query.matches(
+            {'app_id': 'myapp', 'name': 'web01', 'color': 'red'}, predicates))
+        self.assertFalse(query.matches({'app_id': 'myapp'}, predicates))
+
+    def test_parse_boolean_query(self):
+        self.assertEqual(
+            [query.Predicate('env', query.EQ, 'prod'),
+             query.Predicate('tier', query.IN, frozenset(['web', 'api'])),
+             query.Predicate(None, query.NOT, (
+                 query.Predicate('deprecated', query.EXISTS, None),))],
+            query.parse('env=prod AND tier IN (web,api) '
+                        'AND NOT has:deprecated'))
+
+    def test_keywords_ignore_case(self):
+        self.assertEqual(query.parse('env=prod OR NOT env=dev'),
+                         query.parse('env=prod or not env=dev'))
+        self.assertEqual([query.Predicate('and', query.EXISTS, None)],
+                         query.parse('"and"'))
+        self.assertEqual('"or"', query.quote('or'))
+
+    def test_and_term(self):
+        self.assertEqual('env=prod', query.and_term('', 'env', 'prod'))
+        self.assertEqual('(a=1 OR b=2) AND "my key"="say \\"hi\\""',
+                         query.and_term('a=1 OR b=2', 'my key', 'say "hi"'))
+        self.assertEqual(
+            [query.Predicate('my key', query.EQ, 'say "hi"')],
+            query.parse(query.and_term('', 'my key', 'say "hi"')))
+
+    def test_fuzzy_and_any_key(self):
+        self.assertEqual([query.Predicate('env', query.FUZZY, 'prdo')],
+                         query.parse('env%prdo'))
+        self.assertTrue(query.matches({'env': 'Prod'}, query.parse('env%prd')))
+        self.assertFalse(query.matches({'env': 'dev'}, query.parse('env%prd')))
+        self.assertTrue(query.matches({'a': 'x', 'b': 'build-42'},
+                                      query.parse('*~d-4')))
+        self.assertEqual(2, query.edit_distance('kitten', 'sittin', 2))
+        self.assertEqual(3, query.edit_distance('kitten', 'sitting', 2))
+
+    def test_percent_in_values(self):
+        self.assertEqual([query.Predicate('discount', query.EQ, '50%')],
+                         query.parse('discount=50%'))
+        self.assertEqual([query.Predicate('discount', query.FUZZY, '50%')],
+                         query.parse('discount%50%'))
+        self.assertEqual([query.Predicate('my key', query.FUZZY, 'prdo')],
+                         query.parse('"my key" %prdo'))
+        self.assertEqual([query.Predicate('env', query.FUZZY, 'prdo')],
+                         query.parse('env % prdo'))
+        self.assertEqual(
+            [query.Predicate('my%key', query.EQ, '50%')],
+            query.parse(query.and_term('', 'my%key', '50%')))
+        self.assertRaises(query.QueryError, query.parse, '%prdo')
+
+    def test_parse_errors(self):
+        for filter_string in ('a IN (b', '(a=1', 'a=1)', 'size>big',
+                              'name=~"("'):
+            self.assertRaises(query.QueryError, query.parse, filter_string)
+
+    @test.update_settings(METAFINDER_REGEX_MAX_LENGTH=20)
+    def test_regex_limits(self):
+        def term(pattern):
+            return 'name=~"%s"' % pattern.replace('\\', '\\\\')
+
+        for pattern in ('(a+)+$', '(x|(a*))*', '([ab]+){2,}', '(?:\\w+)+',
+                        'a{1,30}' * 4):
+            self.assertRaises(query.QueryError, query.parse, term(pattern))
+        for pattern in ('^web-[0-9]+$', '(ab)+', '(a+)?', '[(+]+',
+                        '[]+)]+', '\\(a+\\)+'):
+            self.assertEqual([query.Predicate('name', query.REGEX, pattern)],
+                             query.parse(term(pattern)))
+
+    def test_compiled_operators(self):
+        metadata = {'env': 'prod', 'tier': 'web', 'cpus': '8',
+                    'name': 'web-01'}
+        for filter_string, expected in (
+                ('env=prod OR env=dev', True),
+                ('NOT (env=prod tier=web)', False),
+                ('tier IN (api,db)', False),
+                ('name^=web- name=~"^web-[0-9]+$"', True),
+                ('cpus>=8 cpus<16', True),
+                ('cpus>8', False),
+                ('name>1', False),
+                ('"env"="prod"', True)):
+            self.assertEqual(expected, query.matches(
+                metadata, query.parse(filter_string)), filter_string)
+
+    def test_select_filters_rows(self):
+        predicates = query.parse('env=prod AND tier IN (web,api) '
+                                 'AND NOT has:deprecated AND cpus>=2')
+        rows = [fakes.FakeResource(metadata={
+                    'env': ('prod', 'dev')[i % 2],
+                    'tier': ('web', 'api', 'db')[i % 3],
+                    'cpus': str(i % 8)})
+                for i in range(1200)]
+        selected = list(query.select('volumes', rows, predicates))
+        self.assertEqual(300, len(selected))
+
+    def test_push_down_volumes(self):
+        filters, residual = query.push_down(
+            'volumes', query.parse('app_id=myapp name~web'))
+        self.assertEqual({'metadata': {'app_id': 'myapp'}}, filters)
+        self.assertEqual([query.Predicate('name', query.CONTAINS, 'web')],
+                         residual)
+
+    @test.update_settings(OPENSTACK_API_VERSIONS={'image': 2})
+    def test_push_down_images_v2(self):
+        filters, residual = query.push_down(
+            'images', query.parse('app_id=myapp'))
+        self.assertEqual({'app_id': 'myapp'}, filters)
+        self.assertEqual([], residual)
+
+    def test_push_down_instances_is_local(self):
+        predicates = query.parse('app_id=myapp')
+        self.assertEqual((None, predicates),
+                         query.push_down('instances', predicates))
+
+
+class SearchStreamTests(test.TestCase):
+    def _iter_resources(self, request, resource_type, filters=None):
+        if resource_type == 'volumes':
+            raise Exception('Cinder is down')
+        for i in range(3):
+            resource = mock.Mock(id='%s-%d' % (resource_type, i),
+                                 metadata={'app_id': 'app%d' % (i % 2)},
+                                 properties={'app_id': 'app0'})
+            resource.name = 'name-%d' % i
+            yield resource
+
+    def test_stream_matches_across_types(self):
+        with mock.patch.object(search.resources, 'iter_resources',
+                               self._iter_resources):
+            results = list(search.stream(self.request,
+                                         query.parse('app_id=app0')))
+
+        ids = sorted(r['id'] for r in results if r['type'] != 'error')
+        self.assertEqual(['images-0', 'images-1', 'images-2',
+                          'instances-0', 'instances-2',
+                          'name-0', 'name-2'], ids)
+        errors = [r for r in results if r['type'] == 'error']
+        self.assertEqual(['volumes'], [e['resource_type'] for e in errors])
+
+
+class MetadataRenderTests(test.TestCase):
+    def test_render_short_metadata(self):
+        self.assertEqual('app_id: myapp',
+                         tables.render_metadata({'app_id': 'myapp'}))
+
+    def test_render_truncates_long_metadata(self):
+        metadata = collections.OrderedDict(
+            ('key%d' % i, i) for i in range(5))
+        rendered = tables.render_metadata(metadata, limit=2)
+        self.assertTrue(rendered.startswith('key0: 0, key1: 1<span'))
+        self.assertIn('key2: 2, key3: 3, key4: 4</span>', rendered)
+        self.assertIn('(3 more)', rendered)
+
+    def test_render_escapes_truncated_metadata(self):
+        rendered = tables.render_metadata({'a': '<b>', 'c': 'd'}, limit=1)
+        self.assertNotIn('<b>', rendered)
+
+    @mock.patch.object(tables, 'render_metadata', return_value='rendered')
+    def test_memoized_per_revision(self, mock_render):
+        server = mock.Mock(spec=['id', 'metadata', 'updated'])
+        server.id = 's1'
+        server.metadata = {'a': 'b'}
+        server.updated = '1'
+        for i in range(3):
+            tables.metadata_dict_to_str(server)
+        self.assertEqual(1, mock_render.call_count)
+
+        server.updated = '2'
+        tables.metadata_dict_to_str(server)
+        self.assertEqual(2, mock_render.call_count)
+
+
+class FakeBackendsTests(test.TestCase):
+    def test_pages_through_every_resource(self):
+        backends = fakes.FakeBackends(count=45, page_size=20)
+        with backends.patch():
+            volumes = list(resources.iter_resources(self.request,
+                                                    resources.VOLUMES))
+        self.assertEqual(45, len(volumes))
+        self.assertEqual(3, backends.calls['cinder.volume_list_paged'])
+
+    def test_volume_metadata_filter(self):
+        backends = fakes.FakeBackends(count=250)
+        with backends.patch():
+            volumes = list(resources.iter_resources(
+                self.request, resources.VOLUMES,
+                filters={'metadata': {'app_id': 'app1'}}))
+        self.assertEqual(['volume-1', 'volume-101', 'volume-201'],
+                         [v.name for v in volumes])
+
+
+class MetricsTests(test.TestCase):
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        metrics.registry.clear()
+
+    @test.update_settings(METAFINDER_METRICS=False)
+    def test_disabled_records_nothing(self):
+        with metrics.timed(self.request, 'nova', 'instances') as timer:
+            timer.items = 3
+        self.assertEqual([], metrics.registry.snapshot())
+        self.assertEqual('', metrics.server_timing(self.request))
+
+    @test.update_settings(METAFINDER_METRICS=True)
+    def test_server_timing_sums_calls(self):
+        for i in range(2):
+            with metrics.timed(self.request, 'swift_head', 'containers'):
+                pass
+        with metrics.timed(self.request, 'nova', 'instances') as timer:
+            timer.items = 3
+        timing = metrics.server_timing(self.request)
+        self.assertIn('swift_head-containers;dur=', timing)
+        self.assertIn('desc="2 calls"', timing)
+        self.assertIn('nova-instances;dur=', timing)
+
+    @test.update_settings(METAFINDER_METRICS=True)
+    def test_prometheus_histogram(self):
+        metrics.record(None, metrics.Sample('glance', 'images', 0.2, 0, 5))
+        metrics.record(None, metrics.Sample('glance', 'images', 20, 0, 5))
+        text = metrics.prometheus_text()
+        labels = 'call="glance",resource_type="images"'
+        self.assertIn('metafinder_call_seconds_bucket{%s,le="0.1"} 0' %
+                      labels, text)
+        self.assertIn('metafinder_call_seconds_bucket{%s,le="0.25"} 1' %
+                      labels, text)
+        self.assertIn('metafinder_call_seconds_bucket{%s,le="+Inf"} 2' %
+                      labels, text)
+        self.assertIn('metafinder_call_items_total{%s} 10' % labels, text)
+        lines = text.splitlines()
+        # Every sample follows the # TYPE line of its own family.
+        self.assertEqual(
+            ['metafinder_call_seconds', 'metafinder_call_bytes_total',
+             'metafinder_call_items_total'],
+            [line.split()[2] for line in lines if line.startswith('#')])
+        self.assertEqual(
+            lines.index('# TYPE metafinder_call_items_total counter') + 1,
+            lines.index('metafinder_call_items_total{%s} 10' % labels))
+
+    @test.update_settings(METAFINDER_METRICS=True,
+                          METAFINDER_METRICS_HOOK='os.path.join')
+    def test_hook_is_imported_once(self):
+        self.addCleanup(setattr, metrics, '_hook', (None, None))
+        with mock.patch.object(metrics, 'import_string') as mock_import:
+            for i in range(3):
+                metrics.record(None, metrics.Sample('nova', 'instances',
+                                                    0.1, 0, 1))
+        self.assertEqual(1, mock_import.call_count)
+        self.assertEqual(3, mock_import.return_value.call_count)
+
+
+class PaginationTests(test.TestCase):
+    def setUp(self):
+        super(PaginationTests, self).setUp()
+        cache._backend = None
+        swift_helpers._revalidated = cache.MemoryBackend()
+        breaker._breakers.clear()
+        self.backends = fakes.FakeBackends(count=50, page_size=20)
+        patch = self.backends.patch()
+        patch.__enter__()
+        self.addCleanup(patch.__exit__, None, None, None)
+
+    def _page(self, resource_type, marker=None, prev_marker=None):
+        paginator = pagination.Paginator(self.request, resource_type)
+        items, has_more, has_prev = paginator.page(marker, prev_marker)
+        return [i.name for i in items], has_more, has_prev
+
+    def _wait_for_prefetch(self):
+        pagination._get_executor().shutdown(wait=True)
+        pagination._executor = None
+
+    def test_slice_page(self):
+        items = [self.backends.volume(i) for i in range(45)]
+
+        def page(marker=None, prev_marker=None):
+            shown, has_more, has_prev = pagination.slice_page(
+                'volumes', items, marker, prev_marker, limit=20)
+            return [shown[0].name, shown[-1].name], has_more, has_prev
+
+        self.assertEqual((['volume-0', 'volume-19'], True, False), page())
+        self.assertEqual((['volume-20', 'volume-39'], True, True),
+                         page('volume-00000019'))
+        self.assertEqual((['volume-40', 'volume-44'], False, True),
+                         page('volume-00000039'))
+        self.assertEqual((['volume-20', 'volume-39'], True, True),
+                         page(prev_marker='volume-00000040'))
+        self.assertEqual((['volume-0', 'volume-19'], True, False),
+                         page(prev_marker='volume-00000020'))
+        self.assertEqual((['volume-0', 'volume-19'], True, False),
+                         page('gone'))
+
+    @test.update_settings(METAFINDER_PREFETCH=False)
+    def test_next_and_previous(self):
+        names, has_more, has_prev = self._page('volumes')
+        self.assertEqual(('volume-0', 'volume-19'), (names[0], names[-1]))
+        self.assertEqual((True, False), (has_more, has_prev))
+
+        names, has_more, has_prev = self._page('volumes', 'volume-00000019')
+        self.assertEqual(('volume-20', 'volume-39'), (names[0], names[-1]))
+        self.assertEqual((True, True), (has_more, has_prev))
+
+        names, has_more, has_prev = self._page('volumes', 'volume-00000039')
+        self.assertEqual(10, len(names))
+        self.assertEqual((False, True), (has_more, has_prev))
+
+        names, has_more, has_prev = self._page(
+            'volumes', prev_marker='volume-00000040')
+        self.assertEqual(('volume-20', 'volume-39'), (names[0], names[-1]))
+        self.assertEqual((True, True), (has_more, has_prev))
+
+        names, has_more, has_prev = self._page(
+            'volumes', prev_marker='volume-00000020')
+        self.assertEqual('volume-0', names[0])
+        self.assertEqual((True, False), (has_more, has_prev))
+        # Going back is served from the page cache.
+        self.assertEqual(3, self.backends.calls['cinder.volume_list_paged'])
+
+    @test.update_settings(METAFINDER_PREFETCH=False, METAFINDER_PAGE_SIZE=5)
+    def test_container_pages_are_cut_from_listing(self):
+        names, has_more, has_prev = self._page('containers')
+        self.assertEqual(['container-%08d' % i for i in range(5)], names)
+        self.assertTrue(has_more)
+        self.assertEqual(5, self.backends.calls['swift.head_container'])
+
+    @test.update_settings(METAFINDER_PREFETCH=False, METAFINDER_PAGE_SIZE=5)
+    def test_unchanged_containers_are_not_looked_up_again(self):
+        self._page('containers')
+        cache._backend = None
+        names, has_more, has_prev = self._page('containers')
+        self.assertEqual(['container-%08d' % i for i in range(5)], names)
+        self.assertEqual(5, self.backends.calls['swift.head_container'])
+
+        swift_helpers.forget_container(self.request, 'container-00000001')
+        cache._backend = None
+        self._page('containers')
+        self.assertEqual(6, self.backends.calls['swift.head_container'])
+
+    @test.update_settings(METAFINDER_PREFETCH=True)
+    def test_next_page_is_prefetched(self):
+        self._page('images')
+        self._wait_for_prefetch()
+        self.assertEqual(2, self.backends.calls['glance.image_list_detailed'])
+
+        names, has_more, has_prev = self._page('images', 'image-00000019')
+        self._wait_for_prefetch()
+        self.assertEqual('image-20', names[0])
+        # The second page came from the prefetch, only the third is new.
+        self.assertEqual(3, self.backends.calls['glance.image_list_detailed'])
+
+    def test_prefetch_runs_without_the_request(self):
+        requests = []
+
+        def lister(request, marker=None, filters=None):
+            requests.append(request)
+            return [self.backends.volume(len(requests))], True, False
+
+        pagination.Paginator(self.request, 'volumes', 'detached',
+                             lister=lister).page()
+        self._wait_for_prefetch()
+        self.assertIs(self.request, requests[0])
+        self.assertIsInstance(requests[1], workers.DetachedRequest)
+        self.assertIs(self.request.user, requests[1].user)
+
+    @test.update_settings(METAFINDER_PREFETCH=False,
+                          METAFINDER_BREAKER_FAILURES=1)
+    def test_last_good_page_is_served_when_service_is_down(self):
+        names = self._page('volumes')[0]
+        cache.invalidate(self.request, 'volumes')
+        self.backends.latency = 0.5
+
+        timeouts = {'cinder': 0.1}
+        with test.update_settings(METAFINDER_BACKEND_TIMEOUTS=timeouts):
+            paginator = pagination.Paginator(self.request, 'volumes')
+            items = paginator.page()[0]
+        self.assertTrue(paginator.stale)
+        self.assertEqual(names, [i.name for i in items])
+
+        # The breaker is open, nothing more is asked of Cinder.
+        calls = self.backends.calls.copy()
+        paginator = pagination.Paginator(self.request, 'volumes',
+                                         filter_string='other')
+        self.assertRaises(breaker.Unavailable, paginator.page)
+        self.assertEqual(calls, self.backends.calls)
+
+
+class CircuitBreakerTests(test.TestCase):
+    def setUp(self):
+        super(CircuitBreakerTests, self).setUp()
+        breaker._breakers.clear()
+
+    def test_opens_after_failures_and_probes_after_cooldown(self):
+        circuit = breaker.CircuitBreaker(failures=2, cooldown=60)
+        circuit.failed()
+        self.assertTrue(circuit.allow())
+        circuit.failed()
+        self.assertFalse(circuit.allow())
+
+        circuit._opened_at -= 60
+        self.assertTrue(circuit.allow())
+        self.assertFalse(circuit.allow())
+        circuit.succeeded()
+        self.assertEqual(breaker.CLOSED, circuit.state)
+
+    @test.update_settings(METAFINDER_BREAKER_FAILURES=1)
+    def test_client_errors_do_not_open_the_breaker(self):
+        self.request.user = mock.Mock(services_region='r1')
+        error = Exception('not found')
+        error.code = 404
+
+        def not_found():
+            raise error
+
+        self.assertRaises(Exception, breaker.call, self.request, 'nova',
+                          not_found)
+        self.assertEqual(breaker.CLOSED,
+                         breaker.get_breaker(self.request, 'nova').state)
+
+    def test_only_server_and_connection_errors_are_outages(self):
+        class ConnectFailure(Exception):
+            pass
+
+        server_error = Exception('unavailable')
+        server_error.http_status = 503
+        self.assertTrue(breaker.is_outage(server_error))
+        self.assertTrue(breaker.is_outage(ConnectFailure()))
+        self.assertFalse(breaker.is_outage(KeyError('id')))
+        self.assertFalse(breaker.is_outage(AttributeError('name')))
+
+    def test_refresh_runs_once_per_type(self):
+        started = threading.Event()
+        release = threading.Event()
+        engine = sync.SyncEngine(mock.Mock())
+
+        def refresh(request, resource_type):
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(engine, 'refresh',
+                               side_effect=refresh) as mock_refresh:
+            first = engine.refresh_async(self.request, resources.IMAGES)
+            started.wait(5)
+            second = engine.refresh_async(self.request, resources.IMAGES)
+            release.set()
+            first.result(5)
+        self.assertIs(first, second)
+        self.assertEqual(1, mock_refresh.call_count)
+
+    def test_spent_budget_skips_the_call(self):
+        func = mock.Mock()
+        self.assertRaises(breaker.Unavailable, breaker.call, self.request,
+                          'glance', func, breaker.Budget(-1))
+        self.assertFalse(func.called)
+
+
+class RecordTests(test.TestCase):
+    def test_compact_keeps_displayed_fields(self):
+        backends = fakes.FakeBackends(count=2)
+        record = records.compact(resources.INSTANCES, backends.instance(1))
+        self.assertEqual('instance-00000001', record.id)
+        self.assertEqual('bench', record.tenant_id)
+        self.assertEqual('cirros', record.image_name)
+        self.assertIsNone(getattr(record, 'OS-EXT-STS:task_state'))
+        self.assertEqual(backends.metadata(1), record.metadata)
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertFalse(hasattr(record, 'flavor'))
+
+        image = records.compact(resources.IMAGES, backends.image(1))
+        self.assertEqual(backends.metadata(1), image.properties)
+        self.assertEqual('bench', image.owner)
+
+    def test_row_actions_read_compacted_fields(self):
+        backends = fakes.FakeBackends(count=1)
+        instance = records.compact(resources.INSTANCES, backends.instance(1))
+        self.assertEqual('nova', instance.availability_zone)
+        self.assertTrue(tables.StopInstance().allowed(self.request, instance))
+        self.assertFalse(tables.StartInstance().allowed(self.request,
+                                                        instance))
+
+        volume = backends.volume(1)
+        volume.status = 'awaiting-transfer'
+        volume.transfer = fakes.FakeResource(id='t1', name='move')
+        record = records.compact(resources.VOLUMES, volume)
+        self.assertTrue(tables.DeleteTransfer().allowed(self.request, record))
+        self.assertEqual('t1', record.transfer.id)
+
+    @mock.patch.object(records, '_image_names', cache.MemoryBackend())
+    def test_image_names_are_looked_up_once(self):
+        self.request.user = mock.Mock(tenant_id='p1', services_region='r1')
+        servers = [mock.Mock(image={'id': 'i%d' % (i % 2)})
+                   for i in range(4)]
+
+        def get_image(request, image_id):
+            image = mock.Mock()
+            image.name = 'name-' + image_id
+            return image
+        with mock.patch.object(records.api.glance, 'image_get',
+                               side_effect=get_image) as image_get:
+            self.assertEqual({'i0': 'name-i0', 'i1': 'name-i1'},
+                             records._get_image_names(self.request, servers))
+            records._get_image_names(self.request, servers)
+        self.assertEqual(2, image_get.call_count)
+
+    def test_metadata_keys_are_shared(self):
+        first, second = [records.Record('volumes', str(i), 'v',
+                                        metadata={'app_' + 'id': i})
+                         for i in range(2)]
+        self.assertIs(list(first.metadata)[0], list(second.metadata)[0])
+
+    def test_pickles(self):
+        record = records.Record('images', 'i1', 'one', 'p1',
+                                metadata={'a': 'b'}, protected=True)
+        copy = pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(('i1', 'p1', {'a': 'b'}, True),
+                         (copy.id, copy.owner, copy.properties,
+                          copy.protected))
+
+
+class SnapshotStoreTests(test.TestCase):
+    def setUp(self):
+        super(SnapshotStoreTests, self).setUp()
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.store = snapshot.SnapshotStore(os.path.join(tmp, 'snap.db'))
+        self.store.replace('volumes', 'r1', [
+            records.Record('volumes', 'v%d' % i, 'vol%d' % i,
+                           'p1' if i < 5 else 'p2', 'available', None,
+                           {'app_id': 'app%d' % (i % 2), 'n': str(i)})
+            for i in range(8)])
+
+    def _page(self, *args, **kwargs):
+        records, has_more, has_prev = self.store.page('volumes', 'r1', 'p1',
+                                                      *args, **kwargs)
+        return [r.id for r in records], has_more, has_prev
+
+    def test_pages_forward_and_back(self):
+        self.assertEqual((['v0', 'v1'], True, False), self._page(limit=2))
+        self.assertEqual((['v2', 'v3'], True, True),
+                         self._page(marker='v1', limit=2))
+        self.assertEqual((['v4'], False, True),
+                         self._page(marker='v3', limit=2))
+        self.assertEqual((['v2', 'v3'], True, True),
+                         self._page(prev_marker='v4', limit=2))
+        self.assertEqual((['v0', 'v1'], True, False),
+                         self._page(prev_marker='v2', limit=2))
+
+    def test_predicates(self):
+        self.assertEqual((['v1', 'v3'], False, False),
+                         self._page(query.parse('app_id=app1')))
+        self.assertEqual((['v3'], False, False),
+                         self._page(query.parse('app_id=app1 n~3')))
+
+    def test_replace_and_freshness(self):
+        self.assertIsNone(self.store.crawled_at('images', 'r1', 'p1'))
+        self.assertIsNotNone(self.store.crawled_at('volumes', 'r1', 'p1'))
+        self.store.replace('volumes', 'r1', [])
+        self.assertEqual(([], False, False), self._page())
+
+    def test_projects_see_public_and_shared_images(self):
+        self.store.replace('images', 'r1', [
+            records.Record('images', 'own', 'a', 'p1', visibility='private'),
+            records.Record('images', 'public', 'b', 'p2',
+                           visibility='public'),
+            records.Record('images', 'shared', 'c', 'p2',
+                           visibility='shared'),
+            records.Record('images', 'other', 'd', 'p2',
+                           visibility='shared'),
+        ], members=[('shared', 'p1'), ('other', 'p3')])
+        images, has_more, has_prev = self.store.page('images', 'r1', 'p1')
+        self.assertEqual(['own', 'public', 'shared'], [i.id for i in images])
+
+    def test_row_action_fields_are_kept(self):
+        self.store.put('images', 'r1', [records.Record(
+            'images', 'i1', 'one', 'p1', 'active', protected=True,
+            container_format='bare')])
+        # Notifications do not carry every field.
+        self.store.update('images', 'r1', 'i1', {'name': 'renamed'})
+        [image], has_more, has_prev = self.store.page('images', 'r1', 'p1')
+        self.assertEqual('renamed', image.name)
+        self.assertTrue(image.protected)
+        self.assertEqual('bare', image.container_format)
+
+        self.store.put('volumes', 'r1', [records.Record(
+            'volumes', 'v1', 'vol1', 'p1', 'awaiting-transfer',
+            transfer=records.Transfer('t1', 'move'))])
+        [volume] = [v for v in self.store.page('volumes', 'r1', 'p1')[0]
+                    if v.id == 'v1']
+        self.assertEqual('t1', volume.transfer.id)
+
+    def test_regions_are_kept_apart(self):
+        self.store.replace('volumes', 'r2', [
+            records.Record('volumes', 'v0', 'elsewhere', 'p1')])
+        self.assertIsNone(self.store.crawled_at('images', 'r2', 'p1'))
+        self.assertEqual((['v0', 'v1'], True, False), self._page(limit=2))
+        [volume], has_more, has_prev = self.store.page('volumes', 'r2', 'p1')
+        self.assertEqual('elsewhere', volume.name)
+
+        self.store.replace('volumes', 'r2', [])
+        self.assertEqual((['v0', 'v1'], True, False), self._page(limit=2))
+
+    def test_older_snapshots_are_rebuilt(self):
+        with self.store._connect() as db:
+            db.execute('PRAGMA user_version = 1')
+        store = snapshot.SnapshotStore(self.store.path)
+        self.assertIsNone(store.crawled_at('volumes', 'r1', 'p1'))
+        self.assertEqual(([], False, False), store.page('volumes', 'r1', 'p1'))
+
+
+class NotificationTests(test.TestCase):
+    def setUp(self):
+        super(NotificationTests, self).setUp()
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.store = snapshot.SnapshotStore(os.path.join(tmp, 'snap.db'))
+        self.store.replace('volumes', 'r1', [
+            records.Record('volumes', 'v1', 'vol1', 'p1', 'available', None,
+                           {'app_id': 'app1'})])
+        self.transport = notifications.MemoryTransport()
+        self.listener = notifications.Listener(self.store, self.transport,
+                                               'r1')
+        self.listener.start()
+
+    def _ids(self, resource_type, filter_string=''):
+        found = self.store.page(resource_type, 'r1', 'p1',
+                                query.parse(filter_string))[0]
+        return [r.id for r in found]
+
+    def _volume(self, event_type, **metadata):
+        self.transport.publish(event_type, {
+            'volume_id': 'v2', 'tenant_id': 'p1', 'display_name': 'vol2',
+            'status': 'available',
+            'metadata': [{'key': k, 'value': v}
+                         for k, v in metadata.items()]})
+
+    def test_changes_are_applied_as_they_arrive(self):
+        self._volume('volume.create.end', app_id='app2')
+        self.assertEqual(['v2'], self._ids('volumes', 'app_id=app2'))
+        self._volume('volume.update.end', app_id='app3')
+        self.assertEqual([], self._ids('volumes', 'app_id=app2'))
+        self.assertEqual(['v2'], self._ids('volumes', 'app_id=app3'))
+        self._volume('volume.delete.end')
+        self.assertEqual(['v1'], self._ids('volumes'))
+
+        self.transport.publish('image.update', {
+            'id': 'i1', 'owner': 'p1', 'name': 'img', 'status': 'active',
+            'properties': {'os_distro': 'ubuntu'}})
+        self.transport.publish('instance.create.end', {
+            'nova_object.data': {'uuid': 's1', 'tenant_id': 'p1',
+                                 'display_name': 'web', 'state': 'active',
+                                 'metadata': {'role': 'web'}}})
+        self.assertEqual(['i1'], self._ids('images', 'os_distro=ubuntu'))
+        self.assertEqual(['s1'], self._ids('instances', 'role=web'))
+        self.assertEqual(5, self.listener.applied)
+
+    def test_events_about_anything_else_are_ignored(self):
+        self.assertIsNone(notifications.parse('volume.create.start',
+                                              {'volume_id': 'v3'}))
+        self.assertIsNone(notifications.parse('identity.project.created',
+                                              {'resource_info': 'p1'}))
+        self.assertIsNone(notifications.parse('image.send',
+                                              {'image_id': 'i1'}))
+
+    def test_notifications_keep_what_the_crawl_filled_in(self):
+        self.store.replace('images', 'r1', [
+            records.Record('images', 'i1', 'img', 'p1', 'active', None,
+                           {'os_distro': 'ubuntu'}, visibility='shared',
+                           protected=True)], members=[('i1', 'p2')])
+        self.store.replace('instances', 'r1', [
+            records.Record('instances', 's1', 'web', 'p1', 'ACTIVE',
+                           image_name='ubuntu', key_name='key1',
+                           task_state='powering-off')])
+
+        self.transport.publish('image.update', {'id': 'i1', 'name': 'img2',
+                                                'status': 'active'})
+        self.transport.publish('instance.update', {
+            'nova_object.data': {'uuid': 's1', 'state': 'stopped',
+                                 'task_state': None,
+                                 'power_state': 'shutdown'}})
+
+        [image] = self.store.page('images', 'r1', 'p2')[0]
+        self.assertEqual('img2', image.name)
+        self.assertEqual({'os_distro': 'ubuntu'}, image.metadata)
+        self.assertEqual('shared', image.visibility)
+        self.assertTrue(image.protected)
+        [instance] = self.store.page('instances', 'r1', 'p1')[0]
+        self.assertEqual('STOPPED', instance.status)
+        self.assertEqual('ubuntu', instance.image_name)
+        self.assertEqual('key1', instance.key_name)
+        self.assertIsNone(instance.task_state)
+        self.assertEqual(4, instance.power_state)
+
+    def test_task_state_of_legacy_and_versioned_payloads(self):
+        legacy = notifications.parse('compute.instance.update', {
+            'instance_id': 's1', 'state_description': 'rebooting'})
+        versioned = notifications.parse('instance.update', {
+            'nova_object.data': {'uuid': 's1', 'task_state': 'rebooting',
+                                 'state_description': ''}})
+        self.assertEqual('rebooting', legacy.fields['task_state'])
+        self.assertEqual('rebooting', versioned.fields['task_state'])
+
+    @mock.patch.object(notifications.crawler, 'crawl')
+    def test_reconcile_replays_changes_made_during_the_crawl(self, crawl):
+        def stale_crawl(request, store, resource_type):
+            self._volume('volume.create.end', app_id='app2')
+            store.replace(resource_type, 'r1', [])
+            return 0
+        crawl.side_effect = stale_crawl
+
+        self.request.user = mock.Mock(services_region='r1')
+        self.listener.reconcile(self.request, 'volumes')
+        self.assertEqual(['v2'], self._ids('volumes'))
+
+
+class AdminSearchTests(test.TestCase):
+    def _volumes(self, request, project_id, filters):
+        if project_id == 'broken':
+            raise Exception('boom')
+        volumes = []
+        for name in ('b-%s' % project_id, 'a-%s' % project_id):
+            volume = mock.Mock(id=name, metadata={'owner': 'teamX'})
+            volume.name = name
+            volumes.append(volume)
+        return volumes
+
+    def test_merges_projects_in_name_order(self):
+        with mock.patch.dict(admin_search.LISTERS,
+                             {'volumes': self._volumes}):
+            results = admin_search.search(
+                self.request, query.parse('owner=teamX'), ['volumes'],
+                regions=[self.request.user.services_region],
+                project_ids=['p2', 'broken', 'p1'])
+
+        self.assertEqual(['a-p1', 'a-p2', 'b-p1', 'b-p2', None],
+                         [r.get('name') for r in results])
+        self.assertEqual(['p1', 'p2', 'p1', 'p2', 'broken'],
+                         [r['project_id'] for r in results])
+        self.assertEqual('error', results[-1]['type'])
+
+    @test.update_settings(API_RESULT_LIMIT=20)
+    @mock.patch.object(admin_search, '_swift_connection')
+    def test_container_lookups_do_not_share_connections(self,
+                                                        mock_connection):
+        busy = set()
+        shared = []
+
+        def head_container(connection, name):
+            if connection in busy:
+                shared.append(name)
+            busy.add(connection)
+            time.sleep(0.01)
+            busy.discard(connection)
+            return {'x-container-meta-app-id': name}
+
+        def connect(request, project_id):
+            connection = mock.Mock()
+            connection.get_account.return_value = (
+                {}, [{'name': 'c%d' % i} for i in range(20)])
+            connection.head_container.side_effect = (
+                lambda name: head_container(connection, name))
+            return connection
+        mock_connection.side_effect = connect
+
+        containers = list(admin_search._containers(self.request, 'p1', None))
+        self.assertEqual(20, len(containers))
+        self.assertEqual([], shared)
+
+
+class ExportTests(test.TestCase):
+    def _results(self):
+        yield {'type': 'volumes', 'id': 'v1', 'name': 'one',
+               'metadata': {'app_id': 'a', 'color': 'blue'}}
+        yield {'type': 'volumes', 'id': 'v2', 'name': 'two, "quoted"',
+               'metadata': {'app_id': 'b', 'late': 'x'}}
+
+    @test.update_settings(METAFINDER_EXPORT_SAMPLE_SIZE=1)
+    def test_csv_columns_from_sample(self):
+        lines = list(export.csv_lines(self._results()))
+        self.assertEqual(3, len(lines))
+        self.assertEqual('type,id,name,project_id,region,resource_type,'
+                         'message,metadata.app_id,metadata.color,'
+                         'other_metadata\r\n', lines[0])
+        self.assertEqual('volumes,v1,one,,,,,a,blue,\r\n', lines[1])
+        self.assertEqual('volumes,v2,"two, ""quoted""",,,,,b,,'
+                         '"{""late"": ""x""}"\r\n', lines[2])
+
+    def test_csv_header_from_keys_comes_first(self):
+        results = mock.MagicMock()
+        results.__iter__.return_value = self._results()
+        lines = export.csv_lines(results, ['color'])
+        self.assertTrue(next(lines).endswith(
+            'metadata.color,other_metadata\r\n'))
+        self.assertFalse(results.__iter__.called)
+        self.assertEqual('volumes,v1,one,,,,,blue,"{""app_id"": ""a""}"\r\n',
+                         next(lines))
+        self.assertEqual(['app_id', 'color', 'env'], query.named_keys(
+            query.parse('(color=blue OR env~prod) NOT has:app_id *~x')))
+
+    def test_csv_is_lazy(self):
+        results = mock.MagicMock()
+        results.__iter__.return_value = iter([])
+        lines = export.csv_lines(results)
+        self.assertFalse(results.__iter__.called)
+        list(lines)
+        self.assertTrue(results.__iter__.called)
+
+    def test_jsonl_flattens_metadata(self):
+        lines = list(export.jsonl_lines(self._results()))
+        self.assertEqual('{"id": "v1", "metadata.app_id": "a", '
+                         '"metadata.color": "blue", "name": "one", '
+                         '"type": "volumes"}\n', lines[0])
+
+
+class SwiftConnectionPoolTests(test.TestCase):
+    def test_connections_are_reused(self):
+        factory = mock.Mock(side_effect=lambda: mock.Mock())
+        pool = swift_helpers.ConnectionPool(factory, 2)
+
+        def head(name):
+            with pool.connection() as conn:
+                time.sleep(0.01)
+                return conn
+        conns = workers.bounded_map(head, range(20), lambda i, e: None,
+                                    max_workers=8)
+
+        self.assertEqual(2, factory.call_count)
+        self.assertEqual(2, len(set(id(c) for c in conns)))
+
+    @mock.patch.object(swift_helpers, 'swift_api')
+    def test_one_pool_per_request(self, mock_swift_api):
+        mock_swift_api.return_value.head_container.return_value = {}
+        for name in ('c1', 'c2', 'c3'):
+            swift_helpers.swift_get_container_with_metadata(self.request,
+                                                            name)
+        self.assertEqual(1, mock_swift_api.call_count)
+        self.assertEqual(3, mock_swift_api.return_value.head_container
+                         .call_count)
+
+
+class ObjectSearchTests(test.TestCase):
+    def setUp(self):
+        super(ObjectSearchTests, self).setUp()
+        self.listing = {
+            'c1': ['logs/a', 'logs/b', 'web/c'],
+            'c2': ['logs/d'],
+        }
+
+        def list_objects(request, container_name, marker=None, prefix=None,
+                         limit=None):
+            names = [n for n in self.listing[container_name]
+                     if n.startswith(prefix or '') and
+                     (marker is None or n > marker)]
+            return names[:2], len(names) > 2
+
+        def head(request, container_name, name):
+            return swift_helpers.SwiftObject({
+                'name': name, 'container_name': container_name,
+                'metadata': {'kind': name.split('/')[0]}})
+
+        for name, func in (('swift_list_objects', list_objects),
+                           ('swift_get_object_with_metadata', head)):
+            patcher = mock.patch.object(swift_helpers, name,
+                                        side_effect=func)
+            setattr(self, 'mock_' + name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def _search(self, filter_string, marker=None):
+        return [o.id for o in objects.search(
+            self.request, query.parse(filter_string), marker)]
+
+    def test_matches_across_listing_pages(self):
+        self.assertEqual(['c1/logs/a', 'c1/logs/b', 'c2/logs/d'],
+                         self._search('container:c1 container:c2 '
+                                      'kind=logs'))
+
+    def test_prefix_narrows_candidates(self):
+        self.assertEqual(['c1/web/c'],
+                         self._search('container:c1 prefix:web kind=web'))
+        self.assertEqual(1, self.mock_swift_get_object_with_metadata
+                         .call_count)
+
+    def test_resumes_after_marker(self):
+        self.assertEqual(['c1/web/c', 'c2/logs/d'],
+                         self._search('container:c1 container:c2 has:kind',
+                                      marker='c1/logs/b'))
+
+    def test_list_objects_needs_a_filter(self):
+        self.assertEqual(([], False, False),
+                         objects.list_objects(self.request))
+        items, has_more, has_prev = objects.list_objects(
+            self.request, filters=query.parse('container:c1 has:kind'),
+            limit=2)
+        self.assertEqual(['c1/logs/a', 'c1/logs/b'], [o.id for o in items])
+        self.assertTrue(has_more)
+
+    @test.update_settings(METAFINDER_OBJECT_SCAN_LIMIT=3)
+    def test_scan_stops_at_the_limit(self):
+        self.assertEqual(['c1/logs/a', 'c1/logs/b'],
+                         self._search('container:c1 container:c2 '
+                                      'kind=logs'))
+        self.assertEqual(3, self.mock_swift_get_object_with_metadata
+                         .call_count)
+
+
+@test.update_settings(METAFINDER_FACETS=False)
+class TabLoadingTests(test.TestCase):
+    def setUp(self):
+        super(TabLoadingTests, self).setUp()
+        patcher = mock.patch.object(tabs.PagedTableMixin, '_get_resources',
+                                    side_effect=self._get_resources)
+        self.mock_get_resources = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.slow = ()
+
+    def _get_resources(self, resource_type):
+        if resource_type in self.slow:
+            time.sleep(0.5)
+        return []
+
+    def _loaded(self, tab_group):
+        return sorted(slug for slug, tab in tab_group._tabs.items()
+                      if tab.data_loaded)
+
+    def test_lazy_by_default(self):
+        self.assertEqual(tabs.LAZY, tabs.get_tab_loading())
+        tab_group = tabs.MetaFinderTabs(self.request)
+        tab_group.load_tab_data()
+        self.assertEqual(['instances_tab'], self._loaded(tab_group))
+
+    @test.update_settings(METAFINDER_TAB_LOADING=tabs.PARALLEL)
+    def test_parallel_loads_the_tabs_allowed(self):
+        with mock.patch.object(tabs.ContainerTab, 'allowed',
+                               return_value=False):
+            tab_group = tabs.MetaFinderTabs(self.request)
+        tab_group.load_tab_data()
+        self.assertEqual(['images_tab', 'instances_tab', 'objects_tab',
+                          'volumes_tab'], self._loaded(tab_group))
+        self.assertEqual(3, self.mock_get_resources.call_count)
+
+    @test.update_settings(METAFINDER_TAB_LOADING=tabs.PARALLEL,
+                          METAFINDER_TAB_TIMEOUT=0.1)
+    @mock.patch.object(tabs, 'messages')
+    def test_parallel_tab_past_timeout_is_empty(self, mock_messages):
+        self.slow = (resources.VOLUMES,)
+        tab_group = tabs.MetaFinderTabs(self.request)
+        tab_group.load_tab_data()
+        volumes = tab_group.get_tab('volumes_tab')
+        self.assertTrue(volumes.data_loaded)
+        self.assertEqual([], volumes._data['volumes_table'].data)
+        self.assertEqual(1, mock_messages.warning.call_count)
+
+    @mock.patch.object(tables, 'reverse', return_value='/metafinder/')
+    def test_tab_content_view_renders_one_tab(self, mock_reverse):
+        view = views.TabContentView.as_view()
+        response = view(self.factory.get('/tabs/containers_tab/'),
+                        tab_slug='containers_tab')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('id="containers"', response.content.decode('utf-8'))
+        self.mock_get_resources.assert_called_once_with(
+            resources.CONTAINERS)
+
+        self.assertRaises(views.http.Http404, view,
+                          self.factory.get('/tabs/nope/'), tab_slug='nope')
+
+
+@test.update_settings(ROOT_URLCONF='metasearchdashboard.metafinder.urls')
+class SearchViewTests(test.TestCase):
+    def setUp(self):
+        super(SearchViewTests, self).setUp()
+        self.results = [{'type': 'volumes', 'id': 'v1', 'name': 'one',
+                         'metadata': {'app_id': 'a'}}]
+        patcher = mock.patch.object(views.search, 'stream',
+                                    side_effect=self._results)
+        self.mock_stream = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(views.admin_search, 'search',
+                                    side_effect=self._results)
+        self.mock_admin_search = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _results(self, *args, **kwargs):
+        return iter(self.results)
+
+    def _get(self, path, **params):
+        response = self.client.get(path, params)
+        content = b''.join(response.streaming_content if response.streaming
+                           else [response.content])
+        return response, content.decode('utf-8')
+
+    def test_search_streams_results(self):
+        response, content = self._get('/search/', q='app_id=a',
+                                      types='volumes')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        self.assertEqual('{"type": "volumes", "id": "v1", "name": "one", '
+                         '"metadata": {"app_id": "a"}}\n', content)
+        args = self.mock_stream.call_args[0]
+        self.assertEqual(query.parse('app_id=a'), args[1])
+        self.assertEqual(['volumes'], args[2])
+
+        response, content = self._get('/search/', format='json')
+        self.assertEqual(json.loads(content), self.results)
+        self.assertEqual(list(resources.RESOURCE_TYPES),
+                         self.mock_stream.call_args[0][2])
+
+    def test_invalid_searches_are_rejected(self):
+        for params in ({'q': '%prdo'}, {'format': 'xml'},
+                       {'types': 'volumes,nope'}):
+            response, content = self._get('/search/', **params)
+            self.assertEqual(400, response.status_code)
+        self.assertFalse(self.mock_stream.called)
+
+    def test_all_projects_is_for_admins_only(self):
+        for path in ('/search/', '/export/'):
+            response, content = self._get(path, all_projects='1')
+            self.assertEqual(403, response.status_code)
+        self.assertFalse(self.mock_admin_search.called)
+        self.assertFalse(self.mock_stream.called)
+
+        self.user.is_superuser = True
+        self.user.save()
+        response, content = self._get('/search/', all_projects='1',
+                                      types='volumes', regions='r1,r2')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['v1'], [json.loads(line)['id']
+                                  for line in content.splitlines()])
+        self.assertEqual(['r1', 'r2'],
+                         self.mock_admin_search.call_args[0][3])
+        response, content = self._get('/search/', all_projects='1',
+                                      types='objects')
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(self.mock_stream.called)
+
+    def test_export_is_an_attachment(self):
+        response, content = self._get('/export/', q='app_id=a',
+                                      types='volumes')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/csv', response['Content-Type'])
+        self.assertEqual('attachment; filename="metafinder-volumes.csv"',
+                         response['Content-Disposition'])
+        self.assertEqual(['type,id,name,project_id,region,resource_type,'
+                          'message,metadata.app_id,other_metadata',
+                          'volumes,v1,one,,,,,a,'], content.splitlines())
+
+        response, content = self._get('/export/', format='ndjson',
+                                      types='volumes')
+        self.assertEqual('attachment; filename="metafinder-volumes.jsonl"',
+                         response['Content-Disposition'])
+
+    @mock.patch.object(views.index, 'get_facets',
+                       return_value=[('app_id', 2, [('a', 2)])])
+    def test_facets(self, mock_get_facets):
+        response, content = self._get('/facets/', types='volumes', keys='5')
+        self.assertEqual({'volumes': [{'key': 'app_id', 'count': 2,
+                                       'values': [{'value': 'a',
+                                                   'count': 2}]}]},
+                         json.loads(content))
+        self.assertEqual(('volumes', 5, 0), mock_get_facets.call_args[0][1:])
+        for params in ({'types': 'nope'}, {'keys': 'many'}):
+            response, content = self._get('/facets/', **params)
+            self.assertEqual(400, response.status_code)
+
+    @mock.patch.object(views.index, 'get_index')
+    def test_suggestions(self, mock_get_index):
+        mock_get_index.return_value.suggest.return_value = (
+            [('app_id', 0.5)], [('app1', 0.25)])
+        response, content = self._get('/suggest/', type='volumes', q='ap')
+        self.assertEqual({'keys': [{'key': 'app_id', 'score': 0.5}],
+                          'values': [{'value': 'app1', 'score': 0.25}]},
+                         json.loads(content))
+        mock_get_index.return_value.suggest.assert_called_once_with(
+            'volumes', 'ap', 10)
+        for params in ({'type': 'nope'}, {'type': 'volumes', 'limit': 'x'}):
+            response, content = self._get('/suggest/', **params)
+            self.assertEqual(400, response.status_code)
+
+    def test_metrics_only_when_enabled(self):
+        response, content = self._get('/metrics/')
+        self.assertEqual(404, response.status_code)
+        with self.settings(METAFINDER_METRICS=True):
+            response, content = self._get('/metrics/', format='statsd')
+            self.assertEqual(200, response.status_code)
+            response, content = self._get('/metrics/', format='xml')
+            self.assertEqual(400, response.status_code)
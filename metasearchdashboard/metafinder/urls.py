@@ -17,4 +17,13 @@ from metasearchdashboard.metafinder import views
 
 urlpatterns = [
     url(r'^$', views.IndexView.as_view(), name='index'),
+    url(r'^tabs/(?P<tab_slug>[^/]+)/$',
+        views.TabContentView.as_view(), name='tab'),
+    url(r'^search/$', views.SearchView.as_view(), name='search'),
+    url(r'^export/$', views.ExportView.as_view(), name='export'),
+    url(r'^facets/$', views.FacetsView.as_view(), name='facets'),
+    url(r'^suggest/$', views.SuggestView.as_view(), name='suggest'),
+    url(r'^metrics/$', views.MetricsView.as_view(), name='metrics'),
+    url(r'^invalidate/(?P<resource_type>[^/]+)/$',
+        views.InvalidateCacheView.as_view(), name='invalidate'),
 ]
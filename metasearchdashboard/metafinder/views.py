@@ -10,11 +10,47 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
+
+from django import http
+from django.views import generic
+
 from horizon import tabs
+from metasearchdashboard.metafinder import admin_search
+from metasearchdashboard.metafinder import cache
+from metasearchdashboard.metafinder import export
+from metasearchdashboard.metafinder import index
+from metasearchdashboard.metafinder import metrics
+from metasearchdashboard.metafinder import query
+from metasearchdashboard.metafinder import search
+from metasearchdashboard.metafinder.api import resources
+from metasearchdashboard.metafinder.api import swift_helpers
 from metasearchdashboard.metafinder import tabs as metadb_tabs
 
 
-class IndexView(tabs.TabbedTableView):
+class ServerTimingMixin(object):
+    """
+    Adds the backend and rendering timings of the request as a Server-Timing
+    header, once the response has been rendered
+    """
+    def dispatch(self, request, *args, **kwargs):
+        response = super(ServerTimingMixin, self).dispatch(request, *args,
+                                                           **kwargs)
+        if not metrics.is_enabled():
+            return response
+        if getattr(response, 'is_rendered', True):
+            self._add_server_timing(response)
+        else:
+            response.add_post_render_callback(self._add_server_timing)
+        return response
+
+    def _add_server_timing(self, response):
+        timing = metrics.server_timing(self.request)
+        if timing:
+            response['Server-Timing'] = timing
+
+
+class IndexView(ServerTimingMixin, tabs.TabbedTableView):
     tab_group_class = metadb_tabs.MetaFinderTabs
     # A very simple class-based view...
     template_name = 'metasearchdashboard/metafinder/index.html'
@@ -22,3 +58,224 @@ class IndexView(tabs.TabbedTableView):
     def get_data(self, request, context, *args, **kwargs):
         # Add data to the context here...
         return context
+
+    def get_context_data(self, **kwargs):
+        context = super(IndexView, self).get_context_data(**kwargs)
+        context['tab_loading'] = metadb_tabs.get_tab_loading()
+        return context
+
+
+class TabContentView(ServerTimingMixin, tabs.TabView):
+    """
+    Renders the content of a single tab
+
+    The index page requests every tab from here at once, so each one shows
+    up as soon as its own backend answers. The tables post their actions to
+    the index view, see tables.IndexFormMixin.
+    """
+    tab_group_class = metadb_tabs.MetaFinderTabs
+
+    def get(self, request, *args, **kwargs):
+        tab_group = self.get_tabs(request)
+        tab = tab_group.get_tab(kwargs['tab_slug'])
+        if tab is None:
+            raise http.Http404()
+        tab.preload = True
+        return http.HttpResponse(tab.render())
+
+
+class InvalidateCacheView(generic.View):
+    """
+    Drops the cached pages of a resource type
+
+    Called by the panel's javascript once a metadata modal has saved, as
+    those edits go straight to the REST API and bypass our table actions.
+    """
+    def post(self, request, *args, **kwargs):
+        resource_type = kwargs['resource_type']
+        if resource_type not in resources.RESOURCE_TYPES:
+            raise http.Http404()
+        cache.invalidate(request, resource_type)
+        object_id = request.POST.get('object_id')
+        if object_id:
+            index.get_index(request).remove(resource_type, object_id)
+            if resource_type == resources.CONTAINERS:
+                swift_helpers.forget_container(request, object_id)
+        return http.HttpResponse(status=204)
+
+
+class SearchView(generic.View):
+    """
+    Streams resources matching a metadata query across resource types
+
+    GET parameters:
+    q: the query, see metafinder.query.parse
+    types: comma separated resource types, defaults to all of them but
+    objects, which are searched by HEADing each candidate. Object queries
+    can be narrowed with "container:<name>" and "prefix:<p>" terms
+    format: "ndjson" (default), one object per line, "json", an array,
+    "jsonl", one flattened object per line with metadata.<key> fields, or
+    "csv", with a metadata.<key> column per key
+    all_projects: admins only, "1" searches every project, results then
+    carry project_id and region and come sorted by name
+    regions: comma separated regions for all_projects, defaults to all
+
+    Results are written as each backend produces them, so memory use does
+    not grow with the size of the result set. All project searches are
+    merged before they are written.
+    """
+    content_types = {
+        'ndjson': 'application/x-ndjson',
+        'json': 'application/json',
+        'jsonl': 'application/x-ndjson',
+        'csv': 'text/csv',
+    }
+    default_format = 'ndjson'
+
+    def get(self, request, *args, **kwargs):
+        output_format = request.GET.get('format', self.default_format)
+        if output_format not in self.content_types:
+            return http.HttpResponseBadRequest('Unknown format.')
+        resource_types = [t for t in request.GET.get('types', '').split(',')
+                          if t] or list(resources.RESOURCE_TYPES)
+        if any(t not in resources.SEARCHABLE_TYPES for t in resource_types):
+            return http.HttpResponseBadRequest('Unknown resource type.')
+        try:
+            predicates = query.parse(request.GET.get('q', ''))
+        except query.QueryError as e:
+            return http.HttpResponseBadRequest(str(e))
+        if request.GET.get('all_projects') == '1':
+            if not request.user.is_superuser:
+                return http.HttpResponseForbidden()
+            if resources.OBJECTS in resource_types:
+                return http.HttpResponseBadRequest(
+                    'Objects cannot be searched across projects.')
+            regions = [r for r in request.GET.get('regions', '').split(',')
+                       if r] or None
+            results = admin_search.search(request, predicates,
+                                          resource_types, regions)
+        else:
+            results = search.stream(request, predicates, resource_types)
+        if output_format == 'json':
+            lines = self._json_array(results)
+        elif output_format == 'jsonl':
+            lines = export.jsonl_lines(results)
+        elif output_format == 'csv':
+            lines = export.csv_lines(results,
+                                     query.named_keys(predicates) or None)
+        else:
+            lines = (json.dumps(result) + '\n' for result in results)
+        response = http.StreamingHttpResponse(
+            lines, content_type=self.content_types[output_format])
+        return self.finalize_response(response, resource_types,
+                                      output_format)
+
+    def finalize_response(self, response, resource_types, output_format):
+        return response
+
+    def _json_array(self, results):
+        yield '['
+        separator = ''
+        for result in results:
+            yield separator + json.dumps(result)
+            separator = ','
+        yield ']'
+
+
+class ExportView(SearchView):
+    """
+    Downloads a search as a file, CSV unless format says otherwise
+
+    Takes the same parameters as SearchView. Every marker page of every
+    requested type is exported, rows are written as they are found.
+    """
+    default_format = 'csv'
+
+    def finalize_response(self, response, resource_types, output_format):
+        extension = 'jsonl' if output_format == 'ndjson' else output_format
+        response['Content-Disposition'] = (
+            'attachment; filename="metafinder-%s.%s"' %
+            ('-'.join(resource_types), extension))
+        return response
+
+
+class FacetsView(generic.View):
+    """
+    Returns the most used metadata keys and values of the project's index
+
+    GET parameters:
+    types: comma separated resource types, defaults to all of them
+    keys: how many keys per type, defaults to METAFINDER_FACET_KEYS
+    values: how many values per key, defaults to METAFINDER_FACET_VALUES
+
+    Counts cover the resources fetched or synced so far, they are kept up to
+    date by the index rather than counted for each request.
+    """
+    def get(self, request, *args, **kwargs):
+        resource_types = [t for t in request.GET.get('types', '').split(',')
+                          if t] or list(resources.RESOURCE_TYPES)
+        if any(t not in resources.RESOURCE_TYPES for t in resource_types):
+            return http.HttpResponseBadRequest('Unknown resource type.')
+        try:
+            keys = int(request.GET.get('keys', 0))
+            values = int(request.GET.get('values', 0))
+        except ValueError:
+            return http.HttpResponseBadRequest('Invalid count.')
+        facets = {}
+        for resource_type in resource_types:
+            facets[resource_type] = [
+                {'key': key, 'count': count,
+                 'values': [{'value': value, 'count': value_count}
+                            for value, value_count in top]}
+                for key, count, top in index.get_facets(
+                    request, resource_type, keys, values)]
+        return http.JsonResponse(facets)
+
+
+class SuggestView(generic.View):
+    """
+    Returns the metadata keys and values of the project's index closest to
+    what was typed, for completing searches
+
+    GET parameters:
+    type: the resource type
+    q: the text typed, any part of a key or value, typos included
+    limit: how many keys and values, 10 by default
+    """
+    def get(self, request, *args, **kwargs):
+        resource_type = request.GET.get('type')
+        if resource_type not in resources.RESOURCE_TYPES:
+            return http.HttpResponseBadRequest('Unknown resource type.')
+        try:
+            limit = int(request.GET.get('limit', 10))
+        except ValueError:
+            return http.HttpResponseBadRequest('Invalid limit.')
+        keys, values = index.get_index(request).suggest(
+            resource_type, request.GET.get('q', ''), limit)
+        return http.JsonResponse({
+            'keys': [{'key': key, 'score': score} for key, score in keys],
+            'values': [{'value': value, 'score': score}
+                       for value, score in values],
+        })
+
+
+class MetricsView(generic.View):
+    """
+    Exposes the panel's metrics for scraping
+
+    GET parameters:
+    format: "prometheus" (default) or "statsd"
+    """
+    renderers = {
+        'prometheus': metrics.prometheus_text,
+        'statsd': metrics.statsd_text,
+    }
+
+    def get(self, request, *args, **kwargs):
+        if not metrics.is_enabled():
+            raise http.Http404()
+        renderer = self.renderers.get(request.GET.get('format', 'prometheus'))
+        if renderer is None:
+            return http.HttpResponseBadRequest('Unknown format.')
+        return http.HttpResponse(renderer(),
+                                 content_type='text/plain; version=0.0.4')
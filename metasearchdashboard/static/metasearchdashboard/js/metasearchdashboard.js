@@ -1 +1,110 @@
 /* Additional JavaScript for metasearch. */
+
+horizon.metafinder = {
+  /* Tells the panel to drop its cached pages for a resource type, returns
+     the request. */
+  invalidate: function (resource_type, object_id) {
+    var $panel = $('.metafinder');
+    return $.ajax({
+      type: 'POST',
+      url: $panel.data('invalidate-url').replace('RESOURCE_TYPE', resource_type),
+      data: {object_id: object_id},
+      headers: {'X-CSRFToken': $panel.data('csrf-token')}
+    });
+  },
+
+  /* Puts the filter of a facet value in the table's search box and runs
+     the search, as if it had been typed. */
+  narrow: function ($value) {
+    var $facets = $value.closest('.metafinder-facets'),
+      $pane = $facets.parent(),
+      $input = $pane.find('input[name="' + $facets.data('filter-param') + '"]');
+    $input.val($value.data('query'));
+    $input.closest('.table_search').find('button').first().click();
+  },
+
+  /* Requests every tab that is not loaded yet at the same time, each pane
+     is filled in as soon as its own response arrives and its tables are
+     set up the way Horizon sets up the tables of lazy tabs. */
+  load_tabs: function () {
+    var $panel = $('.metafinder');
+    if ($panel.data('tab-loading') !== 'ajax') {
+      return;
+    }
+    $panel.find(".ajax-tabs a[data-loaded='false']").each(function () {
+      var $link = $(this),
+        $pane = $($link.attr('data-target')),
+        slug = $link.attr('data-target').split('__')[1];
+      $link.attr('data-loaded', 'true');
+      $pane.html('<span>' + gettext('Loading') + '&hellip;</span>');
+      $.ajax({
+        url: $panel.data('tab-url').replace('TAB_SLUG', slug),
+        success: function (data) {
+          $pane.html(data);
+          horizon.utils.loadAngular($pane);
+          horizon.tabs.initTabLoad($pane);
+          $pane.find('table.datatable').each(function () {
+            horizon.datatables.update_footer_count($(this), 0);
+          });
+        },
+        error: function () {
+          $link.attr('data-loaded', 'false');
+          $pane.html('');
+        }
+      });
+    });
+  }
+};
+
+horizon.addInitFunction(horizon.metafinder.init = function () {
+  horizon.metafinder.load_tabs();
+  $(document).on('click', '.metafinder .metadata-expand', function (evt) {
+    evt.preventDefault();
+    $(this).prev('.metadata-more').removeClass('hide');
+    $(this).remove();
+  });
+  $(document).on('click', '.metafinder .metafinder-facet-value', function (evt) {
+    evt.preventDefault();
+    horizon.metafinder.narrow($(this));
+  });
+});
+
+/* Metadata modals save through the REST API and reload the page once the
+   save succeeds. Successful saves are held until the panel has dropped its
+   cached pages for the resource, so the reload shows the new metadata. */
+(function () {
+  'use strict';
+
+  var SAVE_URL = /\/api\/(nova\/servers|cinder\/volumes|glance\/images)\/([^\/]+)\/(metadata|properties)\/?$/,
+    RESOURCE_TYPES = {
+      'nova/servers': 'instances',
+      'cinder/volumes': 'volumes',
+      'glance/images': 'images'
+    };
+
+  angular
+    .module('horizon.metafinder', [])
+    .factory('horizon.metafinder.metadataSaveInterceptor', metadataSaveInterceptor)
+    .config(['$httpProvider', function ($httpProvider) {
+      $httpProvider.interceptors.push('horizon.metafinder.metadataSaveInterceptor');
+    }]);
+
+  metadataSaveInterceptor.$inject = ['$q'];
+
+  function metadataSaveInterceptor($q) {
+    return {
+      response: function (response) {
+        var config = response.config,
+          match = config.method !== 'GET' && SAVE_URL.exec(config.url);
+        if (!match || !$('.metafinder').length) {
+          return response;
+        }
+        function done() {
+          return response;
+        }
+        return $q.when(horizon.metafinder.invalidate(
+          RESOURCE_TYPES[match[1]], decodeURIComponent(match[2]))).then(done, done);
+      }
+    };
+  }
+})();
@@ -31,7 +31,9 @@ setup(
     version='0.1',
     packages=[
         'metasearchdashboard', 'metasearchdashboard.metafinder',
-        'metasearchdashboard.metafinder.api', 'metasearchdashboard.enabled'
+        'metasearchdashboard.metafinder.api', 'metasearchdashboard.enabled',
+        'metasearchdashboard.management',
+        'metasearchdashboard.management.commands'
     ],
     package_data={
         'metasearchdashboard': [